@@ -16,9 +16,11 @@ auth_login_url = '/auth/login'
 sqlalchemy_url = 'sqlite:///' + root + '/database.sqlite'
 sqlalchemy_echo = False
 
-private_key = os.urandom(128)
+private_key = os.urandom(64).encode('hex')
     
 template_path = [root + '/templates']
+
+imgsizer_path = [os.path.join(os.path.dirname(root), 'static')]
 template_cache_dir = root + '/templates'
 
 session_type = 'ext:database'
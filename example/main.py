@@ -1,4 +1,4 @@
-from nitrogen.app import App
+from nitrogen.core import App
 
 from . import config
 
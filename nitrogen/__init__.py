@@ -1 +1,6 @@
-from .app import App
+
+# The full App imports every subsystem, so it is only built when asked for;
+# see nitrogen.app.build_app_class.
+def get_app_class():
+    from .app import get_app_class
+    return get_app_class()
@@ -0,0 +1,176 @@
+"""Admission control: cap the requests in flight, and shed load past that.
+
+When a worker is saturated, letting more requests in only makes every one of
+them slower. Instead, requests past the cap wait (briefly) in a bounded queue
+for a slot; if the queue is full or the wait runs out they are answered
+immediately with a 503 and a Retry-After header.
+
+A slot is held until the response body is closed, so slow streaming
+responses count against the cap too.
+
+Cheap requests (static files, health checks) can bypass the queue entirely.
+
+"""
+
+import logging
+import threading
+import time
+
+from . import status
+from .pipeline import passthrough
+
+
+log = logging.getLogger(__name__)
+
+
+class Limiter(object):
+
+    """Counts requests in flight, and makes the rest wait for a slot.
+
+        >>> limiter = Limiter(max_in_flight=1, max_queue=0)
+        >>> limiter.acquire()
+        True
+        >>> limiter.acquire()
+        False
+        >>> limiter.release()
+        >>> limiter.acquire()
+        True
+
+    """
+
+    def __init__(self, max_in_flight=16, max_queue=64, timeout=1.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def acquire(self):
+        """Take a slot, waiting up to `timeout` for one. Returns success."""
+        with self.condition:
+
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.timeout
+                while self.in_flight >= self.max_in_flight:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    @property
+    def stats(self):
+        return dict(
+            in_flight=self.in_flight,
+            waiting=self.waiting,
+            admitted=self.admitted,
+            rejected=self.rejected,
+            timed_out=self.timed_out,
+        )
+
+
+def admission_middleware(app, limiter, bypass=None, retry_after=1):
+    """WSGI middleware which admits requests through a `Limiter`.
+
+    `bypass` is an optional predicate on the environ; requests for which it is
+    true skip the limiter entirely.
+
+    """
+
+    def _admission_app(environ, start):
+
+        if bypass is not None and bypass(environ):
+            return app(environ, start)
+
+        if not limiter.acquire():
+            log.warning('shedding %s %s; %d in flight, %d waiting' % (
+                environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+                limiter.in_flight, limiter.waiting,
+            ))
+            response = status.ServiceUnavailable().get_response(environ)
+            response.headers['Retry-After'] = str(retry_after)
+            return response(environ, start)
+
+        released = []
+        def release():
+            if not released:
+                released.append(True)
+                limiter.release()
+
+        try:
+            app_iter = app(environ, start)
+        except:
+            release()
+            raise
+        return passthrough(app_iter, environ, release)
+
+    return _admission_app
+
+
+class AdmissionAppMixin(object):
+
+    def setup_config(self):
+        super(AdmissionAppMixin, self).setup_config()
+        self.config.setdefaults(
+            admission_max_in_flight=0, # Zero turns this off.
+            admission_max_queue=32,
+            admission_timeout=1.0,
+            admission_retry_after=1,
+            admission_bypass_static=True,
+            admission_bypass_paths=('/health', ),
+        )
+
+    def __init__(self, *args, **kwargs):
+        super(AdmissionAppMixin, self).__init__(*args, **kwargs)
+        if self.config.admission_max_in_flight:
+            self.admission_limiter = Limiter(
+                max_in_flight=self.config.admission_max_in_flight,
+                max_queue=self.config.admission_max_queue,
+                timeout=self.config.admission_timeout,
+            )
+            self.register_middleware(self.TRANSPORT_LAYER, admission_middleware, None, dict(
+                limiter=self.admission_limiter,
+                bypass=self.admission_bypass,
+                retry_after=self.config.admission_retry_after,
+            ))
+        else:
+            self.admission_limiter = None
+
+    def admission_bypass(self, environ):
+        """Should this request skip admission control?
+
+        By default, requests under any of `admission_bypass_paths` and (if
+        `admission_bypass_static`) for static files do.
+
+        """
+        path = environ.get('PATH_INFO') or '/'
+        for prefix in self.config.admission_bypass_paths:
+            if path == prefix or path.startswith(prefix.rstrip('/') + '/'):
+                return True
+        if self.config.admission_bypass_static:
+            return self.static_router.get_mtime(path) is not None
+        return False
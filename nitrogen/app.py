@@ -1,22 +1,25 @@
 
+import gc
 import logging
 import os
-import threading
+import time
 
 import werkzeug as wz
 import werkzeug.wrappers
 
-import webstar
-
 from . import config
+from . import context
+from . import metrics
 from . import request
+from . import route
 from . import status
 from . import mixin
 from .event import instance_event
+from .pipeline import is_file_wrapper, passthrough
 from .static import StaticRouter
 
 
-__all__ = ['App']
+__all__ = ['build_app_class', 'get_app_class']
 log = logging.getLogger(__name__)
 
 
@@ -38,11 +41,21 @@ class Core(object):
         # Setup initial routers. Use the primary router (or just the .route
         # method) for simple apps, or append your own router to the routers
         # list.
-        self.router = webstar.Router()
+        self.router = route.Router()
         self.static_router = StaticRouter(**self.config.filter_prefix('static_'))
         self.router.register(None, self.static_router)
         self.router.not_found_app = self.not_found_app
         
+        # Optional cache of resolved routes; cleared whenever the routing
+        # table changes.
+        if self.config.route_cache_size:
+            self.route_cache = route.RouteCache(self.router,
+                maxsize=self.config.route_cache_size,
+                uncacheable=[self.static_router],
+            )
+        else:
+            self.route_cache = None
+        
         # Setup middleware stack. This is a list of tuples; the second is a
         # function to call that takes a WSGI app, and returns one. The first
         # is a value (normally a tuple of ints) representing the priority;
@@ -57,11 +70,24 @@ class Core(object):
         # Use self.register_middleware to add to this list.
         self.middleware = []
         self._flattened_wsgi_app = None
+        self._compiled_wsgi_app = None
         
         self._local = self.local()
         
+        # Per-phase request timings, folded into histograms keyed by route.
+        # Mount the registry somewhere (or set metrics_url) to read them.
+        self.metrics = metrics.Registry()
+        self._metrics_local = self.local()
+        if self.config.metrics_on:
+            self._listen_metrics()
+        if self.config.metrics_url:
+            self.route(self.config.metrics_url, self.metrics)
+        
         Core.RequestMixin.app = self
         Core.ResponseMixin.app = self
+        # On our own Request class, since the mixins are shared by every app.
+        self.LiteRequest = type('LiteRequest', (request.LiteRequest, ), dict(__slots__=(), app=self))
+        self.Request.lite_class = self.LiteRequest
     
     def setup_config(self):
         self.config.setdefaults(
@@ -71,8 +97,22 @@ class Core(object):
             reload=False,
             reloader_packages=('nitrogen', 'app'),
             static_cache_max_age=3600,
+            static_index_interval=1.0,
+            static_manifest=None, # See nitrogen.manifest.
+            static_hot_cache_size=8 * 1024 * 1024, # Bytes of small files kept in memory.
+            static_hot_max_file_size=64 * 1024,
+            static_gzip_sidecars=True, # Serve "foo.js.gz" for "foo.js"; see nitrogen.precompress.
             cache_dir='/tmp',
+            compiled_pipeline=False,
+            metrics_on=False,
+            metrics_url=None,
+            route_cache_size=0,
         )
+        # Never stat static files in production; pick up changes while
+        # developing. See nitrogen.static.StaticIndex for 'watch' (pyinotify).
+        # A 'frozen' index does not serve files added after it is built, so
+        # deploy them before starting (or use 'poll' or 'watch').
+        self.config.setdefault('static_index', 'poll' if self.config.reload else 'frozen')
         self.config.setdefault('static_path', []).append(
             os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + '/static'
         )
@@ -109,22 +149,110 @@ class Core(object):
     
     # So we can overload it to check for permissions and predicates.
     def _get_wsgi_app(self, environ):
+        if self.route_cache is not None:
+            return self.route_cache.wsgi_route(environ)
         return self.router.wsgi_route(environ)
     
     def wsgi_app(self, environ, start):
-        app = self._get_wsgi_app(environ)
-        return self.Request.auto_application(app)(environ, start)
+        with self.time_phase('route'):
+            app = self._get_wsgi_app(environ)
+        app = self.Request.auto_application(app)
+        with self.time_phase('controller'):
+            return app(environ, start)
+    
+    def warmup(self):
+        """Do the work that would otherwise wait for the first requests.
+        
+        Call this once in the master of a pre-forking server (e.g. gunicorn
+        with `preload_app`) so that the results are shared copy-on-write by
+        all of the workers, instead of each one building its own copy.
+        
+        Mixins extend this to warm their own caches; they should do so before
+        calling the super method so that the final garbage collection (which
+        keeps refcount churn on the shared pages down) happens last.
+        
+        """
+        self.flatten_middleware()
+        mixin.build_all(self)
+        self.static_router.warmup()
+        gc.collect()
     
     def flatten_middleware(self):
         if self._flattened_wsgi_app is None:
             middleware = sorted(self.middleware)
             log.debug('Flattening middleware:')
             app = self.wsgi_app
+            timed = self.config.metrics_on
+            if timed:
+                app = metrics.timed_middleware(app, None, self._metrics_local)
             for priority, func, args, kwargs in middleware:
                 log.debug('%12r: %s' % (priority, func))
                 app = func(app, *args, **kwargs)
+                if timed:
+                    name = getattr(func, '__name__', None) or func.__class__.__name__
+                    app = metrics.timed_middleware(app, name, self._metrics_local)
             self._flattened_wsgi_app = app
+            self._compiled_wsgi_app = self.compile_pipeline(app) if self.config.compiled_pipeline else None
         return self._flattened_wsgi_app
+    
+    def compile_pipeline(self, app):
+        """Merge the request events and a flattened app into one WSGI callable.
+        
+        This does everything that `_iter_call` does, with the lookups of the
+        request state and events done once up front instead of per request.
+        The app iterator is handed straight back to the server and all of the
+        teardown (after_request, and popping the request context) happens in
+        its `close()` method. Server file wrappers survive the trip, so files
+        can be sent without passing through Python.
+        
+        Event listeners are read from the live lists so that anything which
+        listens after compilation is still called.
+        
+        """
+        
+        local = self._local
+        metrics_local = self._metrics_local
+        request_context = self.request_context
+        before_request = self.before_request.listeners
+        on_wsgi_start = self.on_wsgi_start.listeners
+        after_request = self.after_request.listeners
+        
+        def _teardown(environ, token):
+            try:
+                for func in after_request:
+                    func(environ)
+            finally:
+                request_context.pop(token)
+        
+        def _compiled_wsgi_app(environ, start):
+            
+            token = request_context.push()
+            
+            try:
+                local.environ = environ
+                
+                for func in before_request:
+                    func(environ)
+                
+                def _start(*args):
+                    for func in on_wsgi_start:
+                        func(*args)
+                    return start(*args)
+                
+                app_iter = app(environ, _start)
+            
+            except:
+                _teardown(environ, token)
+                raise
+            
+            # Files are sent by the server, so there is nothing to time.
+            phases = getattr(metrics_local, 'phases', None)
+            if phases is not None and not is_file_wrapper(app_iter):
+                app_iter = metrics.TimedIterator(app_iter, phases)
+            
+            return passthrough(app_iter, environ, lambda: _teardown(environ, token))
+        
+        return _compiled_wsgi_app
         
     @property
     def route(self):
@@ -134,44 +262,111 @@ class Core(object):
     def url_for(self):
         return self.router.url_for
     
-    @wz.utils.cached_property
-    def __managed_locals(self):
-        return []
+    # All per-request state lives in one context which is swapped in and out
+    # around each request; see nitrogen.context.
+    request_context = context.request_context
     
     def local(self):
-        """Return a managed thread-local object, reset for every request.
+        """Return a request-local object, reset for every request.
         
-        This is nessesary to make sure that thread re-use does not poison our
-        local objects (which we assume to be clean every time).
+        Attributes are stored in the current request context, so they are
+        local to the thread or greenlet serving the request, and thread (or
+        greenlet) re-use can not poison them.
         
         """
-        obj = threading.local()
-        self.__managed_locals.append(obj)
-        return obj
+        return self.request_context.local()
     
     def local_request(self):
-        return self.Request(self._local.environ)
+        """The (full) Request for the current request, built on first use.
+        
+        Nothing builds one up front, so endpoints served with lite requests
+        never pay for it.
+        
+        """
+        return self.Request.from_environ(self._local.environ)
     
     def __call__(self, environ, start):
         app = self.flatten_middleware()
+        if self._compiled_wsgi_app is not None:
+            return self._compiled_wsgi_app(environ, start)
+        return self._iter_call(app, environ, start)
+    
+    def _iter_call(self, app, environ, start):
         
-        self._local.environ = environ
-        self._local.request = self.local_request()
-        
-        self.before_request.trigger(environ)
+        token = self.request_context.push()
         
-        def _start(*args):
-            self.on_wsgi_start.trigger(*args)
-            return start(*args)
+        def _teardown():
+            try:
+                self.after_request.trigger(environ)
+            finally:
+                self.request_context.pop(token)
         
         try:
-            for x in app(environ, _start):
-                yield x
-                
-        finally:
-            self.after_request.trigger(environ)
-            for obj in self.__managed_locals:
-                obj.__dict__.clear()
+            self._local.environ = environ
+            
+            self.before_request.trigger(environ)
+            
+            def _start(*args):
+                self.on_wsgi_start.trigger(*args)
+                return start(*args)
+            
+            app_iter = app(environ, _start)
+        
+        except:
+            _teardown()
+            raise
+        
+        # Files are sent by the server, so there is nothing to time.
+        phases = getattr(self._metrics_local, 'phases', None)
+        if phases is not None and not is_file_wrapper(app_iter):
+            app_iter = metrics.TimedIterator(app_iter, phases)
+        
+        # Server file wrappers reach the server untouched; the teardown
+        # happens when the app iterator is closed.
+        return passthrough(app_iter, environ, _teardown)
+    
+    def time_phase(self, name):
+        """Context manager to time a phase of the current request.
+        
+        Does nothing unless metrics_on is set and we are within a request.
+        
+        """
+        phases = getattr(self._metrics_local, 'phases', None)
+        if phases is None:
+            return metrics.null_timer
+        return metrics.PhaseTimer(phases, self._metrics_local.active, name)
+    
+    def enable_metrics(self):
+        """Turn on metrics for an app that was built without metrics_on."""
+        if not self.config.metrics_on:
+            self.config['metrics_on'] = True
+            self._listen_metrics()
+            # Rebuild the middleware with the per-layer timers.
+            self._flattened_wsgi_app = None
+    
+    def _listen_metrics(self):
+        self.before_request.listen(self._start_metrics)
+        self.after_request.listen(self._finish_metrics)
+    
+    def _start_metrics(self, environ):
+        local = self._metrics_local
+        local.phases = {}
+        local.active = set()
+        local.child_time = 0
+        local.start_time = time.time()
+    
+    def _finish_metrics(self, environ):
+        local = self._metrics_local
+        phases = getattr(local, 'phases', None)
+        if phases is None:
+            return
+        phases['total'] = time.time() - local.start_time
+        self.metrics.observe_many(metrics.route_name(environ), phases)
+        # Break down the access log's single duration.
+        if hasattr(self, 'set_access_log_meta'):
+            self.set_access_log_meta(phases=','.join(
+                '%s:%.1f' % (name, 1000 * value) for name, value in sorted(phases.iteritems())
+            ))
     
     def test_client(self, use_cookies=True):
         """Builds a test client that will call this app."""
@@ -181,37 +376,90 @@ class Core(object):
 
 
 
-def _build_final_class():
-    from .auth import AuthAppMixin
-    from .cookies import CookieAppMixin
-    from .crud import CRUDAppMixin
-    from .exception import ExceptionAppMixin
-    from .imgsizer import ImgSizerAppMixin
-    from .logs import LoggingAppMixin
-    from .session import SessionAppMixin
-    from .sqlalchemy.app import SQLAlchemyAppMixin
-    from .tracker import TrackerAppMixin
-    from .view.app import ViewAppMixin
-    from .wtforms.app import FormAppMixin
-
-    # Be careful about the order of these.
-    class App(
-        ImgSizerAppMixin, # Needs View
-        FormAppMixin, # Needs View
-        CRUDAppMixin, # Needs View and SQLAlchemy
-        TrackerAppMixin, # Needs View (and maybe session)
-        SessionAppMixin, # Needs View (for view_globals)
-        ViewAppMixin,
-        SQLAlchemyAppMixin,
-        AuthAppMixin,
-        CookieAppMixin,
-        LoggingAppMixin,
-        ExceptionAppMixin, # Must be after anything that may throw exceptions.
-        Core
-    ):
-        pass
-        
-    return App
-
-
-App = _build_final_class()
\ No newline at end of file
+# The optional subsystems, as (name, 'module:MixinClass', dependencies). The
+# order here is the order in the final class's bases, so be careful about it.
+SUBSYSTEMS = (
+    ('imgsizer', 'nitrogen.imgsizer:ImgSizerAppMixin', ('view', )),
+    ('assets', 'nitrogen.assets:AssetsAppMixin', ('view', )),
+    ('forms', 'nitrogen.wtforms.app:FormAppMixin', ('view', )),
+    ('crud', 'nitrogen.crud:CRUDAppMixin', ('view', 'sqlalchemy')),
+    ('tracker', 'nitrogen.tracker:TrackerAppMixin', ('cookies', 'logging')),
+    ('session', 'nitrogen.session:SessionAppMixin', ('view', )), # For view_globals.
+    ('view', 'nitrogen.view.app:ViewAppMixin', ()),
+    ('sqlalchemy', 'nitrogen.sqlalchemy.app:SQLAlchemyAppMixin', ()),
+    ('auth', 'nitrogen.auth:AuthAppMixin', ('cookies', )),
+    ('cookies', 'nitrogen.cookies:CookieAppMixin', ()),
+    ('logging', 'nitrogen.logs:LoggingAppMixin', ()),
+    ('cache', 'nitrogen.cache:PageCacheAppMixin', ()),
+    ('singleflight', 'nitrogen.singleflight:SingleFlightAppMixin', ()),
+    ('admission', 'nitrogen.admission:AdmissionAppMixin', ()),
+    ('compress', 'nitrogen.compress:CompressAppMixin', ()),
+    ('exception', 'nitrogen.exception:ExceptionAppMixin', ()), # Must be after anything that may throw exceptions.
+)
+
+DEFAULT_SUBSYSTEMS = tuple(x[0] for x in SUBSYSTEMS)
+
+_subsystem_paths = dict((name, path) for name, path, deps in SUBSYSTEMS)
+_subsystem_deps = dict((name, deps) for name, path, deps in SUBSYSTEMS)
+
+
+def resolve_subsystems(names):
+    """Add the dependencies of the given subsystems, and put them in order.
+    
+        >>> resolve_subsystems(['auth', 'exception'])
+        ('auth', 'cookies', 'exception')
+    
+    """
+    enabled = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in _subsystem_deps:
+            raise ValueError('unknown subsystem %r' % name)
+        if name not in enabled:
+            enabled.add(name)
+            todo.extend(_subsystem_deps[name])
+    return tuple(x[0] for x in SUBSYSTEMS if x[0] in enabled)
+
+
+def load_subsystem(name):
+    """Import and return the app mixin for the named subsystem."""
+    module_name, class_name = _subsystem_paths[name].split(':')
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+_app_classes = {}
+
+def build_app_class(subsystems=DEFAULT_SUBSYSTEMS):
+    """Build an App class with only the given subsystems mixed in.
+    
+    Dependencies are added automatically, and only the modules for enabled
+    subsystems are imported. E.g. a JSON-only app can avoid PIL, beaker,
+    SQLAlchemy, and the template engines entirely with:
+    
+        App = build_app_class(['logging', 'exception'])
+    
+    Classes are cached, so asking for the same subsystems twice returns the
+    same class.
+    
+    """
+    names = resolve_subsystems(subsystems)
+    cls = _app_classes.get(names)
+    if cls is None:
+        bases = tuple(load_subsystem(name) for name in names) + (Core, )
+        cls = _app_classes[names] = type('App', bases, dict(
+            __module__=__name__,
+            subsystems=names,
+        ))
+    return cls
+
+
+def get_app_class():
+    """The App with every default subsystem, built on first call.
+    
+    Building it imports everything, so nothing does so until asked; use
+    `nitrogen.core.App` where that doesn't matter.
+    
+    """
+    return build_app_class()
@@ -0,0 +1,256 @@
+"""Static asset bundles: concatenated, minified, and fingerprinted.
+
+A bundle is a list of static files (by their path under `static_path`)
+which are served as one. Bundles are built on first use into a directory
+private to the app's user (by default under `cache_dir`; see
+`nitrogen.cache.make_private_dir`), and only rebuilt when one of their inputs
+changes (according to the static index, so checking costs no stats). A build
+on disk survives restarts.
+
+    App(assets_bundles={
+        'site.js': ['js/jquery.cookie.js', 'js/jquery.crud.js'],
+        'site.css': ['css/silk.css', 'css/site.css'],
+    })
+
+and in a template:
+
+    <script src="${asset_url('site.js')}"></script>
+
+Relative `url(...)`s in CSS are rewritten to absolute ones, since the bundle
+is served from elsewhere.
+
+"""
+
+import hashlib
+import logging
+import os
+import posixpath
+import re
+
+from . import manifest as manifests
+from . import status
+from .cache import default_cache_dir, make_private_dir
+from .singleflight import SingleFlight
+from .static import _StaticApp
+
+
+log = logging.getLogger(__name__)
+
+
+def minify_js(source):
+    # jsmin 2.x (see setup.py) works on byte strings; it mangles unicode.
+    from jsmin import jsmin
+    return jsmin(source)
+
+
+# Strings are kept as they are; comments are dropped.
+_css_token_re = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/''', re.S)
+_css_space_re = re.compile(r'\s+')
+_css_punct_re = re.compile(r'\s*([{};,>])\s*')
+_css_colon_re = re.compile(r':\s+')
+
+def _minify_css_code(source):
+    source = _css_space_re.sub(' ', source)
+    source = _css_colon_re.sub(':', source)
+    return _css_punct_re.sub(r'\1', source)
+
+def minify_css(source):
+    """Strip comments and needless whitespace (outside of strings) from CSS.
+
+        >>> minify_css('a, b {\\n  color: red; /* hi */\\n}\\n')
+        'a,b{color:red;}'
+        >>> minify_css('a:after { content: "x  /* y */  z"; }')
+        'a:after{content:"x  /* y */  z";}'
+
+    """
+    parts = []
+    pos = 0
+    for m in _css_token_re.finditer(source):
+        parts.append(_minify_css_code(source[pos:m.start()]))
+        parts.append(m.group(1) or '')
+        pos = m.end()
+    parts.append(_minify_css_code(source[pos:]))
+    return ''.join(parts).strip()
+
+
+_css_url_re = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+def absolutize_css_urls(source, path):
+    """Make relative url()s in the CSS at static `path` absolute.
+
+        >>> absolutize_css_urls('a { background: url("../img/x.png") }', 'css/site.css')
+        'a { background: url("/img/x.png") }'
+
+    """
+    base = posixpath.dirname('/' + path.lstrip('/'))
+    def _replace(m):
+        quote, url = m.groups()
+        if url.startswith(('/', 'data:', '#')) or '://' in url:
+            return m.group(0)
+        return 'url(%s%s%s)' % (quote, posixpath.normpath(posixpath.join(base, url)), quote)
+    return _css_url_re.sub(_replace, source)
+
+
+class Bundle(object):
+
+    def __init__(self, name, sources, minify=True):
+        self.name = name
+        self.sources = list(sources)
+        self.minify = minify
+        self.kind = os.path.splitext(name)[1].lstrip('.').lower()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+
+class _Build(object):
+
+    __slots__ = ('inputs', 'path', 'url_path')
+
+    def __init__(self, inputs, path, url_path):
+        self.inputs = inputs
+        self.path = path
+        self.url_path = url_path
+
+
+class AssetBundler(object):
+
+    """Builds bundles from a StaticRouter's files, and serves them.
+
+    Builds are served as the app's own scripts and styles, so the directory
+    they are kept in must be private to us; it is refused if it is not. It is
+    not touched until the first build, so apps without bundles never use it.
+
+    """
+
+    def __init__(self, static_router, directory, bundles=(), url_base='/__assets'):
+        self.static_router = static_router
+        self.directory = directory
+        self._directory_checked = False
+        self.url_base = '/' + url_base.strip('/')
+        self.bundles = {}
+        for bundle in bundles:
+            self.add(bundle)
+        self._builds = {}
+        self._by_url = {}
+        self._flights = SingleFlight()
+
+    def add(self, bundle):
+        self.bundles[bundle.name] = bundle
+
+    def _inputs(self, bundle):
+        """What the bundle is built from; changes whenever an input does."""
+        inputs = []
+        for source in bundle.sources:
+            file = self.static_router.get_file(source)
+            if file is None:
+                raise ValueError('%r: no static file %r' % (bundle.name, source))
+            inputs.append((source, file.path, file.mtime, file.size))
+        inputs.append(bundle.minify)
+        return tuple(inputs)
+
+    def get_build(self, name):
+        """Return the current build of a bundle, building it if needed."""
+        bundle = self.bundles[name]
+        inputs = self._inputs(bundle)
+        build = self._builds.get(name)
+        if build is None or build.inputs != inputs:
+            build = self._flights.do(name, lambda: self._build(bundle, inputs))
+        return build
+
+    def _build(self, bundle, inputs):
+
+        # Another thread may have finished this build as we were waiting.
+        build = self._builds.get(bundle.name)
+        if build is not None and build.inputs == inputs:
+            return build
+
+        if not self._directory_checked:
+            make_private_dir(self.directory)
+            self._directory_checked = True
+
+        input_key = hashlib.md5(repr(inputs)).hexdigest()
+        base, ext = os.path.splitext(bundle.name)
+        path = os.path.join(self.directory, '%s.%s%s' % (base, input_key, ext))
+
+        if os.path.exists(path):
+            with open(path, 'rb') as fh:
+                content = fh.read()
+        else:
+            log.info('building asset bundle %r' % bundle.name)
+            content = self.render(bundle)
+            dir_ = os.path.dirname(path)
+            if not os.path.exists(dir_):
+                os.makedirs(dir_)
+            tmp_path = '%s.tmp-%d' % (path, os.getpid())
+            with open(tmp_path, 'wb') as fh:
+                fh.write(content)
+            os.rename(tmp_path, path)
+
+        url_path = manifests.fingerprint(bundle.name, hashlib.md5(content).hexdigest())
+        build = _Build(inputs, path, url_path)
+        self._builds[bundle.name] = build
+        self._by_url[url_path] = build
+        return build
+
+    def render(self, bundle):
+        """Concatenate (and minify) the sources of a bundle."""
+        parts = []
+        for source in bundle.sources:
+            with open(self.static_router.get_file(source).path, 'rb') as fh:
+                content = fh.read()
+            if bundle.kind == 'css':
+                content = absolutize_css_urls(content, source)
+            parts.append(content)
+        # The semicolon guards against sources which do not end with one.
+        content = (';\n' if bundle.kind == 'js' else '\n').join(parts)
+        if bundle.minify:
+            if bundle.kind == 'js':
+                content = minify_js(content)
+            elif bundle.kind == 'css':
+                content = minify_css(content)
+        return content
+
+    def url(self, name):
+        """The fingerprinted URL of a bundle."""
+        return self.url_base + '/' + self.get_build(name).url_path
+
+    def __call__(self, environ, start):
+        path = environ.get('PATH_INFO', '').lstrip('/')
+        build = self._by_url.get(path)
+        if build is None:
+            # Maybe the bundle is built, but not yet by this process.
+            parsed = manifests.parse_fingerprint(path)
+            if parsed and parsed[0] in self.bundles:
+                build = self.get_build(parsed[0])
+                if build.url_path != path:
+                    build = None
+        if build is None:
+            raise status.NotFound('no such asset bundle')
+        return _StaticApp(build.path, self.static_router, immutable=True)(environ, start)
+
+
+class AssetsAppMixin(object):
+
+    def setup_config(self):
+        super(AssetsAppMixin, self).setup_config()
+        self.config.setdefaults(
+            assets_bundles={}, # Maps bundle names to lists of static paths.
+            assets_minify=True,
+            assets_url_base='__assets',
+            assets_dir=None, # Defaults to our own directory under cache_dir.
+        )
+
+    def __init__(self, *args, **kwargs):
+        super(AssetsAppMixin, self).__init__(*args, **kwargs)
+        self.assets = AssetBundler(
+            self.static_router,
+            self.config.assets_dir or default_cache_dir(self.config.cache_dir, 'nitrogen-assets'),
+            [Bundle(name, sources, self.config.assets_minify) for name, sources in self.config.assets_bundles.iteritems()],
+            self.config.assets_url_base,
+        )
+        self.route('/' + self.config.assets_url_base.strip('/'), self.assets)
+        self.view_globals['asset_url'] = self.asset_url
+
+    def asset_url(self, name):
+        return self.assets.url(name)
@@ -70,7 +70,7 @@ class AuthAppMixin(object):
         
     def _get_wsgi_app(self, environ):
         app = super(AuthAppMixin, self)._get_wsgi_app(environ)
-        request = self.Request(environ)
+        request = self.Request.from_environ(environ)
         route = request.route_steps
         # We always have a route at this point if the route was successful.
         # We may not have one if it is doing a normalization redirection or
@@ -0,0 +1,331 @@
+"""In-process load generation and benchmarking for nitrogen apps.
+
+Requests are made straight into the app through `nitrogen.test.Client`, so
+there is no network or server in the way, and the numbers reflect only the
+app (and nitrogen). Latency is recorded per target (from the outside), and
+per route and phase (from the app's own metrics, which are turned on for the
+run).
+
+Usage:
+
+    python -m nitrogen.bench example.main:app --scenario example -c 8 -d 10
+    python -m nitrogen.bench myapp:app --mix mix.json --processes -c 4
+
+A mix file is a JSON list of targets, e.g.:
+
+    [
+        {"path": "/", "weight": 10},
+        {"name": "search", "path": "/search?q=x", "weight": 2},
+        {"path": "/api/post", "method": "POST", "data": "{}",
+            "headers": {"Content-Type": "application/json"}},
+        {"path": "/events", "max_chunks": 2,
+            "headers": {"Accept": "text/event-stream"}}
+    ]
+
+"""
+
+import collections
+import json
+import logging
+import multiprocessing
+import random
+import sys
+import threading
+import time
+
+from . import metrics
+from .test import Client
+
+
+log = logging.getLogger(__name__)
+
+
+# Finer than the metrics defaults; 50us up to ~30s in 25% steps.
+BUCKETS = tuple(0.00005 * 1.25 ** i for i in xrange(60))
+
+
+class Target(object):
+
+    """One kind of request in a mix.
+
+    The path may be a callable, which will be called with the app to get the
+    real path (e.g. for signed URLs). Streaming responses can be cut off after
+    `max_chunks` chunks of the body.
+
+    """
+
+    def __init__(self, path, name=None, method='GET', weight=1, headers=None,
+        data=None, max_chunks=None
+    ):
+        self.path = path
+        self.name = name or (path if isinstance(path, basestring) else None)
+        if self.name is None:
+            raise ValueError('target with a callable path must have a name')
+        self.method = method
+        self.weight = weight
+        self.headers = dict(headers or {})
+        self.data = data
+        self.max_chunks = max_chunks
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.method, self.name)
+
+    def resolve(self, app):
+        path = self.path(app) if callable(self.path) else self.path
+        path, _, query = path.partition('?')
+        return dict(
+            path=path,
+            query_string=query,
+            method=self.method,
+            headers=self.headers.items(),
+            data=self.data,
+        )
+
+
+def load_mix(path):
+    """Load a list of targets from a JSON mix file."""
+    with open(path) as fh:
+        spec = json.load(fh)
+    return [Target(**dict((str(k), v) for k, v in x.iteritems())) for x in spec]
+
+
+# Scenarios for the example app (`example.main:app`).
+SCENARIOS = dict(
+    example=[
+        Target('/favicon.ico', name='static', weight=10),
+        Target('/cookies', name='cookies', weight=5),
+        Target('/session', name='session', weight=5),
+        Target('/crud', name='crud', weight=3),
+        Target(lambda app: app.auto_img_src('/img/silk-all.png', width=64), name='imgsizer', weight=3),
+        Target('/eventstream/events', name='eventstream', weight=1,
+            headers={'Accept': 'text/event-stream'},
+            max_chunks=2,
+        ),
+    ],
+)
+
+
+class Results(object):
+
+    """Latencies and status codes by target, plus the app's phase metrics."""
+
+    def __init__(self):
+        self.latency = {}
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.errors = collections.Counter()
+        self.phases = {}
+        self.elapsed = 0.0
+
+    @property
+    def count(self):
+        return sum(h.count for h in self.latency.itervalues())
+
+    @property
+    def throughput(self):
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def observe(self, name, status, elapsed):
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = metrics.Histogram(BUCKETS)
+        histogram.observe(elapsed)
+        self.statuses[name][status] += 1
+
+    def add_phases(self, items):
+        for key, histogram in items:
+            existing = self.phases.get(key)
+            if existing is None:
+                existing = self.phases[key] = metrics.Histogram(histogram.buckets)
+            existing.merge(histogram)
+
+    def merge(self, other):
+        for name, histogram in other.latency.iteritems():
+            existing = self.latency.get(name)
+            if existing is None:
+                existing = self.latency[name] = metrics.Histogram(BUCKETS)
+            existing.merge(histogram)
+        for name, counts in other.statuses.iteritems():
+            self.statuses[name].update(counts)
+        self.errors.update(other.errors)
+        self.add_phases(other.phases.iteritems())
+
+    def iter_report(self):
+        yield '%d requests in %.2fs: %.1f req/s, %d errors\n' % (
+            self.count, self.elapsed, self.throughput, sum(self.errors.itervalues()))
+        width = max([6] + [len(name) for name in self.latency])
+        yield '\n%-*s %8s %9s %9s %9s  %s\n' % (width, 'target', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'statuses')
+        for name, h in sorted(self.latency.iteritems()):
+            statuses = ' '.join('%s:%d' % x for x in sorted(self.statuses[name].iteritems()))
+            yield '%-*s %8d %9.2f %9.2f %9.2f  %s\n' % ((width, name, h.count) + _quantiles(h) + (statuses, ))
+        if self.errors:
+            yield '\nerrors:\n'
+            for (name, error), count in sorted(self.errors.iteritems()):
+                yield '    %s: %s x %d\n' % (name, error, count)
+        if self.phases:
+            width = max(len(route) for route, phase in self.phases)
+            phase_width = max(len(phase) for route, phase in self.phases)
+            yield '\n%-*s %-*s %8s %9s %9s %9s\n' % (width, 'route', phase_width, 'phase', 'count', 'p50 ms', 'p90 ms', 'p99 ms')
+            for (route, phase), h in sorted(self.phases.iteritems()):
+                yield '%-*s %-*s %8d %9.2f %9.2f %9.2f\n' % ((width, route, phase_width, phase, h.count) + _quantiles(h))
+
+
+def _quantiles(histogram):
+    return tuple(1000 * (histogram.quantile(q) or 0) for q in (0.5, 0.9, 0.99))
+
+
+def _request(app, client, target, request, results):
+    start = time.time()
+    try:
+        app_iter, status, headers = client.open(**request)
+        try:
+            for i, chunk in enumerate(app_iter):
+                if target.max_chunks and i + 1 >= target.max_chunks:
+                    break
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                close()
+    except Exception as e:
+        results.errors[(target.name, e.__class__.__name__)] += 1
+        return
+    results.observe(target.name, int(status.split(None, 1)[0]), time.time() - start)
+
+
+def _work(app, targets, deadline=None, count=None, seed=None):
+    """Make requests until the deadline or count is reached."""
+
+    rand = random.Random(seed)
+    client = Client(app, use_cookies=True)
+    requests = [(target, target.resolve(app)) for target in targets]
+    total = float(sum(target.weight for target in targets))
+
+    results = Results()
+    start = time.time()
+    done = 0
+    while (count is None or done < count) and (deadline is None or time.time() < deadline):
+        point = rand.random() * total
+        for target, request in requests:
+            point -= target.weight
+            if point < 0:
+                break
+        _request(app, client, target, request, results)
+        done += 1
+    results.elapsed = time.time() - start
+    return results
+
+
+def _run_threads(app, targets, concurrency, deadline, count, seed):
+    results = [None] * concurrency
+    def target(i):
+        results[i] = _work(app, targets, deadline, count, seed + i)
+    threads = [threading.Thread(target=target, args=(i, )) for i in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _run_processes(app, targets, concurrency, deadline, count, seed):
+    # Workers are forked, so they inherit the (warmed up) app as is.
+    queue = multiprocessing.Queue()
+    def target(i):
+        res = _work(app, targets, deadline, count, seed + i)
+        res.add_phases(app.metrics.items())
+        queue.put(res)
+    procs = [multiprocessing.Process(target=target, args=(i, )) for i in xrange(concurrency)]
+    for proc in procs:
+        proc.start()
+    # Must drain the queue before joining, or large results may deadlock.
+    results = [queue.get() for proc in procs]
+    for proc in procs:
+        proc.join()
+    return results
+
+
+def run(app, targets, concurrency=1, duration=10, requests=None, warmup=1,
+    processes=False, seed=0
+):
+    """Benchmark an app with a mix of targets; returns a `Results`.
+
+    Runs for `duration` seconds, or until `requests` requests (in total) have
+    been made. The app is first warmed up for `warmup` seconds (in this
+    process, so that forked workers inherit it warm).
+
+    """
+
+    app.enable_metrics()
+
+    if warmup:
+        _run_threads(app, targets, concurrency, time.time() + warmup, None, seed)
+    app.metrics.clear()
+    app.metrics.buckets = BUCKETS
+
+    count = -(-requests // concurrency) if requests else None
+    deadline = None if count else time.time() + duration
+
+    start = time.time()
+    runner = _run_processes if processes else _run_threads
+    worker_results = runner(app, targets, concurrency, deadline, count, seed)
+
+    results = Results()
+    for res in worker_results:
+        results.merge(res)
+    if not processes:
+        results.add_phases(app.metrics.items())
+    results.elapsed = time.time() - start
+    return results
+
+
+def load_app(spec):
+    """Import an app given as "package.module:attribute"."""
+    module_name, _, attr = spec.partition(':')
+    module = __import__(module_name, fromlist=['hack'])
+    return getattr(module, attr or 'app')
+
+
+def main(argv=None):
+
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] module:app')
+    parser.add_option('-m', '--mix', help='JSON file of targets')
+    parser.add_option('-s', '--scenario', help='built-in scenario; one of: %s' % ', '.join(sorted(SCENARIOS)))
+    parser.add_option('-c', '--concurrency', type='int', default=1)
+    parser.add_option('-d', '--duration', type='float', default=10,
+        help='seconds to run for [%default]')
+    parser.add_option('-n', '--requests', type='int',
+        help='total requests to make (instead of a duration)')
+    parser.add_option('-w', '--warmup', type='float', default=1,
+        help='seconds to warm up for [%default]')
+    parser.add_option('-p', '--processes', action='store_true',
+        help='use processes instead of threads')
+    parser.add_option('--seed', type='int', default=0)
+    opts, args = parser.parse_args(argv)
+
+    if len(args) != 1:
+        parser.error('exactly one app is required')
+    if opts.mix:
+        targets = load_mix(opts.mix)
+    elif opts.scenario:
+        try:
+            targets = SCENARIOS[opts.scenario]
+        except KeyError:
+            parser.error('unknown scenario %r' % opts.scenario)
+    else:
+        targets = [Target('/')]
+
+    app = load_app(args[0])
+    results = run(app, targets,
+        concurrency=opts.concurrency,
+        duration=opts.duration,
+        requests=opts.requests,
+        warmup=opts.warmup,
+        processes=opts.processes,
+        seed=opts.seed,
+    )
+    for line in results.iter_report():
+        sys.stdout.write(line)
+
+
+if __name__ == '__main__':
+    main()
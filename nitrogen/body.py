@@ -4,11 +4,19 @@ import tempfile
 from . import status
 
 
+# Bodies (and uploaded files) up to this size are kept in memory by the
+# spooling functions; larger ones roll over to a temporary file.
+DEFAULT_SPOOL_SIZE = 512 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+
 def reject_factory(total_length, content_type, filename, file_length):
     """Do not accept files."""
     raise status.RequestEntityTooLarge('not accepting posted files')
 
 def stringio_factory(total_length, content_type, filename, file_length):
+    """Keeps the whole file in memory; see spooled_factory for large files."""
     return StringIO()
 
 def tempfile_factory(total_length, content_type, filename, file_length):
@@ -20,3 +28,88 @@ def tempfile_factory(total_length, content_type, filename, file_length):
     """
     # We do need the "+" in there for the tempfile module's sake.
     return tempfile.TemporaryFile("w+b")
+
+def make_spooled_factory(max_size=DEFAULT_SPOOL_SIZE):
+    """Build a make_file which keeps files in memory up to `max_size` bytes.
+
+    Past that the file rolls over to a temporary file on disk, so it is cheap
+    for small files but large uploads do not sit in memory.
+
+    """
+    def spooled_factory(total_length, content_type, filename, file_length):
+        return tempfile.SpooledTemporaryFile(max_size, "w+b")
+    return spooled_factory
+
+spooled_factory = make_spooled_factory()
+
+
+class ProgressStream(object):
+
+    """Wraps a readable stream to report how much has been read from it.
+
+    The callback is called with the number of bytes read so far and the
+    expected total (which may be None) after every read.
+
+        >>> seen = []
+        >>> stream = ProgressStream(StringIO('hello world'), lambda *x: seen.append(x), 11)
+        >>> stream.read(5)
+        'hello'
+        >>> stream.read()
+        ' world'
+        >>> seen
+        [(5, 11), (11, 11)]
+
+    """
+
+    def __init__(self, stream, callback, total=None):
+        self.stream = stream
+        self.callback = callback
+        self.total = total
+        self.bytes_read = 0
+
+    def _advance(self, data):
+        if data:
+            self.bytes_read += len(data)
+            self.callback(self.bytes_read, self.total)
+        return data
+
+    def read(self, *args):
+        return self._advance(self.stream.read(*args))
+
+    def readline(self, *args):
+        return self._advance(self.stream.readline(*args))
+
+    def readlines(self, *args):
+        return [self._advance(line) for line in self.stream.readlines(*args)]
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def spool(stream, max_size=DEFAULT_SPOOL_SIZE, length=None, progress=None):
+    """Copy a stream into a seekable file, spooling to disk past `max_size`.
+
+    The copy is done in chunks, so the whole stream is never in memory at
+    once (unless it is under `max_size`). At most `length` bytes are read if
+    given. The `progress` callback is called as by `ProgressStream`.
+
+    Returns the spooled file, seeked back to the start.
+
+    """
+    out = tempfile.SpooledTemporaryFile(max_size, "w+b")
+    if progress is not None:
+        stream = ProgressStream(stream, progress, length)
+    remaining = length
+    while remaining is None or remaining > 0:
+        chunk = stream.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        out.write(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    out.seek(0)
+    return out
@@ -0,0 +1,125 @@
+"""Byte range (HTTP Range) support for file responses.
+
+Ranges are read from the file as they are sent, a block at a time, so a range
+of a large file is never loaded fully into memory. Several ranges are sent as
+a multipart/byteranges body.
+
+"""
+
+import os
+
+from werkzeug.http import parse_range_header, parse_if_range_header
+
+
+# More ranges than this and we send the whole file instead (which the spec
+# allows); lots of tiny ranges are far more expensive than they are worth.
+MAX_RANGES = 16
+
+
+def parse_ranges(header, length, max_ranges=MAX_RANGES):
+    """Resolve a Range header against a length into (start, stop) pairs.
+
+    Returns None if the header should be ignored (malformed, not in bytes, or
+    too many ranges), and an empty list if none of the ranges are satisfiable.
+
+        >>> parse_ranges('bytes=0-9', 100)
+        [(0, 10)]
+        >>> parse_ranges('bytes=0-0,-1', 100)
+        [(0, 1), (99, 100)]
+        >>> parse_ranges('bytes=90-200', 100)
+        [(90, 100)]
+        >>> parse_ranges('bytes=200-', 100)
+        []
+        >>> parse_ranges('items=0-1', 100) is None
+        True
+
+    """
+    try:
+        range_ = parse_range_header(header)
+    except ValueError:
+        return None
+    if range_ is None or range_.units != 'bytes' or len(range_.ranges) > max_ranges:
+        return None
+    ranges = []
+    for start, stop in range_.ranges:
+        if start < 0:
+            start = max(0, length + start)
+            stop = length
+        elif stop is None or stop > length:
+            stop = length
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def if_range_matches(header, etag=None, last_modified=None):
+    """Does an If-Range header still match the entity?
+
+    Only strong (exact) matches count; a date must equal the Last-Modified.
+
+    """
+    if_range = parse_if_range_header(header)
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified is not None and if_range.date == last_modified
+    return False
+
+
+def content_range(start, stop, length):
+    return 'bytes %d-%d/%d' % (start, stop - 1, length)
+
+
+def multipart_pieces(ranges, length, boundary, content_type):
+    """The pieces of a multipart/byteranges body; strings are sent as is,
+    and (start, stop) pairs are read from the file."""
+    pieces = []
+    for start, stop in ranges:
+        pieces.append('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n' % (
+            boundary, content_type, content_range(start, stop, length)))
+        pieces.append((start, stop))
+    pieces.append('\r\n--%s--\r\n' % boundary)
+    return pieces
+
+
+def pieces_length(pieces):
+    return sum(len(x) if isinstance(x, str) else x[1] - x[0] for x in pieces)
+
+
+def make_boundary():
+    return os.urandom(12).encode('hex')
+
+
+class RangeIterator(object):
+
+    """An app iterator over pieces of a file.
+
+    Each piece is either a string (which is sent as is) or a (start, stop)
+    range which is read from the file in blocks.
+
+    """
+
+    def __init__(self, file, pieces, block_size=64 * 1024):
+        self.file = file
+        self.pieces = pieces
+        self.block_size = block_size
+
+    def __iter__(self):
+        for piece in self.pieces:
+            if isinstance(piece, str):
+                yield piece
+                continue
+            start, stop = piece
+            self.file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = self.file.read(min(self.block_size, remaining))
+                if not chunk:
+                    # The file shrank under us; there is no honest way to
+                    # finish the body.
+                    raise IOError('file truncated while sending range')
+                remaining -= len(chunk)
+                yield chunk
+
+    def close(self):
+        self.file.close()
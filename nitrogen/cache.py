@@ -0,0 +1,469 @@
+"""Full-page response cache, with a memory tier and an optional disk tier.
+
+Controllers opt in by wrapping their WSGI app (usually the one made by
+`Request.application`):
+
+    @app.route('/about')
+    @app.page_cache.cached(ttl=300, tags=['pages'])
+    @Request.application
+    def about(request):
+        ...
+
+Only successful GET (and HEAD) responses without cookies or a private
+Cache-Control are stored. Entries are keyed by host, path, query, and any
+headers or cookies the page varies upon, and hold the status, headers, and
+body. Responses with a Vary header naming anything which is not in the key
+are not stored.
+
+Once an entry expires it may still be served for `stale` more seconds: the
+first request to find it stale renders a fresh copy while everyone else is
+given the stale one.
+
+Entries can be dropped early by tag with `invalidate`. Tags are invalidated
+by time, so that other processes sharing the disk tier see it too (within
+`tag_check_interval` seconds).
+
+The disk tier is off by default. When on, it lives in a directory which only
+the app's user may use (see `make_private_dir`); entries are stored as a line
+of JSON followed by the raw body, so nothing read back is ever executed.
+
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+
+from werkzeug.http import parse_cookie, parse_etags, unquote_etag
+
+from .lru import LRUCache
+from .pipeline import PassthroughIterator
+
+
+log = logging.getLogger(__name__)
+
+
+def make_private_dir(path):
+    """Create a directory which only we may use, or check an existing one.
+
+    Raises ValueError if the path is not a real directory owned by us, or if
+    anyone else may write to it, since anything found inside could have been
+    planted.
+
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise ValueError('%r is not a directory' % path)
+    if st.st_uid != os.getuid():
+        raise ValueError('%r is not owned by us' % path)
+    if st.st_mode & 0022:
+        raise ValueError('%r is writable by others' % path)
+    return path
+
+
+def default_cache_dir(cache_dir, name):
+    """Our own directory under `cache_dir` (which is often a shared /tmp)."""
+    return os.path.join(cache_dir, '%s-%d' % (name, os.getuid()))
+
+
+def request_key(environ, vary=(), vary_cookies=(), method='GET'):
+    """Key a request by host, path, query, and the given headers and cookies.
+
+        >>> from werkzeug.test import create_environ
+        >>> a = request_key(create_environ('/a?x=1'))
+        >>> a == request_key(create_environ('/a?x=1', headers=[('Accept-Language', 'fr')]))
+        True
+        >>> a == request_key(create_environ('/a?x=1', headers=[('Accept-Language', 'fr')]), ['Accept-Language'])
+        False
+
+    """
+    parts = [
+        method,
+        environ.get('wsgi.url_scheme', ''),
+        environ.get('HTTP_HOST') or environ.get('SERVER_NAME', ''),
+        environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+        environ.get('QUERY_STRING', ''),
+    ]
+    for name in vary:
+        parts.append(environ.get('HTTP_' + name.upper().replace('-', '_'), ''))
+    if vary_cookies:
+        cookies = parse_cookie(environ)
+        parts.extend(cookies.get(name, '') for name in vary_cookies)
+    return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+def vary_is_keyed(value, vary=(), vary_cookies=()):
+    """Is everything a Vary header names part of the key from `request_key`?
+
+    A Cookie is taken to be covered by the cookies in the key.
+
+        >>> vary_is_keyed('Accept-Language', ['accept-language'])
+        True
+        >>> vary_is_keyed('Accept-Language, Accept-Encoding', ['Accept-Language'])
+        False
+        >>> vary_is_keyed('Cookie', vary_cookies=['user_id'])
+        True
+        >>> vary_is_keyed('*', ['Accept-Language'])
+        False
+
+    """
+    keyed = set(name.lower() for name in vary)
+    if vary_cookies:
+        keyed.add('cookie')
+    for name in value.split(','):
+        name = name.strip().lower()
+        if name and name not in keyed:
+            return False
+    return True
+
+
+class Entry(object):
+
+    __slots__ = ('status', 'headers', 'body', 'created', 'expires', 'stale_until', 'tags')
+
+    def __init__(self, status, headers, body, created, expires, stale_until, tags):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.created = created
+        self.expires = expires
+        self.stale_until = stale_until
+        self.tags = tags
+
+    def dumps(self):
+        """Serialize as a line of JSON (everything but the body), then the body."""
+        meta = dict((name, getattr(self, name)) for name in self.__slots__ if name != 'body')
+        # Header values are bytes; latin-1 round trips any of them.
+        return json.dumps(meta, encoding='latin-1') + '\n' + self.body
+
+    @classmethod
+    def loads(cls, data):
+        meta, body = data.split('\n', 1)
+        return cls.from_meta(json.loads(meta), body)
+
+    @classmethod
+    def from_meta(cls, meta, body=None):
+        return cls(
+            str(meta['status']),
+            [(name.encode('latin-1'), value.encode('latin-1')) for name, value in meta['headers']],
+            body,
+            meta['created'],
+            meta['expires'],
+            meta['stale_until'],
+            tuple(tag.encode('latin-1') for tag in meta['tags']),
+        )
+
+    @classmethod
+    def load_meta(cls, fh):
+        """Read just the metadata from an open entry file; the body is None."""
+        return cls.from_meta(json.loads(fh.readline()))
+
+
+class PageCache(object):
+
+    """Response cache with a bounded memory LRU in front of a directory.
+
+    The directory (if given) is created private to us, and refused if it is
+    not; see `make_private_dir`.
+
+    """
+
+    def __init__(self, maxsize=1024, directory=None, ttl=60, stale=0,
+        vary=(), vary_cookies=(), max_entry_size=1024 * 1024,
+        tag_check_interval=1.0
+    ):
+        self.memory = LRUCache(maxsize)
+        self.directory = make_private_dir(directory) if directory else None
+        self.ttl = ttl
+        self.stale = stale
+        self.vary = tuple(vary)
+        self.vary_cookies = tuple(vary_cookies)
+        self.max_entry_size = max_entry_size
+        self.tag_check_interval = tag_check_interval
+
+        self._lock = threading.Lock()
+        self._revalidating = set()
+        self._tag_times = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def make_key(self, environ, vary=(), vary_cookies=()):
+        """The cache key for a request; HEAD shares with GET."""
+        return request_key(environ, self.vary + tuple(vary), self.vary_cookies + tuple(vary_cookies))
+
+    # Tags.
+
+    def invalidate(self, *tags):
+        """Drop every entry with any of these tags."""
+        now = time.time()
+        for tag in tags:
+            self._tag_times[tag] = (now, now)
+            path = self._tag_path(tag)
+            if path:
+                self._write(path, '')
+                os.utime(path, (now, now))
+
+    def _tag_path(self, tag):
+        if self.directory:
+            return os.path.join(self.directory, 'tags', hashlib.sha1(tag).hexdigest())
+
+    def _tag_invalidated_at(self, tag, now):
+        invalidated, checked = self._tag_times.get(tag, (0, 0))
+        path = self._tag_path(tag)
+        if path and now - checked > self.tag_check_interval:
+            try:
+                invalidated = max(invalidated, os.path.getmtime(path))
+            except OSError:
+                pass
+            self._tag_times[tag] = (invalidated, now)
+        return invalidated
+
+    def _is_current(self, entry, now):
+        for tag in entry.tags:
+            if entry.created <= self._tag_invalidated_at(tag, now):
+                return False
+        return True
+
+    # Storage.
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _write(self, path, data):
+        # Write then rename, so readers never see a partial file.
+        dir_ = os.path.dirname(path)
+        if not os.path.exists(dir_):
+            try:
+                os.makedirs(dir_)
+            except OSError:
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=dir_, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmp_path, path)
+
+    def get(self, key, now=None):
+        """Get an entry (which may be stale) or None."""
+        now = now or time.time()
+        entry = self.memory.get(key)
+        if entry is None and self.directory:
+            try:
+                with open(self._entry_path(key), 'rb') as fh:
+                    entry = Entry.loads(fh.read())
+            except (IOError, ValueError, KeyError, TypeError):
+                pass
+            else:
+                self.memory[key] = entry
+        if entry is None:
+            return None
+        if entry.stale_until < now or not self._is_current(entry, now):
+            self.delete(key)
+            return None
+        return entry
+
+    def set(self, key, entry):
+        self.memory[key] = entry
+        if self.directory:
+            try:
+                self._write(self._entry_path(key), entry.dumps())
+            except (IOError, OSError):
+                log.exception('could not write page cache entry')
+
+    def delete(self, key):
+        self.memory.pop(key)
+        if self.directory:
+            try:
+                os.unlink(self._entry_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        self.memory.clear()
+        self._tag_times.clear()
+        if self.directory:
+            for dir_path, dir_names, file_names in os.walk(self.directory):
+                for name in file_names:
+                    os.unlink(os.path.join(dir_path, name))
+
+    def prune(self):
+        """Delete expired entries from the disk tier."""
+        if not self.directory:
+            return
+        now = time.time()
+        for dir_path, dir_names, file_names in os.walk(self.directory):
+            if os.path.basename(dir_path) == 'tags':
+                continue
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                try:
+                    with open(path, 'rb') as fh:
+                        entry = Entry.load_meta(fh)
+                except (IOError, ValueError, KeyError, TypeError):
+                    continue
+                if entry.stale_until < now or not self._is_current(entry, now):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            stale_hits=self.stale_hits,
+            misses=self.misses,
+            memory=self.memory.stats,
+        )
+
+    # WSGI.
+
+    def cached(self, ttl=None, stale=None, tags=(), vary=(), vary_cookies=()):
+        """Decorator to cache the responses of a WSGI app."""
+        def _decorator(app):
+            def _cached_app(environ, start):
+                return self.serve(app, environ, start, ttl, stale, tags, vary, vary_cookies)
+            _cached_app.__name__ = getattr(app, '__name__', 'cached_app')
+            _cached_app.__doc__ = getattr(app, '__doc__', None)
+            return _cached_app
+        return _decorator
+
+    def serve(self, app, environ, start, ttl=None, stale=None, tags=(), vary=(), vary_cookies=()):
+
+        method = environ.get('REQUEST_METHOD')
+        if method not in ('GET', 'HEAD') or environ.get('HTTP_AUTHORIZATION'):
+            return app(environ, start)
+
+        key = self.make_key(environ, vary, vary_cookies)
+        now = time.time()
+        entry = self.get(key, now)
+
+        if entry is not None:
+            if entry.expires >= now:
+                self.hits += 1
+                return self._serve_entry(entry, environ, start, 'HIT')
+            # Stale; someone else is already rendering a fresh copy.
+            with self._lock:
+                revalidating = key in self._revalidating
+                if not revalidating:
+                    self._revalidating.add(key)
+            if revalidating:
+                self.stale_hits += 1
+                return self._serve_entry(entry, environ, start, 'STALE')
+        else:
+            with self._lock:
+                self._revalidating.add(key)
+
+        self.misses += 1
+        try:
+            return self._render(app, environ, start, key, now,
+                self.ttl if ttl is None else ttl,
+                self.stale if stale is None else stale,
+                tuple(tags),
+                self.vary + tuple(vary),
+                self.vary_cookies + tuple(vary_cookies),
+            )
+        finally:
+            with self._lock:
+                self._revalidating.discard(key)
+
+    def _serve_entry(self, entry, environ, start, state):
+        headers = list(entry.headers)
+        headers.append(('X-Cache', state))
+        body = entry.body
+        etag = dict((k.lower(), v) for k, v in entry.headers).get('etag')
+        if etag and environ.get('HTTP_IF_NONE_MATCH'):
+            if parse_etags(environ['HTTP_IF_NONE_MATCH']).contains(unquote_etag(etag)[0]):
+                start('304 Not Modified', [(k, v) for k, v in headers if k.lower() in ('etag', 'cache-control', 'expires', 'vary', 'x-cache')])
+                return []
+        start(entry.status, headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [body]
+
+    def _render(self, app, environ, start, key, now, ttl, stale, tags, vary, vary_cookies):
+
+        captured = []
+        def _start(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+            return start(status, headers + [('X-Cache', 'MISS')], exc_info)
+
+        app_iter = app(environ, _start)
+
+        # A HEAD has no body to store.
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return app_iter
+
+        chunks = []
+        size = 0
+        iterator = iter(app_iter)
+        for chunk in iterator:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.max_entry_size:
+                # Too big to keep; send the rest as it comes.
+                return PassthroughIterator.prefetched(''.join(chunks), iterator, app_iter)
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+
+        status, headers = captured
+        if self._is_storable(status, headers, vary, vary_cookies):
+            self.set(key, Entry(status, list(headers), ''.join(chunks), now, now + ttl, now + ttl + stale, tags))
+        return chunks
+
+    def _is_storable(self, status, headers, vary=(), vary_cookies=()):
+        if not status.startswith('200'):
+            return False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return False
+            if name == 'cache-control' and ('private' in value or 'no-store' in value):
+                return False
+            # We would serve it to requests it doesn't apply to.
+            if name == 'vary' and not vary_is_keyed(value, vary, vary_cookies):
+                return False
+        return True
+
+
+class PageCacheAppMixin(object):
+
+    def setup_config(self):
+        super(PageCacheAppMixin, self).setup_config()
+        self.config.setdefaults(
+            page_cache_maxsize=1024,
+            page_cache_disk=False,
+            page_cache_dir=None, # Defaults to our own directory under cache_dir.
+            page_cache_ttl=60,
+            page_cache_stale=0,
+            page_cache_vary=(),
+            page_cache_vary_cookies=(),
+            page_cache_max_entry_size=1024 * 1024,
+        )
+
+    def __init__(self, *args, **kwargs):
+        super(PageCacheAppMixin, self).__init__(*args, **kwargs)
+        self.page_cache = PageCache(
+            maxsize=self.config.page_cache_maxsize,
+            directory=(
+                self.config.page_cache_dir or default_cache_dir(self.config.cache_dir, 'nitrogen-page-cache')
+            ) if self.config.page_cache_disk else None,
+            ttl=self.config.page_cache_ttl,
+            stale=self.config.page_cache_stale,
+            vary=self.config.page_cache_vary,
+            vary_cookies=self.config.page_cache_vary_cookies,
+            max_entry_size=self.config.page_cache_max_entry_size,
+        )
+        self.cache_page = self.page_cache.cached
@@ -0,0 +1,252 @@
+"""Response compression (gzip or deflate) negotiated by Accept-Encoding.
+
+Bodies are compressed incrementally as they are produced, so streaming
+responses stay streaming; event streams are flushed after every event so that
+they arrive immediately.
+
+ETags of compressed responses get an encoding suffix (since the bytes differ
+from the identity response), which is stripped from If-None-Match on the way
+in so that the app still sees its own ETags. Apps which encode responses
+themselves can find what the client really sent at `IF_NONE_MATCH_KEY`.
+
+"""
+
+import re
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+
+DEFAULT_MIMETYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'application/xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'image/svg+xml',
+)
+
+# These are flushed after every chunk, since each is meaningful on its own.
+FLUSH_MIMETYPES = ('text/event-stream', )
+
+ENCODINGS = ('gzip', 'deflate')
+
+_etag_suffix_re = re.compile(r'-(%s)"' % '|'.join(ENCODINGS))
+
+# Where the If-None-Match is kept when we strip our suffixes from it.
+IF_NONE_MATCH_KEY = 'nitrogen.compress.if_none_match'
+
+
+def choose_encoding(accept_encoding):
+    """Pick the encoding to use given an Accept-Encoding header.
+
+        >>> choose_encoding('gzip, deflate')
+        'gzip'
+        >>> choose_encoding('deflate;q=1, gzip;q=0.5')
+        'deflate'
+        >>> choose_encoding('gzip;q=0, identity') is None
+        True
+
+    """
+    best = None
+    best_quality = 0
+    for value, quality in parse_accept_header(accept_encoding):
+        value = value.lower()
+        if value == '*':
+            value = ENCODINGS[0]
+        if value in ENCODINGS and quality > best_quality:
+            best = value
+            best_quality = quality
+    return best
+
+
+def compressobj(encoding, level=6):
+    # zlib emits gzip framing for wbits 16+, and zlib framing (which is what
+    # HTTP calls "deflate") by default.
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+class _CompressingIterator(object):
+
+    def __init__(self, app_iter, state):
+        self.app_iter = app_iter
+        self._next = iter(app_iter).next
+        self.state = state
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self.done:
+            try:
+                chunk = self._next()
+            except StopIteration:
+                self.done = True
+                compressor = self.state.get('compressor')
+                if compressor is not None:
+                    tail = compressor.flush()
+                    if tail:
+                        return tail
+                raise
+            compressor = self.state.get('compressor')
+            if compressor is None:
+                return chunk
+            data = compressor.compress(chunk)
+            if self.state['flush']:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                return data
+        raise StopIteration()
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def compress_middleware(app, min_size=500, mimetypes=DEFAULT_MIMETYPES, level=6,
+    flush_mimetypes=FLUSH_MIMETYPES
+):
+    """WSGI middleware to compress responses the client will accept.
+
+    Only responses with a mimetype starting with one of `mimetypes` are
+    compressed, and only if they are not known to be smaller than `min_size`
+    bytes. Responses which are already encoded, ranged, or handed off to the
+    server via X-Sendfile are left alone.
+
+    """
+
+    mimetypes = tuple(mimetypes)
+    flush_mimetypes = tuple(flush_mimetypes)
+
+    def _compress_app(environ, start):
+
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            def _start_identity(status, headers, exc_info=None):
+                # Caches must still know that other clients may differ.
+                names = _header_names(headers)
+                if _mimetype(headers, names).startswith(mimetypes):
+                    _add_vary(headers, names)
+                return start(status, headers, exc_info)
+            return app(environ, _start_identity)
+
+        # The app doesn't know about our ETag suffixes.
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        client_etag_suffixed = False
+        if if_none_match:
+            stripped = _etag_suffix_re.sub('"', if_none_match)
+            if stripped != if_none_match:
+                environ[IF_NONE_MATCH_KEY] = if_none_match
+                environ['HTTP_IF_NONE_MATCH'] = stripped
+                client_etag_suffixed = True
+
+        state = {}
+
+        def _start(status, headers, exc_info=None):
+
+            # Until we decide otherwise, the body is passed through.
+            state['compressor'] = None
+
+            code = int(status.split(None, 1)[0])
+            names = _header_names(headers)
+
+            # A 304 must carry the ETag which the client actually has.
+            if code == 304 and client_etag_suffixed and 'etag' in names:
+                _suffix_etag(headers, names['etag'], encoding)
+
+            mimetype = _mimetype(headers, names)
+            if not mimetype.startswith(mimetypes):
+                return start(status, headers, exc_info)
+
+            # The response depends on Accept-Encoding whether or not we
+            # compress this particular one.
+            _add_vary(headers, names)
+
+            length = headers[names['content-length']][1] if 'content-length' in names else None
+            if (
+                code < 200 or code in (204, 206, 304) or
+                'content-encoding' in names or
+                'content-range' in names or
+                'x-sendfile' in names or
+                'no-transform' in (headers[names['cache-control']][1] if 'cache-control' in names else '') or
+                (length is not None and length.isdigit() and int(length) < min_size)
+            ):
+                return start(status, headers, exc_info)
+
+            headers = [(name, value) for name, value in headers if name.lower() not in ('content-length', 'accept-ranges')]
+            headers.append(('Content-Encoding', encoding))
+            for i, (name, value) in enumerate(headers):
+                if name.lower() == 'etag':
+                    _suffix_etag(headers, i, encoding)
+
+            compressor = state['compressor'] = compressobj(encoding, level)
+            state['flush'] = mimetype.startswith(flush_mimetypes)
+
+            write = start(status, headers, exc_info)
+            def _write(data):
+                write(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))
+            return _write
+
+        app_iter = app(environ, _start)
+
+        # HEAD responses have no body to compress, and if the headers are out
+        # and we decided not to compress there is no need to wrap the body
+        # (which keeps server file wrappers intact).
+        if environ.get('REQUEST_METHOD') == 'HEAD' or ('compressor' in state and state['compressor'] is None):
+            return app_iter
+        return _CompressingIterator(app_iter, state)
+
+    return _compress_app
+
+
+def _header_names(headers):
+    return dict((name.lower(), i) for i, (name, value) in enumerate(headers))
+
+
+def _mimetype(headers, names):
+    if 'content-type' not in names:
+        return ''
+    return headers[names['content-type']][1].split(';')[0].strip().lower()
+
+
+def _add_vary(headers, names):
+    if 'vary' in names:
+        i = names['vary']
+        name, value = headers[i]
+        if 'accept-encoding' not in value.lower() and value.strip() != '*':
+            headers[i] = (name, value + ', Accept-Encoding')
+    else:
+        headers.append(('Vary', 'Accept-Encoding'))
+
+
+def _suffix_etag(headers, i, encoding):
+    name, value = headers[i]
+    if value.endswith('"') and not value.endswith('-%s"' % encoding):
+        headers[i] = (name, value[:-1] + '-%s"' % encoding)
+
+
+class CompressAppMixin(object):
+
+    def setup_config(self):
+        super(CompressAppMixin, self).setup_config()
+        self.config.setdefaults(
+            compress_on=False,
+            compress_min_size=500,
+            compress_level=6,
+            compress_mimetypes=DEFAULT_MIMETYPES,
+        )
+
+    def __init__(self, *args, **kwargs):
+        super(CompressAppMixin, self).__init__(*args, **kwargs)
+        if self.config.compress_on:
+            # Outside of the exception handler so error pages are compressed.
+            self.register_middleware((self.FRAMEWORK_LAYER, 1000), compress_middleware, None, dict(
+                min_size=self.config.compress_min_size,
+                mimetypes=self.config.compress_mimetypes,
+                level=self.config.compress_level,
+            ))
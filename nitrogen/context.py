@@ -0,0 +1,105 @@
+"""Per-request state which is local to threads and greenlets.
+
+All state for a request lives in a single dict (the context) which is swapped
+in when the request starts and swapped back out when it ends, so starting and
+finishing a request costs the same no matter how many locals exist.
+
+Contexts are keyed by the current greenlet if greenlet is installed (which
+also distinguishes threads, since each has its own main greenlet), otherwise
+by the current thread. Outside of a request the context is empty and
+anything stored in it is thrown away; nothing is kept for the greenlet or
+thread (which may be short-lived, or re-used).
+
+    >>> ctx = RequestContext()
+    >>> local = ctx.local()
+    >>> token = ctx.push()
+    >>> local.value = 123
+    >>> local.value
+    123
+    >>> ctx.pop(token)
+    >>> getattr(local, 'value', None) is None
+    True
+
+"""
+
+try:
+    from greenlet import getcurrent as get_ident
+except ImportError:
+    from thread import get_ident
+
+
+class RequestContext(object):
+
+    def __init__(self):
+        self._contexts = {}
+
+    def push(self):
+        """Start a fresh context; returns a token to give to `pop`.
+
+        The previous context (if any) is restored by `pop`, so requests may
+        be nested.
+
+        """
+        ident = get_ident()
+        token = (ident, self._contexts.get(ident))
+        self._contexts[ident] = {}
+        return token
+
+    def pop(self, token):
+        ident, previous = token
+        if previous is None:
+            self._contexts.pop(ident, None)
+        else:
+            self._contexts[ident] = previous
+
+    def current(self):
+        """Get the current context; a throwaway one if we are not in a request."""
+        try:
+            return self._contexts[get_ident()]
+        except KeyError:
+            return {}
+
+    def local(self):
+        return ContextLocal(self)
+
+
+class ContextLocal(object):
+
+    """An object whose attributes are stored in the current context.
+
+    This is a drop-in replacement for `threading.local`, including access to
+    the underlying `__dict__`.
+
+    """
+
+    __slots__ = ('_context', )
+
+    def __init__(self, context):
+        object.__setattr__(self, '_context', context)
+
+    @property
+    def __dict__(self):
+        context = self._context.current()
+        try:
+            return context[self]
+        except KeyError:
+            return context.setdefault(self, {})
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+# The context shared by all apps (and the logging formatters).
+request_context = RequestContext()
@@ -275,15 +275,7 @@ class _RequestMixin(object):
     @wz.utils.cached_property
     def cookies(self):
         """Read only access to the retrieved cookie values as dictionary."""
-        raw = parse_cookies(self.environ.get('HTTP_COOKIE', ''))
-        encryption_key = hashlib.md5(self.app.config.private_key).digest() if self.app.config.private_key else '0123456789abcdef'
-        ret = {}
-        for key, raw_value in raw.iteritems():
-            try:
-                ret[key] = sign.loads(encryption_key, raw_value, depends_on=dict(name=key), strict=True)
-            except ValueError:
-                pass
-        return self.dict_storage_class(ret)
+        return self.dict_storage_class(self.app.load_cookies(self.environ.get('HTTP_COOKIE', '')))
 
 
 class _ResponseMixin(object):
@@ -297,14 +289,28 @@ class _ResponseMixin(object):
 
 class CookieAppMixin(object):
     
-    def dump_cookie(self, key, value='', max_age=None, **kwargs):
+    @property
+    def cookie_encryption_key(self):
         if self.config.private_key:
-            encryption_key = hashlib.md5(self.config.private_key).digest()
-        else:
+            return hashlib.md5(self.config.private_key).digest()
+        return '0123456789abcdef'
+    
+    def dump_cookie(self, key, value='', max_age=None, **kwargs):
+        if not self.config.private_key:
             log.warning('using default encryption key')
-            encryption_key = '0123456789abcdef'
-        value = sign.dumps(encryption_key, value, max_age=max_age, depends_on=dict(name=key))
+        value = sign.dumps(self.cookie_encryption_key, value, max_age=max_age, depends_on=dict(name=key))
         return dump_cookie(key, value, max_age=max_age, **kwargs)
+    
+    def load_cookies(self, header):
+        """Parse a Cookie header, keeping only the values that verify."""
+        encryption_key = self.cookie_encryption_key
+        ret = {}
+        for key, raw_value in parse_cookies(header).iteritems():
+            try:
+                ret[key] = sign.loads(encryption_key, raw_value, depends_on=dict(name=key), strict=True)
+            except ValueError:
+                pass
+        return ret
         
     RequestMixin = _RequestMixin
     ResponseMixin = _ResponseMixin
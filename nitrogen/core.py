@@ -1,3 +1,4 @@
 # For B/C.
-from .app import App
+from .app import get_app_class
+App = get_app_class()
 
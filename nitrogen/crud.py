@@ -4,6 +4,7 @@ import logging
 import re
 import collections
 import datetime
+import functools
 import json
 
 from multimap import MultiMap
@@ -12,12 +13,18 @@ import werkzeug as wz
 
 from nitrogen import status
 
-from .request import Request, Response
+from .request import Request, Response, JSONResponse
 from . import mixin
 
 log = logging.getLogger(__name__)
 
 
+def _json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
 class CRUD(object):
     
     model_class = None
@@ -38,6 +45,12 @@ class CRUD(object):
     allow_commit = True
     allow_restore = True
     
+    # api_list dumps every object (streamed) when allowed.
+    allow_list = False
+    list_batch_size = 500
+    
+    json_encoder = staticmethod(functools.partial(json.dumps, default=_json_default))
+    
     def __init__(self, Session, **kwargs):
         
         self.Session = Session
@@ -93,7 +106,9 @@ class CRUD(object):
         if not handler:
             raise status.BadRequest('bad method %r' % method)
         res = handler(request)
-        return Response(json.dumps(res))
+        if isinstance(res, Response):
+            return res
+        return JSONResponse(res, encoder=self.json_encoder)
         
     def versions_for(self, obj):
         """Return a list of (version, comment) tuples.
@@ -207,6 +222,19 @@ class CRUD(object):
         
         return response
     
+    def dump_model(self, obj):
+        """Return the JSON-able form of an object, for api_list."""
+        if hasattr(obj, 'todict'):
+            return obj.todict()
+        return dict((col.name, getattr(obj, col.name)) for col in obj.__table__.columns)
+    
+    def api_list(self, request):
+        if not self.allow_list:
+            raise status.BadRequest('bad method %r' % 'list')
+        query = self.Session().query(self.model_class).yield_per(self.list_batch_size)
+        # A generator, so the response is streamed.
+        return (self.dump_model(obj) for obj in query)
+    
     def api_preview(self, request):
         return self.api_save(request, commit=False)
 
@@ -0,0 +1,78 @@
+"""ETags which are computed as the body is produced, and cached by version.
+
+A controller which can cheaply describe everything its response depends on
+(e.g. a model's updated time and the template's mtime) passes that "version
+key" to `Request.check_version` before doing any real work. Once we have seen
+a response for that key we remember its ETag, and can answer a conditional
+request with a 304 without rendering anything.
+
+"""
+
+import hashlib
+
+from werkzeug.http import quote_etag
+
+from . import status
+
+
+def hash_chunks(chunks, charset='utf-8'):
+    """MD5 a body (as werkzeug's generate_etag does) without joining it.
+
+        >>> hash_chunks(['hello ', u'world']) == hashlib.md5('hello world').hexdigest()
+        True
+
+    """
+    hash = hashlib.md5()
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode(charset)
+        hash.update(chunk)
+    return hash.hexdigest()
+
+
+class HashingIterator(object):
+
+    """Wraps an app iterator to hash the chunks as they pass through.
+
+    The callback is called with the ETag only if the iterator is exhausted;
+    a partial body is never reported.
+
+    """
+
+    def __init__(self, app_iter, callback, charset='utf-8'):
+        self.app_iter = app_iter
+        self._next = iter(app_iter).next
+        self.callback = callback
+        self.charset = charset
+        self.hash = hashlib.md5()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            chunk = self._next()
+        except StopIteration:
+            if self.hash is not None:
+                self.callback(self.hash.hexdigest())
+                self.hash = None
+            raise
+        self.hash.update(chunk.encode(self.charset) if isinstance(chunk, unicode) else chunk)
+        return chunk
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+class NotModified(status.NotModified):
+
+    """A 304 which carries the ETag that the client matched."""
+
+    def __init__(self, etag):
+        super(NotModified, self).__init__()
+        self.etag = etag
+
+    def get_headers(self, environ):
+        return [('ETag', quote_etag(self.etag))]
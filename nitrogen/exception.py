@@ -14,9 +14,9 @@ except ImportError:
         pass
 
 from werkzeug.datastructures import Headers
-from mako.exceptions import RichTraceback as MakoTraceback, TopLevelLookupException as MakoLookupError
 
 from . import status
+from .pipeline import PassthroughIterator, is_sequence, is_file_wrapper
 
 
 log = logging.getLogger(__name__)
@@ -130,6 +130,18 @@ def format_report(environ, html=False):
     return ''.join(format_report_iter(environ, html))
 
 
+def _get_mako_exceptions():
+    # Mako is only used by the view subsystem, which may not be enabled. If
+    # nothing has imported it then there are no templates to worry about.
+    if 'mako' not in sys.modules:
+        return None
+    try:
+        import mako.exceptions
+    except ImportError:
+        return None
+    return mako.exceptions
+
+
 def get_cleaned_traceback():
     """Returns a traceback cleaned of mako jibberish.
     
@@ -138,10 +150,14 @@ def get_cleaned_traceback():
     """
     
     type, value, tb = sys.exc_info()
-    try:
-        raw = list(MakoTraceback().traceback)
-    except:
-        log.exception('Error while Mako was cleaning traceback')
+    raw = None
+    mako_exceptions = _get_mako_exceptions()
+    if mako_exceptions is not None:
+        try:
+            raw = list(mako_exceptions.RichTraceback().traceback)
+        except:
+            log.exception('Error while Mako was cleaning traceback')
+    if raw is None:
         raw = traceback.extract_tb(tb)
     cleaned = []
     for filename, lineno, function, line in raw:
@@ -158,19 +174,54 @@ def exception_logger(app, level=logging.ERROR, ignore=None):
     """
     
     ignore = ignore or ()
+    
+    def _log(environ, e):
+        report = format_report(environ).strip()
+        log.log(level, 'Unexpected %r\n' % e + report)
+    
     def _exception_logger(environ, start):
         try:
-            for x in app(environ, start):
-                yield x
+            app_iter = app(environ, start)
         except ignore:
             raise
         except Exception as e:
-            report = format_report(environ).strip()
-            log.log(level, 'Unexpected %r\n' % e + report)
+            _log(environ, e)
             raise
+        if is_sequence(app_iter) or is_file_wrapper(app_iter):
+            return app_iter
+        return _LoggingIterator(app_iter, environ, ignore, _log)
     
     return _exception_logger
 
+
+class _LoggingIterator(object):
+    
+    def __init__(self, app_iter, environ, ignore, log_func):
+        self.app_iter = app_iter
+        self._next = iter(app_iter).next
+        self.environ = environ
+        self.ignore = ignore
+        self.log_func = log_func
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        try:
+            return self._next()
+        except StopIteration:
+            raise
+        except self.ignore:
+            raise
+        except Exception as e:
+            self.log_func(self.environ, e)
+            raise
+    
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
 error_logger = exception_logger
 logger = exception_logger
 
@@ -178,14 +229,24 @@ logger = exception_logger
 
 
 def exception_handler(app, render=None, debug=False):
+    
     def _exception_handler(environ, start):
         
+        # Exceptions raised while calling the app, or while pulling the first
+        # chunk (which is where generators will call start), are turned into
+        # error pages. After that the headers have gone out and there is
+        # nothing left for us to do.
         try:
-            app_iter = iter(app(environ, start))
+            app_iter = app(environ, start)
+            # Reading from a file is not going to raise anything we can
+            # render, and the server must see its own file wrapper.
+            if is_sequence(app_iter) or is_file_wrapper(app_iter):
+                return app_iter
+            iterator = iter(app_iter)
             try:
-                yield next(app_iter)
+                first = next(iterator)
             except StopIteration:
-                pass
+                return PassthroughIterator(app_iter)
         except status.HTTPException as e:
             e.original = None
         except PasteException as original:
@@ -196,61 +257,68 @@ def exception_handler(app, render=None, debug=False):
             e = status.InternalServerError()
             e.original = original
         else:
-            for x in app_iter:
-                yield x
-            return
-        
-        if isinstance(e, status.HTTPRedirection):
-            log.info('caught %d %s; redirects to %r' % (e.code, e.title, e.location))
-            for x in e(environ, start):
-                yield x
-            return
+            return PassthroughIterator.prefetched(first, iterator, app_iter)
         
-        log.info('caught %d %s: %r' % (e.code, e.title, e.description))
-        
-        try:
-            text_report = format_report(environ, False) if debug else None
-            html_report = format_report(environ, True) if debug else None
-        except:
-            text_report = html_report = None
-            log.exception('Exception while formating error report.')
-        
-        if render:
-            output = None
-            for template in ('/status/%d.html' % e.code, '/status/generic.html'):
-                try:
-                    output = render(template, exception=e,
-                        environ=environ,
-                        text_report=text_report,
-                        html_report=html_report,
-                    ).encode('utf8')
-                except MakoLookupError:
-                    continue
-                except:
-                    log.exception('Exception while building error page.')
-                break
-            if output:
-                try:
-                    start('%d %s' % (e.code, e.title), [('Content-Type', 'text/html; charset=utf-8')])
-                except:
-                    pass
-                yield output
-                return
-            
-        for x in e(environ, start):
-            yield x
-            
-        # Need to break these out like this incase there was an issue while
-        # building them.
-        if html_report:    
-            yield html_report
-        if text_report:
-            yield '<!-- This is the same error report but in plaintext.\n\n'
-            yield text_report
-            yield '\n-->'
-
+        return _render_exception(e, environ, start, render, debug)
+    
     return _exception_handler
 
+
+def _render_exception(e, environ, start, render, debug):
+    
+    if isinstance(e, status.HTTPRedirection):
+        log.info('caught %d %s; redirects to %r' % (e.code, e.title, e.location))
+        return e(environ, start)
+    
+    # Not errors (e.g. 304), so there is no page to render.
+    if e.code < 400:
+        return e(environ, start)
+    
+    log.info('caught %d %s: %r' % (e.code, e.title, e.description))
+    
+    try:
+        text_report = format_report(environ, False) if debug else None
+        html_report = format_report(environ, True) if debug else None
+    except:
+        text_report = html_report = None
+        log.exception('Exception while formating error report.')
+    
+    if render:
+        mako_exceptions = _get_mako_exceptions()
+        lookup_error = mako_exceptions.TopLevelLookupException if mako_exceptions else ()
+        output = None
+        for template in ('/status/%d.html' % e.code, '/status/generic.html'):
+            try:
+                output = render(template, exception=e,
+                    environ=environ,
+                    text_report=text_report,
+                    html_report=html_report,
+                ).encode('utf8')
+            except lookup_error:
+                continue
+            except:
+                log.exception('Exception while building error page.')
+            break
+        if output:
+            try:
+                start('%d %s' % (e.code, e.title), [('Content-Type', 'text/html; charset=utf-8')])
+            except:
+                pass
+            return [output]
+    
+    output = list(e(environ, start))
+        
+    # Need to break these out like this incase there was an issue while
+    # building them.
+    if html_report:    
+        output.append(html_report)
+    if text_report:
+        output.append('<!-- This is the same error report but in plaintext.\n\n')
+        output.append(text_report)
+        output.append('\n-->')
+    
+    return output
+
 handler = exception_handler
 
 
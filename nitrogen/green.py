@@ -0,0 +1,226 @@
+"""Cooperative (gevent) front end for nitrogen apps.
+
+This lets a single process hold open many slow connections (event streams,
+websockets) without dedicating a worker to each of them. The event loop is
+gevent's hub; normal (blocking) controllers are run on a bounded pool of real
+threads, and only controllers marked as `cooperative` are run directly on the
+loop.
+
+The whole app (middleware stack, events, and resetting of request locals) is
+run for each request exactly as under any other WSGI server; the front end
+only decides where it runs.
+
+Usage:
+
+    from nitrogen import green
+
+    @app.route('/events')
+    @green.cooperative
+    def do_events(request):
+        ...
+
+    green.serve(app, ('0.0.0.0', 8000), threads=16)
+
+Cooperative controllers must only block in ways that yield to the hub (e.g.
+`gevent.sleep`, or anything after `gevent.monkey.patch_all()`).
+
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import sys
+
+import gevent
+import gevent.event
+import gevent.monkey
+import gevent.pywsgi
+import gevent.threadpool
+
+from webstar.core import normalize_path
+
+
+log = logging.getLogger(__name__)
+
+# Real locks, even if the thread module has been patched.
+_allocate_lock = gevent.monkey.get_original('thread', 'allocate_lock')
+
+
+def cooperative(func):
+    """Mark a controller as safe to run directly on the event loop."""
+    func.__dict__['__nitrogen_cooperative__'] = True
+    return func
+
+
+def is_cooperative(app):
+    return bool(getattr(app, '__nitrogen_cooperative__', False))
+
+
+def is_websocket(environ):
+    return (
+        environ.get('HTTP_UPGRADE', '').strip().lower() == 'websocket' and
+        'upgrade' in environ.get('HTTP_CONNECTION', '').lower()
+    )
+
+
+class _Channel(object):
+
+    """Hands the body of a response from a pool thread to the hub.
+
+    The thread `put`s chunks and the hub iterates over them. Only one chunk
+    is held at a time, so the thread waits for the client to take each one
+    before producing the next and large bodies are never buffered. Closing
+    the channel makes the next `put` fail, so the thread stops.
+
+    """
+
+    _done = object()
+
+    def __init__(self, hub=None):
+        hub = hub or gevent.get_hub()
+        self._items = collections.deque()
+        self._mutex = _allocate_lock()
+        # Held while a chunk is waiting to be taken.
+        self._space = _allocate_lock()
+        self._ready = gevent.event.Event()
+        self._watcher = hub.loop.async_()
+        self._watcher.start(self._ready.set)
+        self.closed = False
+
+    def put(self, item):
+        """Called from the thread; returns False if the channel is closed."""
+        self._space.acquire()
+        with self._mutex:
+            if self.closed:
+                self._space.release()
+                return False
+            self._items.append(item)
+        self._watcher.send()
+        return True
+
+    def finish(self, exc_info=None):
+        self.put((self._done, exc_info))
+
+    def _get(self):
+        while True:
+            self._ready.clear()
+            with self._mutex:
+                if self._items:
+                    item = self._items.popleft()
+                    self._space.release()
+                    return item
+            self._ready.wait()
+
+    def __iter__(self):
+        while True:
+            item = self._get()
+            if isinstance(item, tuple) and item[0] is self._done:
+                exc_info = item[1]
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return
+            yield item
+
+    def close(self):
+        with self._mutex:
+            if self.closed:
+                return
+            self.closed = True
+            if self._items:
+                self._items.clear()
+                self._space.release()
+        self._watcher.stop()
+        self._watcher.close()
+
+
+class Frontend(object):
+
+    """WSGI app which dispatches to a nitrogen app from the gevent hub.
+
+    Requests for cooperative controllers, and websocket upgrades (which need
+    the raw socket on the hub), are run in the request's greenlet. Everything
+    else is run on a thread pool of at most `threads` threads, with the body
+    streamed back to the hub a chunk at a time as the client takes it.
+
+    """
+
+    def __init__(self, app, threads=10):
+        self.app = app
+        self.pool = gevent.threadpool.ThreadPool(threads)
+
+    def _route_head(self, environ):
+        # Peek at where the request will be routed without touching the
+        # environ; the app will route it again for real.
+        route_cache = getattr(self.app, 'route_cache', None)
+        if route_cache is not None:
+            app = route_cache.peek(environ)
+            if app is not None:
+                return app
+        router = getattr(self.app, 'router', None)
+        if router is None:
+            return None
+        route = router.route(normalize_path(environ.get('PATH_INFO', '')))
+        return route.app if route else None
+
+    def is_cooperative(self, environ):
+        return is_websocket(environ) or is_cooperative(self._route_head(environ))
+
+    def __call__(self, environ, start):
+        if self.is_cooperative(environ):
+            return self.app(environ, start)
+        channel = _Channel()
+        self.pool.spawn(self._produce, environ, start, channel)
+        return channel
+
+    def _produce(self, environ, start, channel):
+        # The whole request runs on this one thread, so request locals work
+        # as they would anywhere else.
+        try:
+            app_iter = self.app(environ, start)
+            try:
+                for chunk in app_iter:
+                    if not channel.put(chunk):
+                        break
+            finally:
+                close = getattr(app_iter, 'close', None)
+                if close is not None:
+                    close()
+        except Exception:
+            channel.finish(sys.exc_info())
+        else:
+            channel.finish()
+
+
+class WSGIHandler(gevent.pywsgi.WSGIHandler):
+
+    """Handler which exposes the raw socket to the app.
+
+    The socket is at `environ['nitrogen.socket']`, which is where
+    `nitrogen.websocket` looks for it (along with `gunicorn.socket`).
+
+    """
+
+    def get_environ(self):
+        environ = super(WSGIHandler, self).get_environ()
+        environ['nitrogen.socket'] = self.socket
+        return environ
+
+    def start_response(self, status, headers, exc_info=None):
+        write = super(WSGIHandler, self).start_response(status, headers, exc_info)
+        # Websocket apps take over the socket as soon as they have responded,
+        # so the handshake must go out now.
+        if self.code == 101 and not self.headers_sent:
+            self._write_with_headers(b'')
+        return write
+
+
+def make_server(app, listener=('0.0.0.0', 8000), threads=10, **kwargs):
+    kwargs.setdefault('handler_class', WSGIHandler)
+    return gevent.pywsgi.WSGIServer(listener, Frontend(app, threads), **kwargs)
+
+
+def serve(app, listener=('0.0.0.0', 8000), threads=10, **kwargs):
+    server = make_server(app, listener, threads, **kwargs)
+    log.info('serving on %s:%s with %d threads' % (server.address[0], server.address[1], threads))
+    server.serve_forever()
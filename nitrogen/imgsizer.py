@@ -11,6 +11,7 @@ import hashlib
 import sys
 import base64
 import struct
+import threading
 from urlparse import urlparse
 from urllib2 import urlopen
 from subprocess import call
@@ -18,6 +19,7 @@ from subprocess import call
 from .request import Request, Response
 from . import status
 from . import sign
+from .singleflight import SingleFlight
 
 log = logging.getLogger(__name__)
 
@@ -39,6 +41,8 @@ class ImgSizer(object):
         self.cache_root = cache_root
         self.sig_key = sig_key
         self.max_age = max_age
+        # Identical concurrent requests download or resize only once.
+        self.flights = SingleFlight(timeout=30)
     
     def build_url(self, local_path, **kwargs):
         for key in 'background mode width height quality format padding'.split():
@@ -117,6 +121,31 @@ class ImgSizer(object):
         
         return img
     
+    def _download(self, url, path):
+        if os.path.exists(path):
+            return
+        log.info('downloading %s' % url)
+        tmp_path = path + '.tmp-' + str(os.getpid())
+        fh = open(tmp_path, 'wb')
+        fh.write(urlopen(url).read())
+        fh.close()
+        call(['mv', tmp_path, path])
+    
+    def _resize_to_cache(self, path, cache_path, format, quality, **kwargs):
+        
+        img = image.open(path)
+        img = self.resize(img, **kwargs)
+        
+        # Write to the side so nobody can send a partial file.
+        tmp_path = '%s.tmp-%d-%d' % (cache_path, os.getpid(), threading.current_thread().ident)
+        try:
+            cache_file = open(tmp_path, 'wb')
+            img.save(cache_file, format, quality=quality)
+            cache_file.close()
+            os.rename(tmp_path, cache_path)
+        except Exception as e:
+            log.exception('error while saving image to cache')
+    
     @Request.application
     def __call__(self, request):
 
@@ -138,12 +167,7 @@ class ImgSizer(object):
                 hashlib.md5(remote_url).hexdigest() + os.path.splitext(remote_url)[1]
             )
             if not os.path.exists(path):
-                log.info('downloading %s' % remote_url)
-                tmp_path = path + '.tmp-' + str(os.getpid())
-                fh = open(tmp_path, 'wb')
-                fh.write(urlopen(remote_url).read())
-                fh.close()
-                call(['mv', tmp_path, path])
+                self.flights.do(path, lambda: self._download(remote_url, path))
         else:
             path = self.find_img(path)
             if not path:
@@ -176,18 +200,11 @@ class ImgSizer(object):
         cache_mtime = os.path.getmtime(cache_path) if os.path.exists(cache_path) else None
         
         if not cache_mtime or cache_mtime < raw_mtime:
-            
             log.info('resizing %r for %s' % (request.path_info, request.query))
-            
-            img = image.open(path)
-            img = self.resize(img, width=width, height=height, mode=mode, background=background)
-            
-            try:
-                cache_file = open(cache_path, 'wb')
-                img.save(cache_file, format, quality=quality)
-                cache_file.close()
-            except Exception as e:
-                log.exception('error while saving image to cache')
+            self.flights.do(cache_path, lambda: self._resize_to_cache(path, cache_path,
+                width=width, height=height, mode=mode, background=background,
+                format=format, quality=quality,
+            ))
         
         return Response().send_file(cache_path,
             mimetype='image/%s' % format,
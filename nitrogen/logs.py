@@ -16,6 +16,7 @@ import threading
 import multiprocessing
 import time
 
+from . import context
 from .request import Request
 
 
@@ -30,7 +31,9 @@ class ThreadLocalFormatter(logging.Formatter):
     def __init__(self, *args, **kwargs):
         logging.Formatter.__init__(self, *args, **kwargs)
         
-        self._local = threading.local()
+        # Stored in the request context so it is reset for every request, and
+        # does not bleed between greenlets.
+        self._local = context.request_context.local()
         self._lock = self._build_lock()
         
         self.request_count = 0
@@ -187,7 +190,7 @@ class LoggingAppMixin(object):
         self._local.status_code = None
         self._local.start_time = time.time()
         if self.referrer_log:
-            request = self.Request(environ)
+            request = self.Request.from_environ(environ)
             if request.referrer:
                 self.referrer_log.info(request.referrer)
     
@@ -199,7 +202,7 @@ class LoggingAppMixin(object):
             params = environ.copy()
             params['STATUS_CODE'] = self._local.status_code
             params['DURATION_MS'] = 1000 * (time.time() - self._local.start_time)
-            params['PATH'] = Request(environ).full_path
+            params['PATH'] = Request.from_environ(environ).full_path
             meta = self._local.__dict__.get('access_log_meta', {})
             message = self.config.access_log_format % params
             if meta:
@@ -0,0 +1,96 @@
+"""A small thread-safe LRU mapping with hit/miss counters."""
+
+import collections
+import threading
+
+
+class LRUCache(object):
+
+    """Bounded mapping which evicts the least recently used keys.
+
+        >>> cache = LRUCache(2)
+        >>> cache['a'] = 1
+        >>> cache['b'] = 2
+        >>> cache.get('a')
+        1
+        >>> cache['c'] = 3
+        >>> 'b' in cache, 'a' in cache
+        (False, True)
+        >>> cache.get('b', 'missing')
+        'missing'
+        >>> cache.hits, cache.misses
+        (1, 1)
+
+    With `maxbytes`, values are also weighed (by `len` unless given a `weigh`
+    function) and evicted to keep the total weight under budget:
+
+        >>> cache = LRUCache(maxsize=100, maxbytes=10)
+        >>> cache['a'] = 'x' * 6
+        >>> cache['b'] = 'y' * 6
+        >>> 'a' in cache, cache.bytes
+        (False, 6)
+
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, weigh=len):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.weigh = weigh
+        self.bytes = 0
+        self._data = collections.OrderedDict()
+        self._weights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._pop(key, None)
+            self._data[key] = value
+            if self.maxbytes is not None:
+                self._weights[key] = weight = self.weigh(value)
+                self.bytes += weight
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+                self._pop(next(iter(self._data)), None)
+
+    def _pop(self, key, default):
+        self.bytes -= self._weights.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._pop(key, default)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self.bytes = 0
+
+    @property
+    def stats(self):
+        return dict(
+            size=len(self._data),
+            maxsize=self.maxsize,
+            bytes=self.bytes,
+            maxbytes=self.maxbytes,
+            hits=self.hits,
+            misses=self.misses,
+        )
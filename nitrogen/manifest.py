@@ -0,0 +1,100 @@
+"""Content-hash fingerprinted static URLs, and a manifest of them.
+
+A fingerprinted URL has (a prefix of) the MD5 of the file's contents before
+its extension, e.g. `css/site.css` becomes `css/site.0cc175b9.css`. Since the
+URL changes exactly when the contents do, it can be cached forever.
+
+The manifest maps every logical path under the static directories to its
+fingerprinted path, so that templates can build URLs with a dictionary lookup
+and the server never needs to hash (or stat) anything. Build one at deploy
+time with:
+
+    python -m nitrogen.manifest -o static-manifest.json static/ ...
+
+and point the `static_manifest` config at it.
+
+"""
+
+import json
+import os
+import re
+import sys
+
+
+HASH_LENGTH = 8
+
+_fingerprinted_re = re.compile(r'^(.+)\.([0-9a-f]{%d})((?:\.[^./]+)?)$' % HASH_LENGTH)
+
+
+def fingerprint(path, hash):
+    """Put a hash into a path, before the extension.
+
+        >>> fingerprint('css/site.css', '0cc175b9c0f1b6a831c399e269772661')
+        'css/site.0cc175b9.css'
+        >>> fingerprint('LICENSE', '0cc175b9c0f1b6a831c399e269772661')
+        'LICENSE.0cc175b9'
+
+    """
+    dir_, name = os.path.split(path)
+    base, ext = os.path.splitext(name)
+    if not base:
+        # A dotfile.
+        base, ext = ext, ''
+    return os.path.join(dir_, '%s.%s%s' % (base, hash[:HASH_LENGTH], ext))
+
+
+def parse_fingerprint(path):
+    """Split a fingerprinted path into the logical path and hash, or None.
+
+        >>> parse_fingerprint('js/jquery.min.0cc175b9.js')
+        ('js/jquery.min.js', '0cc175b9')
+        >>> parse_fingerprint('js/jquery.min.js') is None
+        True
+
+    """
+    m = _fingerprinted_re.match(path)
+    if m:
+        return m.group(1) + m.group(3), m.group(2)
+
+
+def build_manifest(bases):
+    """Map every file under the given directories to its fingerprinted path."""
+    from .static import StaticIndex
+    index = StaticIndex(bases, 'frozen')
+    index.scan()
+    return dict((path, fingerprint(path, file.hash)) for path, file in index.files.iteritems())
+
+
+def load_manifest(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def write_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+        fh.write('\n')
+    os.rename(tmp_path, path)
+
+
+def main(argv=None):
+
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] static_dir [...]')
+    parser.add_option('-o', '--output', help='where to write the manifest [stdout]')
+    opts, args = parser.parse_args(argv)
+
+    if not args:
+        parser.error('at least one static directory is required')
+    manifest = build_manifest([os.path.abspath(x) for x in args])
+    if opts.output:
+        write_manifest(opts.output, manifest)
+        print >> sys.stderr, 'wrote %d files to %s' % (len(manifest), opts.output)
+    else:
+        json.dump(manifest, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
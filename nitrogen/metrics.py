@@ -0,0 +1,252 @@
+"""In-process request timing metrics.
+
+Each request is broken down into phases (routing, each middleware layer, the
+controller, template rendering, and body iteration) and the time spent in
+each is folded into a histogram keyed by the route that handled it.
+
+The registry is itself a WSGI app which serves the histograms as plain text,
+in the same format that Prometheus scrapes.
+
+"""
+
+import bisect
+import threading
+import time
+
+from webstar.core import HISTORY_ENVIRON_KEY
+
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram(object):
+
+    """Bucketed histogram of durations (in seconds).
+
+        >>> h = Histogram(buckets=(1, 2, 4))
+        >>> for x in 0.5, 1.5, 1.5, 3, 10:
+        ...     h.observe(x)
+        >>> h.count, h.sum, h.min, h.max
+        (5, 16.5, 0.5, 10)
+        >>> h.counts
+        [1, 2, 1, 1]
+        >>> h.quantile(0.5)
+        2
+        >>> h.quantile(0.99)
+        10
+
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or DEFAULT_BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.buckets != self.buckets:
+            raise ValueError('cannot merge histograms with different buckets')
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        for value in other.min, other.max:
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in.
+
+        Values past the last bucket are reported as the maximum.
+
+        """
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+
+def route_name(environ):
+    """Get a stable (and bounded) name for whatever the request routed to."""
+    route = environ.get(HISTORY_ENVIRON_KEY)
+    if not route:
+        return '-'
+    app = route.app
+    name = getattr(app, '__name__', None)
+    if name is None:
+        app = type(app)
+        name = app.__name__
+    return '%s:%s' % (getattr(app, '__module__', None) or '?', name)
+
+
+class Registry(object):
+
+    """Thread-safe collection of histograms keyed by (route, phase)."""
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, phase, value):
+        key = (route, phase)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def observe_many(self, route, phases):
+        for phase, value in phases.iteritems():
+            self.observe(route, phase, value)
+
+    def get(self, route, phase):
+        return self._histograms.get((route, phase))
+
+    def items(self):
+        with self._lock:
+            return sorted(self._histograms.items())
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def iter_text(self, prefix='nitrogen_phase_seconds'):
+        for (route, phase), h in self.items():
+            labels = 'route="%s",phase="%s"' % (_escape(route), _escape(phase))
+            cumulative = 0
+            for bound, count in zip(h.buckets + ('+Inf', ), h.counts):
+                cumulative += count
+                yield '%s_bucket{%s,le="%s"} %d\n' % (prefix, labels, bound, cumulative)
+            yield '%s_sum{%s} %f\n' % (prefix, labels, h.sum)
+            yield '%s_count{%s} %d\n' % (prefix, labels, h.count)
+
+    def __call__(self, environ, start):
+        body = ''.join(self.iter_text())
+        start('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-cache'),
+        ])
+        return [body]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PhaseTimer(object):
+
+    """Context manager which adds the time spent within it to a dict.
+
+    Nested timers for the same phase (e.g. a template rendering another
+    template) are only counted once.
+
+    """
+
+    __slots__ = ('phases', 'active', 'name', 'start')
+
+    def __init__(self, phases, active, name):
+        self.phases = phases
+        self.active = active
+        self.name = name
+
+    def __enter__(self):
+        if self.name in self.active:
+            self.start = None
+        else:
+            self.active.add(self.name)
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            self.active.discard(self.name)
+            elapsed = time.time() - self.start
+            self.phases[self.name] = self.phases.get(self.name, 0) + elapsed
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+null_timer = _NullTimer()
+
+
+def timed_middleware(app, name, local):
+    """Wrap a middleware layer so that its own (exclusive) time is recorded.
+
+    Time spent inside of inner layers is subtracted out by tracking the total
+    time spent by all children in `local.child_time`.
+
+    """
+    phase = 'middleware.' + name if name else None
+    def _timed_middleware(environ, start):
+        phases = getattr(local, 'phases', None)
+        if phases is None:
+            return app(environ, start)
+        outer_child_time = local.child_time
+        local.child_time = 0
+        start_time = time.time()
+        try:
+            return app(environ, start)
+        finally:
+            elapsed = time.time() - start_time
+            if phase:
+                phases[phase] = phases.get(phase, 0) + elapsed - local.child_time
+            local.child_time = outer_child_time + elapsed
+    return _timed_middleware
+
+
+class TimedIterator(object):
+
+    """Wraps an app iterator to record the time spent pulling chunks."""
+
+    def __init__(self, app_iter, phases, name='body'):
+        self.app_iter = app_iter
+        self._next = iter(app_iter).next
+        self.phases = phases
+        self.name = name
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start_time = time.time()
+        try:
+            return self._next()
+        finally:
+            self.phases[self.name] = self.phases.get(self.name, 0) + time.time() - start_time
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
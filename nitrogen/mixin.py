@@ -22,8 +22,20 @@ def build_from_mro(carrier_class, base_class, name=None):
     return cls
 
 
+class _BuilderProperty(wz.utils.cached_property):
+    pass
+
+
 def builder_property(base):
     def _build_class(self):
         return build_from_mro(self.__class__, base)
-    return wz.utils.cached_property(_build_class, name=base.__name__)
+    return _BuilderProperty(_build_class, name=base.__name__)
+
+
+def build_all(obj):
+    """Build every class on the given object from a `builder_property`."""
+    for cls in obj.__class__.__mro__:
+        for name, value in vars(cls).items():
+            if isinstance(value, _BuilderProperty):
+                getattr(obj, name)
     
\ No newline at end of file
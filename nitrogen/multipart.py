@@ -0,0 +1,173 @@
+"""Streaming parser for multipart/form-data bodies.
+
+Unlike werkzeug's form parser (which must store every file somewhere before
+the request can see it) this hands back each part as it arrives, with its
+body as an iterator of chunks. Memory use is bounded by the chunk size no
+matter how large the upload is.
+
+Parts must be consumed in order; moving on to the next part skips whatever is
+left of the current one.
+
+    >>> body = StringIO(
+    ...     '--XX\\r\\n'
+    ...     'Content-Disposition: form-data; name="title"\\r\\n'
+    ...     '\\r\\n'
+    ...     'Hello\\r\\n'
+    ...     '--XX\\r\\n'
+    ...     'Content-Disposition: form-data; name="file"; filename="a.txt"\\r\\n'
+    ...     'Content-Type: text/plain\\r\\n'
+    ...     '\\r\\n'
+    ...     'file contents\\r\\n'
+    ...     '--XX--\\r\\n'
+    ... )
+    >>> for part in iter_parts(body, 'XX', chunk_size=4):
+    ...     print part.name, part.filename, part.content_type, repr(part.read())
+    title None None 'Hello'
+    file a.txt text/plain 'file contents'
+
+"""
+
+from cStringIO import StringIO
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_options_header
+
+from . import status
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class Part(object):
+
+    """A single part of a multipart body.
+
+    Iterating over the part yields chunks of its body (once only).
+
+    """
+
+    def __init__(self, headers, chunks):
+        self.headers = headers
+        self.disposition, options = parse_options_header(headers.get('Content-Disposition', ''))
+        self.name = options.get('name')
+        self.filename = options.get('filename')
+        self.content_type = headers.get('Content-Type')
+        self._chunks = chunks
+
+    def __repr__(self):
+        return '<%s name=%r filename=%r>' % (self.__class__.__name__, self.name, self.filename)
+
+    @property
+    def is_file(self):
+        return self.filename is not None
+
+    def __iter__(self):
+        return self._chunks
+
+    def read(self):
+        """Read the rest of the part into a string; only for small parts."""
+        return ''.join(self._chunks)
+
+    def save(self, dst):
+        """Write the rest of the part to a path or file; returns the size."""
+        if isinstance(dst, basestring):
+            with open(dst, 'wb') as fh:
+                return self.save(fh)
+        size = 0
+        for chunk in self._chunks:
+            dst.write(chunk)
+            size += len(chunk)
+        return size
+
+    def drain(self):
+        for chunk in self._chunks:
+            pass
+
+
+class _Reader(object):
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+
+    def fill(self):
+        data = self.stream.read(self.chunk_size)
+        if not data:
+            return False
+        self.buffer += data
+        return True
+
+
+def _parse_headers(block):
+    headers = Headers()
+    # The first line is the remainder of the boundary line.
+    for line in block.split('\r\n')[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise status.BadRequest('malformed multipart header')
+        headers.add(name.strip(), value.strip())
+    return headers
+
+
+def _iter_body(reader, delimiter):
+    # Always hold back enough of the buffer that a delimiter split across
+    # reads will still be found.
+    keep = len(delimiter) - 1
+    while True:
+        i = reader.buffer.find(delimiter)
+        if i >= 0:
+            if i:
+                yield reader.buffer[:i]
+            reader.buffer = reader.buffer[i + len(delimiter):]
+            return
+        if len(reader.buffer) > keep:
+            chunk = reader.buffer[:-keep]
+            reader.buffer = reader.buffer[-keep:]
+            yield chunk
+        if not reader.fill():
+            raise status.BadRequest('unexpected end of multipart body')
+
+
+def iter_parts(stream, boundary, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield `Part`s from a multipart stream as they arrive."""
+
+    reader = _Reader(stream, chunk_size)
+    delimiter = '--' + boundary
+
+    # Skip the preamble.
+    while True:
+        i = reader.buffer.find(delimiter)
+        if i >= 0:
+            reader.buffer = reader.buffer[i + len(delimiter):]
+            break
+        reader.buffer = reader.buffer[-(len(delimiter) - 1):]
+        if not reader.fill():
+            raise status.BadRequest('multipart boundary not found')
+
+    delimiter = '\r\n' + delimiter
+    while True:
+
+        # A delimiter followed by "--" is the end; we ignore the epilogue.
+        while len(reader.buffer) < 2 and reader.fill():
+            pass
+        if reader.buffer.startswith('--'):
+            return
+
+        while True:
+            i = reader.buffer.find('\r\n\r\n')
+            if i >= 0:
+                break
+            if len(reader.buffer) > MAX_HEADER_SIZE:
+                raise status.BadRequest('multipart headers too large')
+            if not reader.fill():
+                raise status.BadRequest('unexpected end of multipart body')
+        headers = _parse_headers(reader.buffer[:i])
+        reader.buffer = reader.buffer[i + 4:]
+
+        part = Part(headers, _iter_body(reader, delimiter))
+        yield part
+        part.drain()
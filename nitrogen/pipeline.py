@@ -0,0 +1,148 @@
+"""Helpers for passing WSGI app iterators through middleware untouched.
+
+The middleware in this package used to be written as generators, which costs
+a generator frame per layer for every chunk of every response. These helpers
+let a layer hang cleanup off of `close()` instead, while the server iterates
+the underlying iterator directly.
+
+"""
+
+import itertools
+
+
+def is_sequence(app_iter):
+    """Is this app iterator already fully materialized?"""
+    return isinstance(app_iter, (list, tuple))
+
+
+def is_file_wrapper(app_iter):
+    """Is this app iterator from a server's `wsgi.file_wrapper`?
+
+    Servers recognize their own file wrappers and send the file without
+    iterating it (e.g. via sendfile), so middleware must not hide them.
+    Every wrapper we know of (wsgiref, gunicorn, mod_wsgi) exposes the file as
+    `filelike`.
+
+    """
+    return getattr(app_iter, 'filelike', None) is not None
+
+
+class _Cleanup(object):
+
+    """Closes an iterable and then runs callbacks, only the first time."""
+
+    __slots__ = ('close', 'callbacks', 'done')
+
+    def __init__(self, close, callbacks):
+        self.close = close
+        self.callbacks = callbacks
+        self.done = False
+
+    def __call__(self):
+        if self.done:
+            return
+        self.done = True
+        try:
+            if self.close is not None:
+                self.close()
+        finally:
+            for callback in self.callbacks:
+                callback()
+
+
+def _then(cleanup):
+    # An empty iterator which cleans up when it is reached.
+    cleanup()
+    return
+    yield
+
+
+class PassthroughIterator(object):
+
+    """An app iterator which hands out the wrapped iterator directly.
+
+    `iter()` on this object returns the underlying iterator, so the server
+    pulls chunks without going through any Python code of ours. The close
+    callbacks are run in order after closing the wrapped iterable, either by
+    `close()` or once the iterator is exhausted (for consumers which never
+    call `close()`), whichever is first.
+
+        >>> closed = []
+        >>> it = PassthroughIterator(['a', 'b'], lambda: closed.append(True))
+        >>> list(it)
+        ['a', 'b']
+        >>> closed
+        [True]
+        >>> it.close()
+        >>> closed
+        [True]
+
+    """
+
+    __slots__ = ('_iter', '_cleanup')
+
+    def __init__(self, iterable, *callbacks):
+        self._cleanup = _Cleanup(getattr(iterable, 'close', None), callbacks)
+        self._iter = itertools.chain(iter(iterable), _then(self._cleanup))
+
+    @classmethod
+    def prefetched(cls, first, iterator, iterable, *callbacks):
+        """Wrap an iterator that has already had its first chunk pulled.
+
+        `iterable` is the original object returned by the app, and is what
+        will have `close()` called upon it.
+
+        """
+        self = cls(itertools.chain((first, ), iterator), *callbacks)
+        self._cleanup.close = getattr(iterable, 'close', None)
+        return self
+
+    def __iter__(self):
+        return self._iter
+
+    # Some consumers (e.g. werkzeug.test.run_wsgi_app) call next() directly.
+    def next(self):
+        return self._iter.next()
+
+    def close(self):
+        self._cleanup()
+
+
+class _ClosingFile(object):
+
+    """A file proxy which runs callbacks after the file is closed."""
+
+    def __init__(self, file, callbacks):
+        self._file = file
+        self._callbacks = callbacks
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        try:
+            self._file.close()
+        finally:
+            for callback in self._callbacks:
+                callback()
+
+
+def passthrough(app_iter, environ, *callbacks):
+    """Hang close callbacks off an app iterator as `PassthroughIterator` does.
+
+    A server file wrapper is rewrapped (around a file which runs the callbacks
+    when closed) so that the server still recognizes it as its own.
+
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and is_file_wrapper(app_iter):
+        file = _ClosingFile(app_iter.filelike, callbacks)
+        block_size = getattr(app_iter, 'blksize', None)
+        return file_wrapper(file) if block_size is None else file_wrapper(file, block_size)
+    return PassthroughIterator(app_iter, *callbacks)
@@ -0,0 +1,107 @@
+"""Precompressed gzip sidecars for static files.
+
+For every compressible file under the static directories this writes a
+`.gz` beside it, compressed at the highest level (which is too slow to do per
+request). The StaticRouter serves the sidecar to clients which accept gzip,
+as long as it is at least as new as the original. Run it at deploy time:
+
+    python -m nitrogen.precompress static/ ...
+
+Sidecars are only rewritten when their original changes, and are not kept
+if they would not be smaller.
+
+"""
+
+import mimetypes
+import os
+import sys
+import tempfile
+
+from . import compress
+
+
+def is_compressible(path, types=compress.DEFAULT_MIMETYPES):
+    """Is the file at this path worth gzipping?
+
+        >>> is_compressible('css/site.css')
+        True
+        >>> is_compressible('img/logo.png')
+        False
+        >>> is_compressible('css/site.css.gz')
+        False
+
+    """
+    mimetype, encoding = mimetypes.guess_type(path)
+    return encoding is None and mimetype is not None and mimetype.startswith(tuple(types))
+
+
+def gzip_file(path, level=9, min_size=0, force=False):
+    """Write the sidecar for one file if it is missing or stale.
+
+    Returns True if a sidecar was written. A sidecar older than its original
+    is stale.
+
+    """
+
+    sidecar = path + '.gz'
+    stat = os.stat(path)
+    if stat.st_size < min_size:
+        return False
+    if not force:
+        try:
+            if os.path.getmtime(sidecar) >= stat.st_mtime:
+                return False
+        except OSError:
+            pass
+
+    compressor = compress.compressobj('gzip', level)
+    with open(path, 'rb') as fh:
+        data = compressor.compress(fh.read()) + compressor.flush()
+    if len(data) >= stat.st_size:
+        # Not worth it; don't leave an old sidecar around either.
+        if os.path.exists(sidecar):
+            os.unlink(sidecar)
+        return False
+
+    # Write then rename, so the server never sees a partial file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(data)
+    os.chmod(tmp_path, stat.st_mode & 0777)
+    os.rename(tmp_path, sidecar)
+    return True
+
+
+def precompress(bases, level=9, types=compress.DEFAULT_MIMETYPES, min_size=0, force=False):
+    """Write sidecars for every compressible file under the given directories.
+
+    Returns the number of sidecars written.
+
+    """
+    from .static import StaticIndex
+    index = StaticIndex(bases, 'frozen')
+    index.scan()
+    written = 0
+    for path, file in sorted(index.files.iteritems()):
+        if is_compressible(path, types) and gzip_file(file.path, level, min_size, force):
+            written += 1
+    return written
+
+
+def main(argv=None):
+
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] static_dir [...]')
+    parser.add_option('-l', '--level', type='int', default=9, help='gzip level [%default]')
+    parser.add_option('-m', '--min-size', type='int', default=0, help='skip files smaller than this many bytes')
+    parser.add_option('-f', '--force', action='store_true', help='rewrite sidecars which are up to date')
+    opts, args = parser.parse_args(argv)
+
+    if not args:
+        parser.error('at least one static directory is required')
+    written = precompress([os.path.abspath(x) for x in args], opts.level, min_size=opts.min_size, force=opts.force)
+    print >> sys.stderr, 'wrote %d sidecars' % written
+
+
+if __name__ == '__main__':
+    main()
@@ -6,15 +6,14 @@ routing, etc.
 
 """
 
-from cStringIO import StringIO
-import cStringIO as cstringio
+import collections
 import functools
 import hashlib
-import io
+import json
 import logging
 import mimetypes
 import os
-import StringIO as stringio
+import tempfile
 import time
 
 import werkzeug as wz
@@ -23,11 +22,18 @@ import werkzeug.wrappers
 import werkzeug.http
 import werkzeug.wsgi
 import werkzeug.datastructures
+import werkzeug.formparser
+import werkzeug.urls
 
 from webstar.core import Route, get_route_data
 
 from . import body
+from . import byteranges
 from . import cookies
+from . import etag as etags
+from . import multipart
+from . import status
+from .lru import LRUCache
 
 
 log = logging.getLogger(__name__)
@@ -46,6 +52,43 @@ class Request(wz.wrappers.Request):
     
     """
     
+    # The LiteRequest to use for application(lite=True); set on the Request
+    # class which each app builds for itself.
+    lite_class = None
+    
+    # Number of times that from_environ handed back an existing request
+    # instead of building a new one.
+    reuse_count = 0
+    
+    # Werkzeug caches these on the instance, but they change as the request
+    # is routed (which moves PATH_INFO onto SCRIPT_NAME).
+    _routing_cached_attrs = ('path', 'script_root', 'url', 'base_url', 'url_root')
+    
+    def __init__(self, environ, populate_request=True, shallow=False):
+        super(Request, self).__init__(environ, populate_request, shallow)
+        self._routing_state = (environ.get('SCRIPT_NAME'), environ.get('PATH_INFO'))
+    
+    @classmethod
+    def from_environ(cls, environ):
+        """Get the request for this environ, constructing it only if needed.
+        
+        Werkzeug stores every (non-shallow) request in the environ; we reuse
+        that instance (and everything it has already parsed) as long as it is
+        of the requested class. This lets the app, auth, logging, sessions and
+        the controller all share one request.
+        
+        """
+        request = environ.get('werkzeug.request')
+        if not isinstance(request, cls) or request.environ is not environ:
+            return cls(environ)
+        Request.reuse_count += 1
+        state = (environ.get('SCRIPT_NAME'), environ.get('PATH_INFO'))
+        if state != request._routing_state:
+            request._routing_state = state
+            for name in cls._routing_cached_attrs:
+                request.__dict__.pop(name, None)
+        return request
+    
     @classmethod
     def auto_application(cls, func=None, **kwargs):
         
@@ -74,34 +117,49 @@ class Request(wz.wrappers.Request):
         return func
     
     @classmethod
-    def application(cls, func=None, add_etag=None, conditional=True):
+    def application(cls, func=None, add_etag=None, conditional=True, lite=False):
         """Decorator to adapt WSGI to a request/response model.
         
         The function is passed a Request object, and must return a Response
         object.
         
         Params:
-            add_etags: Generate an etag? None implies adding an etag if one
-                does not already exist, and the response is not cached.
+            add_etag: Generate an etag? None implies adding an etag if one
+                does not already exist, and the response is a sequence (or
+                the ETag for its version key is already known). True will also
+                add them to streamed responses, which requires buffering them.
             conditional: Add a date header if not set, and return a 304 if
                 the response does not appear modified.
+            lite: Pass a `LiteRequest` (which is much cheaper to build, but
+                much more limited) instead. Only for an app's Request class
+                (i.e. `app.Request.application`), which can verify cookies.
+        
+        ETags are hashed chunk by chunk, and if the request was given a version
+        key (see `check_version`) the ETag is remembered against that key.
+        Streamed responses are hashed as they are sent so that the ETag is
+        known on the next request.
         
         """
         
         # Work as a decorator.
         if func is None:
             return functools.partial(cls.application,
-                add_etags=add_etags,
+                add_etag=add_etag,
                 conditional=conditional,
+                lite=lite,
             )
         
         add_etag = None if add_etag is None else bool(add_etag)
+        if lite and cls.lite_class is None:
+            raise ValueError('lite requests need an app; use app.Request.application(lite=True)')
+        make_request = cls.lite_class if lite else cls.from_environ
         
         @functools.wraps(func)
         def _wrapped(*args):
             environ = args[-2]
-            request = cls(environ)
-            request.response = Response()
+            request = make_request(environ)
+            if not lite:
+                request.response = Response()
             
             response = func(*(args[:-2] + (request, )))
             
@@ -115,8 +173,22 @@ class Request(wz.wrappers.Request):
                 response = Response(response)
             
             if response.status_code == 200:
-                if add_etag or add_etag is None and response.is_sequence:
-                    response.add_etag()
+                version = request._version_key
+                if 'etag' not in response.headers:
+                    if request._version_etag:
+                        response.set_etag(request._version_etag)
+                    elif response.is_sequence:
+                        if add_etag is not False:
+                            response.set_etag(etags.hash_chunks(response.response, response.charset))
+                    elif add_etag:
+                        response.add_etag()
+                    elif version is not None:
+                        response.response = etags.HashingIterator(response.response,
+                            functools.partial(cls.etag_cache.__setitem__, version),
+                            response.charset,
+                        )
+                if version is not None and 'etag' in response.headers:
+                    cls.etag_cache[version] = response.get_etag()[0]
                 if conditional and response.is_sequence:
                     response.make_conditional(environ)
             
@@ -125,6 +197,26 @@ class Request(wz.wrappers.Request):
         return _wrapped
         
         
+    # Maps version keys (see check_version) to the ETags of their responses.
+    etag_cache = LRUCache(4096)
+    
+    _version_key = _version_etag = None
+    
+    def check_version(self, *key):
+        """Answer with a 304 now if the client has this version of the page.
+        
+        The key should (cheaply) identify everything that the response depends
+        upon, e.g. a model's updated time and the template's mtime. If we have
+        served a response for this key (and URL) before and the client sent
+        its ETag, this raises a 304; otherwise the ETag of the response will be
+        remembered (by `Request.application`) for next time.
+        
+        """
+        self._version_key = (self.url, ) + key
+        self._version_etag = self.etag_cache.get(self._version_key)
+        if self._version_etag and self._version_etag in self.if_none_match:
+            raise etags.NotModified(self._version_etag)
+    
     # Set a default max request length. This applied to both form data, and
     # file uploads. See http://werkzeug.pocoo.org/docs/http/#werkzeug.formparser.parse_form_data
     # for more info.
@@ -135,6 +227,10 @@ class Request(wz.wrappers.Request):
     # See http://werkzeug.pocoo.org/docs/http/#werkzeug.formparser.parse_form_data
     # for more info.
     stream_factory = body.reject_factory
+    
+    # Bodies up to this size stay in memory when made seekable; larger ones
+    # are spooled to a temporary file.
+    spool_max_size = body.DEFAULT_SPOOL_SIZE
         
     def _get_file_stream(self, total_content_length, content_type, filename=None,
         content_length=None):
@@ -170,11 +266,58 @@ class Request(wz.wrappers.Request):
             return werkzeug.wsgi.LimitedStream(self.environ['wsgi.input'], content_length)
         return self.environ['wsgi.input']
     
-    def make_body_seekable(self):
-        stdin = self.environ['wsgi.input']
-        if not isinstance(stdin, (cstringio.InputType, io.StringIO, stringio.StringIO)):
-            self.body = self.environ['wsgi.input'] = StringIO(self.body.read())
-            self.body.seek(0)
+    def make_body_seekable(self, max_size=None, progress=None):
+        """Replace the body (and wsgi.input) with a seekable copy.
+        
+        The body is copied in chunks into a file which is held in memory up to
+        `max_size` bytes (defaulting to `spool_max_size`), and on disk past
+        that. The `progress` callback is called with the number of bytes read
+        so far and the content length as the body is copied.
+        
+        """
+        if not isinstance(self.environ['wsgi.input'], tempfile.SpooledTemporaryFile):
+            self.body = self.environ['wsgi.input'] = body.spool(self.body,
+                max_size=max_size or self.spool_max_size,
+                length=self.headers.get('content-length', type=int),
+                progress=progress,
+            )
+    
+    # Largest body that iter_multipart will accept; None for no limit. This is
+    # separate from max_content_length since it does not hold the body.
+    max_stream_length = None
+    
+    def iter_multipart(self, chunk_size=multipart.DEFAULT_CHUNK_SIZE):
+        """Yield the parts of a multipart body as they arrive.
+        
+        Each part is a `nitrogen.multipart.Part`, which is an iterator over
+        chunks of its body, so files can be streamed to their destination (or
+        hashed) without ever being held in memory or spooled to disk. Parts
+        must be consumed in order.
+        
+        Do not touch `form`, `files`, or `data` when using this, as it reads
+        the body directly.
+        
+        """
+        boundary = self.mimetype_params.get('boundary')
+        if not self.mimetype.startswith('multipart/') or not boundary:
+            raise status.BadRequest('not a multipart body')
+        if self.max_stream_length is not None:
+            length = self.headers.get('content-length', type=int)
+            if length is None or length > self.max_stream_length:
+                raise status.RequestEntityTooLarge()
+        return multipart.iter_parts(self.body, boundary, chunk_size)
+    
+    def track_progress(self, callback):
+        """Report progress of reading the body (e.g. while parsing uploads).
+        
+        The callback is called with the number of bytes read so far and the
+        content length (which may be None) as the body is consumed. Must be
+        called before anything reads the body.
+        
+        """
+        self.environ['wsgi.input'] = body.ProgressStream(self.environ['wsgi.input'],
+            callback, self.headers.get('content-length', type=int))
+        self.__dict__.pop('body', None)
         
     @property
     def route_steps(self):
@@ -205,9 +348,140 @@ class Request(wz.wrappers.Request):
         )
 
 
+class LiteRequest(object):
+    
+    """A small request for hot endpoints (e.g. high-rate tiny JSON APIs).
+    
+    Has `__slots__` and no werkzeug machinery; everything is parsed lazily
+    from the environ on first access. Offers `query`, `post`, `files`,
+    `cookies`, `headers`, `route` and `user_id`, but nothing else from
+    `Request`. Select it with `app.Request.application(lite=True)`.
+    
+    Each app builds its own subclass, so that cookies can be verified (and
+    `user_id` known) by the app's cookie subsystem. The default `response` is
+    only built if it is asked for. Subsystems which look at every request
+    (e.g. auth, the tracker, and the access log) still build a full `Request`
+    for themselves; leave them out of apps which want to avoid that.
+    
+    """
+    
+    __slots__ = ('environ', '_response', '_query', '_post', '_files', '_cookies', '_headers')
+    
+    # Set on the subclass which an app builds for itself.
+    app = None
+    
+    charset = 'utf-8'
+    max_form_memory_size = max_content_length = Request.max_form_memory_size
+    stream_factory = staticmethod(body.reject_factory)
+    
+    def __init__(self, environ):
+        self.environ = environ
+    
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.method, self.path_info)
+    
+    @property
+    def method(self):
+        return self.environ.get('REQUEST_METHOD', 'GET').upper()
+    
+    @property
+    def path_info(self):
+        return self.environ.get('PATH_INFO', '')
+    
+    @property
+    def script_name(self):
+        return self.environ.get('SCRIPT_NAME', '')
+    
+    @property
+    def route(self):
+        return self.environ.get('wsgiorg.routing_args', ((), {}))[1]
+    
+    @property
+    def response(self):
+        try:
+            return self._response
+        except AttributeError:
+            self._response = Response()
+            return self._response
+    
+    @response.setter
+    def response(self, response):
+        self._response = response
+    
+    @property
+    def headers(self):
+        try:
+            return self._headers
+        except AttributeError:
+            self._headers = wz.datastructures.EnvironHeaders(self.environ)
+            return self._headers
+    
+    @property
+    def query(self):
+        try:
+            return self._query
+        except AttributeError:
+            self._query = wz.urls.url_decode(self.environ.get('QUERY_STRING', ''), self.charset)
+            return self._query
+    
+    def _parse_form(self):
+        stream, self._post, self._files = wz.formparser.parse_form_data(self.environ,
+            stream_factory=self.stream_factory,
+            charset=self.charset,
+            max_form_memory_size=self.max_form_memory_size,
+            max_content_length=self.max_content_length,
+        )
+    
+    @property
+    def post(self):
+        try:
+            return self._post
+        except AttributeError:
+            self._parse_form()
+            return self._post
+    
+    @property
+    def files(self):
+        try:
+            return self._files
+        except AttributeError:
+            self._parse_form()
+            return self._files
+    
+    @property
+    def cookies(self):
+        try:
+            return self._cookies
+        except AttributeError:
+            header = self.environ.get('HTTP_COOKIE', '')
+            load = getattr(self.app, 'load_cookies', None)
+            self._cookies = load(header) if load else cookies.parse_cookies(header)
+            return self._cookies
+    
+    @property
+    def user_id(self):
+        if getattr(self.app, 'load_cookies', None) is None:
+            return None
+        return self.cookies.get(self.app.config.auth_cookie_name or 'user_id')
+    
+    # Request.application looks for these; lite requests have no versions.
+    @property
+    def _version_key(self):
+        return None
+    
+    _version_etag = _version_key
 
 
-
+def sendfile_etag(filename, mtime, size):
+    """The ETag which `Response.send_file` gives a file."""
+    return 'sendfile-%s-%s-%s' % (
+        mtime,
+        size,
+        hashlib.md5(
+            filename.encode('utf8') if isinstance(filename, unicode)
+            else filename
+        ).hexdigest()[:8]
+    )
 
 
 class Response(wz.wrappers.Response):
@@ -289,6 +563,87 @@ class Response(wz.wrappers.Response):
     
     use_x_sendfile = 'USE_X_SENDFILE' in os.environ
     
+    # Block size for files which are sent through Python; large blocks mean
+    # fewer trips through the WSGI stack per file.
+    file_block_size = 64 * 1024
+    
+    # The FileWrapper from send_file, so that get_app_iter can swap in the
+    # server's own.
+    _file_wrapper = None
+    
+    def get_app_iter(self, environ):
+        """Return the app iterator, using the server's `wsgi.file_wrapper`
+        for files from `send_file` (so they may be sent via sendfile)."""
+        app_iter = super(Response, self).get_app_iter(environ)
+        wrapper = self._file_wrapper
+        if wrapper is not None:
+            if app_iter is not wrapper:
+                # HEAD, 304, etc.; the file will never be read.
+                wrapper.close()
+            else:
+                server_wrapper = environ.get('wsgi.file_wrapper')
+                if server_wrapper is not None:
+                    return server_wrapper(wrapper.file, self.file_block_size)
+        return app_iter
+    
+    def make_conditional(self, request_or_environ):
+        """As werkzeug's, but also answers Range requests (with If-Range) for
+        files from send_file.
+        
+        A single range is a 206 with a Content-Range, several are a
+        multipart/byteranges 206, and unsatisfiable ones are a 416.
+        
+        """
+        super(Response, self).make_conditional(request_or_environ)
+        environ = getattr(request_or_environ, 'environ', request_or_environ)
+        if (
+            self._file_wrapper is not None and
+            self.status_code == 200 and
+            environ['REQUEST_METHOD'] == 'GET' and
+            environ.get('HTTP_RANGE') and
+            (
+                not environ.get('HTTP_IF_RANGE') or
+                byteranges.if_range_matches(environ['HTTP_IF_RANGE'],
+                    self.headers.get('etag') and wz.http.unquote_etag(self.headers['etag'])[0],
+                    self.last_modified,
+                )
+            )
+        ):
+            self._make_ranged(environ['HTTP_RANGE'])
+        return self
+    
+    def _make_ranged(self, header):
+        
+        length = self.content_length
+        ranges = byteranges.parse_ranges(header, length)
+        if ranges is None:
+            return
+        
+        file = self._file_wrapper.file
+        # A server file wrapper would send the whole file.
+        self._file_wrapper = None
+        
+        if not ranges:
+            file.close()
+            self.status_code = 416
+            self.headers['Content-Range'] = 'bytes */%d' % length
+            self.response = ()
+            self.content_length = 0
+            return
+        
+        self.status_code = 206
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            self.headers['Content-Range'] = byteranges.content_range(start, stop, length)
+            pieces = ranges
+        else:
+            boundary = byteranges.make_boundary()
+            pieces = byteranges.multipart_pieces(ranges, length, boundary, self.headers['Content-Type'])
+            self.headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        self.content_length = byteranges.pieces_length(pieces)
+        self.response = byteranges.RangeIterator(file, pieces, self.file_block_size)
+    
+    
     def send_file(self, filename, mimetype=None, as_attachment=False,
         attachment_filename=None, add_etags=None, cache_max_age=None,
         use_x_sendfile=None
@@ -301,8 +656,9 @@ class Response(wz.wrappers.Response):
         add an etag if there isn't one already set. cache_max_age also sets
         cache_control.expires.
         
-        Uses a generic werkzeug.FileWrapper instead of what is availible in
-        the environment. Also pulled out all conditional code.
+        The server's wsgi.file_wrapper is used if it has one (see
+        get_app_iter), otherwise a generic werkzeug.FileWrapper. Also pulled
+        out all conditional code.
         """
         
         filename  = os.path.abspath(filename)
@@ -320,7 +676,10 @@ class Response(wz.wrappers.Response):
             self.response = ()
         else:
             file = open(filename, 'rb')
-            self.response = wz.wsgi.FileWrapper(file)
+            # Knowing the length stops make_conditional from reading the file.
+            self.content_length = os.fstat(file.fileno()).st_size
+            self.accept_ranges = 'bytes'
+            self.response = self._file_wrapper = wz.wsgi.FileWrapper(file, self.file_block_size)
 
         mtime = os.path.getmtime(filename)
         self.mimetype = mimetype
@@ -333,16 +692,74 @@ class Response(wz.wrappers.Response):
             self.expires = int(time.time() + cache_max_age)
 
         if add_etags or add_etags is None and 'etag' not in self.headers:
-            self.set_etag('sendfile-%s-%s-%s' % (
-                mtime,
-                os.path.getsize(filename),
-                hashlib.md5(
-                    filename.encode('utf8') if isinstance(filename, unicode)
-                    else filename
-                ).hexdigest()[:8]
-            ))
+            self.set_etag(sendfile_etag(filename, mtime, os.path.getsize(filename)))
 
         return self
 
 
+def iter_json_list(items, encode=json.dumps, chunk_size=8192):
+    """Encode an iterable as a JSON list, in chunks of about `chunk_size`.
+    
+        >>> list(iter_json_list(xrange(5), chunk_size=4))
+        ['[0,1', ',2,3', ',4]']
+    
+    """
+    buffer = ['[']
+    size = 1
+    first = True
+    for item in items:
+        encoded = encode(item)
+        if first:
+            first = False
+        else:
+            encoded = ',' + encoded
+        buffer.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(']')
+    yield ''.join(buffer)
+
 
+class JSONResponse(Response):
+    
+    """A response of JSON.
+    
+    Iterators (including generators), and lists or tuples of at least
+    `stream_min_length` items, are streamed element by element, so the whole
+    document is never held in memory. Anything else (including objects which
+    only a custom encoder understands) is encoded at once, so that encoding
+    errors happen before the response starts. Pass `stream` to force it
+    either way.
+    
+    Streamed responses are sent chunked. Their ETag is hashed as they are sent
+    if the request has a version key (see `Request.check_version`), as with
+    any other streamed response.
+    
+    Errors while streaming can not change the status, and will truncate the
+    document.
+    
+    """
+    
+    default_mimetype = 'application/json'
+    
+    # Any function which turns an object into a JSON string; swap in a faster
+    # one (or one with a `default`) per class or per response.
+    encoder = staticmethod(json.dumps)
+    
+    stream_min_length = 100
+    chunk_size = 8192
+    
+    def __init__(self, data=None, status=None, headers=None, stream=None, encoder=None, **kwargs):
+        encoder = encoder or self.encoder
+        if stream is None:
+            stream = (
+                isinstance(data, (list, tuple)) and len(data) >= self.stream_min_length
+            ) or isinstance(data, collections.Iterator)
+        if stream:
+            body = iter_json_list(data, encoder, self.chunk_size)
+        else:
+            body = encoder(data)
+        super(JSONResponse, self).__init__(body, status, headers, **kwargs)
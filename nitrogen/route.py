@@ -0,0 +1,110 @@
+"""Routing on top of webstar, with a cache of resolved routes.
+
+webstar walks every registered router on every request (including the static
+router registered at `None`). Most traffic hits a relatively small set of
+URLs, so we remember the resolved route for each (SCRIPT_NAME, PATH_INFO) and
+replay it onto the environ instead.
+
+"""
+
+import logging
+
+import webstar
+from webstar.core import Route, HISTORY_ENVIRON_KEY
+
+from .event import Event
+from .lru import LRUCache
+
+
+log = logging.getLogger(__name__)
+
+
+class Router(webstar.Router):
+
+    """A webstar.Router which announces changes to its routing table.
+
+    Child routers (e.g. those created by register_module) forward their
+    changes to their parents, so listening to the root router will catch any
+    registration in the tree.
+
+    """
+
+    def __init__(self):
+        super(Router, self).__init__()
+        self.changed = Event()
+
+    def register(self, pattern, app=None, **kwargs):
+        if app and isinstance(app, Router):
+            app.changed.listen(self.changed.trigger)
+        res = super(Router, self).register(pattern, app, **kwargs)
+        if app:
+            self.changed.trigger(self)
+        return res
+
+
+class RouteCache(object):
+
+    """LRU cache of resolved routes, keyed by SCRIPT_NAME and PATH_INFO.
+
+    Only successful routes are cached; not-found and normalization redirects
+    always go back to the router. Routes which pass through any of the
+    `uncacheable` routers are also skipped (e.g. the static router, whose
+    answers depend on the filesystem).
+
+    """
+
+    def __init__(self, router, maxsize=1024, uncacheable=()):
+        self.router = router
+        self.uncacheable = tuple(uncacheable)
+        self.cache = LRUCache(maxsize)
+        if isinstance(router, Router):
+            router.changed.listen(self.invalidate)
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    def invalidate(self, *args):
+        self.cache.clear()
+
+    def peek(self, environ):
+        """The app a request would be routed to if it is cached, else None.
+
+        The environ is not touched.
+
+        """
+        cached = self.cache.get((environ.get('SCRIPT_NAME', ''), environ.get('PATH_INFO', '')))
+        return cached[0].app if cached is not None else None
+
+    def wsgi_route(self, environ):
+
+        key = (environ.get('SCRIPT_NAME', ''), environ.get('PATH_INFO', ''))
+        cached = self.cache.get(key)
+
+        if cached is None:
+            app = self.router.wsgi_route(environ)
+            route = environ.get(HISTORY_ENVIRON_KEY)
+            if route is not None and route.app is app and not any(
+                step.router in self.uncacheable for step in route
+            ):
+                self.cache[key] = (route, route.data, route.unrouted, route.consumed)
+            return app
+
+        route, data, unrouted, consumed = cached
+
+        # Give every request its own Route, since they are mutable.
+        copy = list.__new__(Route)
+        list.extend(copy, route)
+
+        # This mirrors what webstar.core.RouterInterface.wsgi_route does.
+        args, kwargs = environ.setdefault('wsgiorg.routing_args', ((), {}))
+        kwargs.update(data)
+        environ[HISTORY_ENVIRON_KEY] = copy
+        environ['PATH_INFO'] = unrouted
+        environ['SCRIPT_NAME'] = key[0] + consumed
+
+        return route.app
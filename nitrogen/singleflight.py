@@ -0,0 +1,227 @@
+"""Single-flight call coalescing.
+
+When many threads want the same expensive result at once (e.g. a popular
+page which just fell out of the cache), only the first does the work; the
+rest wait for it and share the result. A waiter which gives up after the
+timeout does the work itself.
+
+As WSGI middleware, identical GET requests (keyed as the page cache keys
+them) share one rendered response. It is rendered without any conditional
+headers, and each request's own If-None-Match and If-Modified-Since are then
+checked against it. Ranged requests are not coalesced:
+
+    @app.route('/popular')
+    @app.page_cache.cached(ttl=60)
+    @app.coalesce_requests(timeout=5)
+    @Request.application
+    def popular(request):
+        ...
+
+"""
+
+import logging
+import sys
+import threading
+
+from werkzeug.http import is_resource_modified
+
+from . import compress
+from .cache import request_key
+from .pipeline import PassthroughIterator
+
+
+log = logging.getLogger(__name__)
+
+
+# Stripped from the environ that the shared response is rendered with.
+_CONDITIONAL_KEYS = (
+    'HTTP_IF_NONE_MATCH',
+    'HTTP_IF_MODIFIED_SINCE',
+    'HTTP_IF_RANGE',
+    compress.IF_NONE_MATCH_KEY,
+)
+
+# What a 304 carries over from the full response.
+_NOT_MODIFIED_HEADERS = ('etag', 'last-modified', 'cache-control', 'expires', 'vary')
+
+
+class _Call(object):
+
+    __slots__ = ('event', 'result', 'exc_info')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = self.exc_info = None
+
+
+class SingleFlight(object):
+
+    """Coalesces concurrent calls with the same key.
+
+        >>> flight = SingleFlight()
+        >>> flight.do('key', lambda: 42)
+        42
+
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def do(self, key, func, timeout=None):
+        """Call `func`, or wait for (and share) the result of the call for
+        `key` already in flight.
+
+        Exceptions are shared too. If waiting takes longer than the timeout we
+        stop waiting and call `func` ourselves.
+
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            self.calls += 1
+            try:
+                call.result = func()
+            except:
+                call.exc_info = sys.exc_info()
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+            return call.result
+
+        timeout = self.timeout if timeout is None else timeout
+        if not call.event.wait(timeout):
+            self.timeouts += 1
+            log.warning('gave up waiting on %r after %.1fs' % (key, timeout))
+            return func()
+        self.shared += 1
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    @property
+    def stats(self):
+        return dict(
+            in_flight=len(self._calls),
+            calls=self.calls,
+            shared=self.shared,
+            timeouts=self.timeouts,
+        )
+
+    def coalesced(self, vary=(), vary_cookies=(), timeout=None, max_size=1024 * 1024):
+        """Decorator to coalesce identical GET requests to a WSGI app."""
+        def _decorator(app):
+            return coalesce(app, self, vary, vary_cookies, timeout, max_size)
+        return _decorator
+
+
+def _render(app, environ, max_size):
+    """Call a WSGI app, buffering up to max_size of its body.
+
+    Returns (status, headers, body, rest) where `rest` is the (unbuffered)
+    app iterator if the body was too big, else None. The app is not shown
+    the request's conditional headers, so that the response suits everyone.
+
+    """
+
+    saved = dict((key, environ.pop(key)) for key in _CONDITIONAL_KEYS if key in environ)
+    try:
+        return _render_unconditional(app, environ, max_size)
+    finally:
+        environ.update(saved)
+
+
+def _render_unconditional(app, environ, max_size):
+
+    captured = []
+    body = []
+    def start(status, headers, exc_info=None):
+        captured[:] = [status, headers]
+        return body.append
+
+    app_iter = app(environ, start)
+    size = 0
+    iterator = iter(app_iter)
+    for chunk in iterator:
+        body.append(chunk)
+        size += len(chunk)
+        if size > max_size:
+            return captured[0], captured[1], body, PassthroughIterator.prefetched(''.join(body), iterator, app_iter)
+    close = getattr(app_iter, 'close', None)
+    if close is not None:
+        close()
+    return captured[0], captured[1], body, None
+
+
+def _is_shareable(response):
+    status, headers, body, rest = response
+    return (
+        rest is None and status.startswith('200') and
+        not any(name.lower() == 'set-cookie' for name, value in headers)
+    )
+
+
+def _respond(environ, start, response):
+    """Send a (possibly shared) response, subject to this request's conditionals."""
+    status, headers, body, rest = response
+    if rest is None and status.startswith('200'):
+        values = dict((name.lower(), value) for name, value in headers)
+        if not is_resource_modified(environ, values.get('etag'), last_modified=values.get('last-modified')):
+            start('304 Not Modified', [(name, value) for name, value in headers if name.lower() in _NOT_MODIFIED_HEADERS])
+            return []
+    start(status, list(headers))
+    return body if rest is None else rest
+
+
+def coalesce(app, flight, vary=(), vary_cookies=(), timeout=None, max_size=1024 * 1024):
+    """WSGI middleware which coalesces identical concurrent GET requests.
+
+    Only full 200 responses are shared; those waiting on anything else (or
+    on responses which set cookies or are bigger than `max_size`) call the
+    app themselves.
+
+    """
+
+    def _coalesced_app(environ, start):
+
+        method = environ.get('REQUEST_METHOD')
+        if method not in ('GET', 'HEAD') or environ.get('HTTP_AUTHORIZATION') or environ.get('HTTP_RANGE'):
+            return app(environ, start)
+
+        key = request_key(environ, vary, vary_cookies, method)
+        called = []
+        def render():
+            called.append(True)
+            return _render(app, environ, max_size)
+        response = flight.do(key, render, timeout)
+
+        if not called and not _is_shareable(response):
+            return app(environ, start)
+        return _respond(environ, start, response)
+
+    return _coalesced_app
+
+
+class SingleFlightAppMixin(object):
+
+    def setup_config(self):
+        super(SingleFlightAppMixin, self).setup_config()
+        self.config.setdefaults(
+            singleflight_timeout=10,
+        )
+
+    def __init__(self, *args, **kwargs):
+        super(SingleFlightAppMixin, self).__init__(*args, **kwargs)
+        self.singleflight = SingleFlight(self.config.singleflight_timeout)
+        self.coalesce_requests = self.singleflight.coalesced
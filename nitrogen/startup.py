@@ -0,0 +1,85 @@
+"""Measure the startup cost of each app subsystem.
+
+Every measurement is taken in a fresh interpreter, so that nothing is already
+imported. For each subsystem we report the time to import it (along with its
+dependencies) on top of the core, and the time to construct an App with it.
+
+Usage:
+
+    python -m nitrogen.startup [-n REPEAT] [subsystem ...]
+
+"""
+
+import json
+import subprocess
+import sys
+
+
+_probe = '''
+import json, sys, time
+t0 = time.time()
+import nitrogen.app
+t1 = time.time()
+names = %r
+mixins = [nitrogen.app.load_subsystem(x) for x in nitrogen.app.resolve_subsystems(names)]
+t2 = time.time()
+cls = nitrogen.app.build_app_class(names)
+cls()
+t3 = time.time()
+json.dump(dict(core=t1 - t0, imports=t2 - t1, construct=t3 - t2), sys.stdout)
+'''
+
+
+def probe(subsystems, python=None):
+    """Time importing and constructing an App with the given subsystems.
+
+    Runs in a new interpreter; returns a dict of durations (in seconds) for
+    "core", "imports", and "construct".
+
+    """
+    proc = subprocess.Popen([python or sys.executable, '-c', _probe % (list(subsystems), )],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError('startup probe failed for %r:\n%s' % (subsystems, err))
+    return json.loads(out)
+
+
+def measure(names=None, repeat=3, python=None):
+    """Yield (name, timings) for the core and then each subsystem.
+
+    Timings are the best of `repeat` runs. The core's "imports" and
+    "construct" are for a bare App, and each subsystem's are that of an App
+    with just it (and its dependencies).
+
+    """
+    from .app import DEFAULT_SUBSYSTEMS
+    for name in [None] + list(names or DEFAULT_SUBSYSTEMS):
+        runs = [probe([name] if name else [], python) for i in xrange(repeat)]
+        yield name or 'core', dict((key, min(run[key] for run in runs)) for key in runs[0])
+
+
+def main(argv=None):
+
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] [subsystem ...]')
+    parser.add_option('-n', '--repeat', type='int', default=3,
+        help='take the best of this many runs [%default]')
+    opts, args = parser.parse_args(argv)
+
+    print '%-12s %10s %10s %10s' % ('subsystem', 'core ms', 'import ms', 'init ms')
+    base = None
+    for name, timings in measure(args, opts.repeat):
+        if base is None:
+            base = timings
+        print '%-12s %10.1f %10.1f %10.1f' % (name,
+            1000 * timings['core'],
+            1000 * timings['imports'],
+            1000 * max(0, timings['construct'] - (0 if name == 'core' else base['construct'])),
+        )
+
+
+if __name__ == '__main__':
+    main()
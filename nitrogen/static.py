@@ -1,51 +1,325 @@
 
-import os
+import datetime
+import hashlib
 import logging
+import mimetypes
+import os
+import threading
+import time
 
+import werkzeug as wz
+import werkzeug.http
+import werkzeug.urls
+import werkzeug.utils
 import webstar.core as core
 
-from .request import Request, Response
+from . import compress
+from . import manifest as manifests
+from .lru import LRUCache
+from .request import Request, Response, sendfile_etag
 
 
 log = logging.getLogger(__name__)
 
+
+class StaticFile(object):
+
+    """What the index knows about a file; the hash is computed on demand."""
+
+    __slots__ = ('path', 'size', 'mtime', '_hash')
+
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self._hash = None
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.path)
+
+    @property
+    def hash(self):
+        """MD5 of the contents."""
+        if self._hash is None:
+            md5 = hashlib.md5()
+            with open(self.path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(65536), ''):
+                    md5.update(chunk)
+            self._hash = md5.hexdigest()
+        return self._hash
+
+
+class StaticIndex(object):
+
+    """An in-memory index of every file under a list of directories.
+
+    Maps relative paths (with forward slashes) to `StaticFile`s; where several
+    directories have the same path the first wins. Lookups never touch the
+    disk (except for the very first, which builds the index):
+
+        frozen: built once, and never refreshed (for production). Files
+            added later are not served until the process restarts, or
+            something calls `scan()` (e.g. `StaticRouter.warmup()`).
+        poll: rescanned once a lookup finds it more than `interval` seconds
+            old (for development).
+        watch: rescanned after pyinotify reports a change (falling back to
+            poll if it is not installed).
+
+    Rescans happen on a background thread, and lookups use the old index
+    until they are done, so a slow disk never holds up a request.
+
+    Symlinked directories are followed, except those which lead back into
+    one of their own parents.
+
+    """
+
+    MODES = ('frozen', 'poll', 'watch')
+
+    def __init__(self, bases, mode='poll', interval=1.0):
+        if mode not in self.MODES:
+            raise ValueError('unknown static index mode %r' % mode)
+        self.bases = list(bases)
+        self.mode = mode
+        self.interval = interval
+        self.files = {}
+        self.scanned_at = None
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._notifier = None
+        if mode == 'watch':
+            self._watch()
+
+    def _watch(self):
+        try:
+            import pyinotify
+        except ImportError:
+            log.warning('pyinotify is not installed; polling the static index instead')
+            self.mode = 'poll'
+            return
+        index = self
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                index._dirty = True
+        manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB
+        for base in self.bases:
+            if os.path.isdir(base):
+                manager.add_watch(base, mask, rec=True, auto_add=True)
+        self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self._notifier.daemon = True
+        self._notifier.start()
+
+    def scan(self):
+        """Rebuild the index from the disk; returns the number of files."""
+        # Changes reported during the scan may be missed by it.
+        self._dirty = False
+        files = {}
+        old = self.files
+        for base in self.bases:
+            # The real paths of every directory down to each one we walk.
+            parents = {base: (os.path.realpath(base), )}
+            for dir_path, dir_names, file_names in os.walk(base, followlinks=True):
+                chain = parents.pop(dir_path)
+                for name in list(dir_names):
+                    path = os.path.join(dir_path, name)
+                    real_path = os.path.realpath(path)
+                    if real_path in chain:
+                        dir_names.remove(name)
+                    else:
+                        parents[path] = chain + (real_path, )
+                rel_dir = os.path.relpath(dir_path, base)
+                for name in file_names:
+                    rel_path = name if rel_dir == '.' else os.path.join(rel_dir, name)
+                    rel_path = rel_path.replace(os.path.sep, '/')
+                    if rel_path in files:
+                        continue
+                    path = os.path.join(dir_path, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    # Keep the old entry (and its hash) if nothing changed.
+                    entry = old.get(rel_path)
+                    if entry is None or entry.path != path or entry.mtime != stat.st_mtime or entry.size != stat.st_size:
+                        entry = StaticFile(path, stat.st_size, stat.st_mtime)
+                    files[rel_path] = entry
+        self.files = files
+        self.scanned_at = time.time()
+        return len(files)
+
+    def refresh(self):
+        """Start a background rescan if the mode calls for it.
+
+        Only blocks if the index has never been built.
+
+        """
+        if self.scanned_at is None:
+            with self._lock:
+                if self.scanned_at is None:
+                    self.scan()
+            return
+        if self.mode == 'frozen':
+            return
+        if self.mode == 'poll':
+            due = time.time() - self.scanned_at > self.interval
+        else:
+            due = self._dirty
+        if due and self._lock.acquire(False):
+            try:
+                thread = threading.Thread(target=self._background_scan, name='static-index-scan')
+                thread.daemon = True
+                thread.start()
+            except:
+                self._lock.release()
+                raise
+
+    def _background_scan(self):
+        try:
+            self.scan()
+        except Exception:
+            log.exception('could not scan static files')
+        finally:
+            self._lock.release()
+
+    def get(self, path):
+        """The `StaticFile` for a relative path, or None."""
+        self.refresh()
+        return self.files.get(path.lstrip('/'))
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __len__(self):
+        self.refresh()
+        return len(self.files)
+
         
 class StaticRouter(core.RouterInterface):
     
     use_x_sendfile = 'USE_X_SENDFILE' in os.environ
     
     def __init__(self, path, data_key='filename', use_x_sendfile=None,
-        cache_max_age=3600
+        cache_max_age=3600, index='frozen', index_interval=1.0, manifest=None,
+        hot_cache_size=8 * 1024 * 1024, hot_max_file_size=64 * 1024,
+        gzip_sidecars=True
     ):
         self.path = map(os.path.abspath, path)
         self.data_key = data_key
         if use_x_sendfile is not None:
             self.use_x_sendfile = use_x_sendfile
         self.cache_max_age = cache_max_age
+        self.index = StaticIndex(self.path, index, index_interval)
+        
+        # Logical paths to fingerprinted ones (see nitrogen.manifest); from
+        # a file, or given directly.
+        if isinstance(manifest, basestring):
+            manifest = manifests.load_manifest(manifest)
+        self.manifest = manifest
+        self._manifest_reverse = dict((v, k) for k, v in manifest.iteritems()) if manifest else {}
+        
+        # Small files are kept in memory (along with their headers and a
+        # gzipped copy), within a total byte budget; zero turns this off.
+        self.hot_max_file_size = hot_max_file_size
+        self.hot_cache = LRUCache(maxsize=1 << 20, maxbytes=hot_cache_size, weigh=_HotFile.weigh) if hot_cache_size else None
+        
+        # Serve "foo.js.gz" (if it is at least as new) in place of "foo.js" to
+        # clients which accept gzip; see nitrogen.precompress.
+        self.gzip_sidecars = gzip_sidecars
+        
         super(StaticRouter, self).__init__()
+    
+    def versioned_url(self, path):
+        """The fingerprinted URL for a static path, or the path itself if
+        there is no such file.
+        
+        With a manifest this is a dictionary lookup, otherwise it uses the
+        index (which hashes each file once per change).
+        
+        """
+        path = path.lstrip('/')
+        if self.manifest is not None:
+            return '/' + self.manifest.get(path, path)
+        file = self.index.get(path)
+        if file is None:
+            return '/' + path
+        return '/' + manifests.fingerprint(path, file.hash)
+
+    def get_file(self, path):
+        """The indexed `StaticFile` for a URL path, or None."""
+        return self.index.get(path)
 
     def get_mtime(self, path):
-        path = path.lstrip('/')
-        for base in self.path:
-            fullpath = os.path.join(base, path)
-            if os.path.exists(fullpath) and os.path.isfile(fullpath):
-                return os.path.getmtime(fullpath)
-        return None
+        file = self.index.get(path)
+        return file.mtime if file is not None else None
+    
+    def warmup(self):
+        """Build the static index (which stats every file once, so the OS has
+        them cached before any forks).
+        
+        Returns the number of files seen.
+        
+        """
+        return self.index.scan()
     
     def route_step(self, path):
         path = path[1:]
         if not path:
             return
-        for base in self.path:
-            fullpath = os.path.join(base, path)
-            if os.path.exists(fullpath) and os.path.isfile(fullpath):
-                yield core.RouteStep(
-                    head=_StaticApp(fullpath, self),
-                    router=self,
-                    consumed=path,
-                    unrouted='',
-                    data={self.data_key: path},
-                )
+        file = self.index.get(path)
+        immutable = False
+        logical = path
+        if file is None:
+            logical, immutable = self._resolve_fingerprint(path)
+            file = logical and self.index.get(logical)
+        if file is not None:
+            yield core.RouteStep(
+                head=_StaticApp(file.path, self, immutable, file, self.get_sidecar(logical, file)),
+                router=self,
+                consumed=path,
+                unrouted='',
+                data={self.data_key: logical},
+            )
+    
+    def get_sidecar(self, path, file):
+        """The fresh gzipped sidecar of an indexed file, or None."""
+        if not self.gzip_sidecars:
+            return None
+        sidecar = self.index.get(path + '.gz')
+        if sidecar is not None and sidecar.mtime >= file.mtime:
+            return sidecar
+    
+    def get_hot(self, file, sidecar=None):
+        """Get the in-memory copy of an indexed file, loading it if needed.
+        
+        Returns None if the file is not eligible (too big, or the cache is
+        off).
+        
+        """
+        if self.hot_cache is None or file.size > self.hot_max_file_size:
+            return None
+        hot = self.hot_cache.get(file.path)
+        sidecar_mtime = sidecar.mtime if sidecar is not None else None
+        if hot is None or hot.mtime != file.mtime or hot.size != file.size or hot.sidecar_mtime != sidecar_mtime:
+            try:
+                hot = _HotFile(file, sidecar)
+            except IOError:
+                return None
+            self.hot_cache[file.path] = hot
+        return hot
+    
+    def _resolve_fingerprint(self, path):
+        """Return the logical path for a fingerprinted one, and if the hash
+        is that of the current contents."""
+        parsed = manifests.parse_fingerprint(path)
+        if parsed is None:
+            return None, False
+        logical, hash = parsed
+        logical = self._manifest_reverse.get(path, logical)
+        file = self.index.get(logical)
+        # An old hash (e.g. from a page rendered before a deploy, or a
+        # manifest built before the file changed) still gets the current
+        # file, but it must not be cached forever.
+        return logical, file is not None and file.hash.startswith(hash)
     
     def generate_step(self, data):
         path = data.get(self.data_key)
@@ -53,17 +327,150 @@ class StaticRouter(core.RouterInterface):
             yield core.GenerateStep(segment=path, head=None)
 
 
+def _variant_etag(file, sidecar=None, gzip=False):
+    """The ETag of an indexed file (or its gzipped variant), which both the
+    hot cache and `send_file` must agree upon.
+
+    A gzipped variant from a sidecar is tagged after the sidecar, since its
+    bytes may differ from those of our own gzipping of the file.
+
+    """
+    if not gzip:
+        return sendfile_etag(file.path, file.mtime, file.size)
+    source = sidecar or file
+    return sendfile_etag(source.path, source.mtime, source.size) + '-gzip'
+
+
+def _conditional_environ(environ, encoded):
+    """The environ to check a variant's conditionals against.
+
+    The compress middleware strips encoding suffixes from If-None-Match (so
+    that the client's gzip ETag looks like our identity one); a variant we
+    encoded ourselves is checked against what the client really sent.
+
+    """
+    if encoded and compress.IF_NONE_MATCH_KEY in environ:
+        return dict(environ, HTTP_IF_NONE_MATCH=environ[compress.IF_NONE_MATCH_KEY])
+    return environ
+
+
+class _HotFile(object):
+
+    """A small file held in memory, with everything needed to serve it."""
+
+    __slots__ = ('mtime', 'size', 'sidecar_mtime', 'body', 'gzip_body', 'etag', 'gzip_etag', 'last_modified', 'headers')
+
+    def __init__(self, file, sidecar=None):
+        with open(file.path, 'rb') as fh:
+            self.body = fh.read()
+        self.mtime = file.mtime
+        self.size = file.size
+        self.etag = _variant_etag(file)
+        # HTTP dates only have whole seconds.
+        self.last_modified = datetime.datetime.utcfromtimestamp(int(file.mtime))
+
+        mimetype = mimetypes.guess_type(file.path)[0] or 'application/octet-stream'
+        self.headers = [
+            ('Content-Type', wz.utils.get_content_type(mimetype, 'utf-8')),
+            ('Last-Modified', wz.http.http_date(file.mtime)),
+            # Range requests skip the cache, and are served from the file.
+            ('Accept-Ranges', 'bytes'),
+        ]
+
+        self.gzip_body = None
+        self.sidecar_mtime = None
+        if sidecar is not None:
+            self.headers.append(('Vary', 'Accept-Encoding'))
+            with open(sidecar.path, 'rb') as fh:
+                self.gzip_body = fh.read()
+            self.sidecar_mtime = sidecar.mtime
+        elif mimetype.startswith(compress.DEFAULT_MIMETYPES):
+            self.headers.append(('Vary', 'Accept-Encoding'))
+            compressor = compress.compressobj('gzip', 9)
+            gzip_body = compressor.compress(self.body) + compressor.flush()
+            if len(gzip_body) < len(self.body):
+                self.gzip_body = gzip_body
+        self.gzip_etag = _variant_etag(file, sidecar, True) if self.gzip_body is not None else None
+
+    def weigh(self):
+        return len(self.body) + len(self.gzip_body or '')
+
+    def is_modified(self, environ, etag):
+        """Does the client need the variant with this ETag?"""
+        environ = _conditional_environ(environ, etag != self.etag)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return not wz.http.parse_etags(if_none_match).contains(etag)
+        since = wz.http.parse_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+        return since is None or self.last_modified > since
+
+
 class _StaticApp(object):
 
-    def __init__(self, path, router):
+    def __init__(self, path, router, immutable=False, file=None, sidecar=None):
         self.path = path
         self.router = router
+        self.immutable = immutable
+        self.file = file
+        self.sidecar = sidecar
+
+    def __call__(self, environ, start):
+        if (
+            self.file is not None and
+            not self.router.use_x_sendfile and
+            environ.get('REQUEST_METHOD') in ('GET', 'HEAD') and
+            'HTTP_RANGE' not in environ
+        ):
+            hot = self.router.get_hot(self.file, self.sidecar)
+            if hot is not None:
+                return self._serve_hot(hot, environ, start)
+        return self._serve_file(environ, start)
+
+    def _get_max_age(self, environ):
+        if self.immutable or 'v' in wz.urls.url_decode(environ.get('QUERY_STRING', '')):
+            return 31536000
+        return self.router.cache_max_age
+
+    def _serve_hot(self, hot, environ, start):
+
+        gzip = hot.gzip_body is not None and compress.choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', '')) == 'gzip'
+        body = hot.gzip_body if gzip else hot.body
+        etag = hot.gzip_etag if gzip else hot.etag
+
+        max_age = self._get_max_age(environ)
+        headers = hot.headers + [
+            ('ETag', wz.http.quote_etag(etag)),
+            ('Cache-Control', 'public, %smax-age=%d' % ('immutable, ' if self.immutable else '', max_age)),
+            ('Expires', wz.http.http_date(time.time() + max_age)),
+        ]
+
+        if not hot.is_modified(environ, etag):
+            start('304 Not Modified', headers)
+            return []
+
+        if gzip:
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        start('200 OK', headers)
+        return [] if environ['REQUEST_METHOD'] == 'HEAD' else [body]
 
     @Request.application
-    def __call__(self, request):
+    def _serve_file(self, request):
         
-        return Response().send_file(self.path,
+        gzip = self.sidecar is not None and compress.choose_encoding(request.environ.get('HTTP_ACCEPT_ENCODING', '')) == 'gzip'
+        response = Response().send_file(self.sidecar.path if gzip else self.path,
+            mimetype=mimetypes.guess_type(self.path)[0],
             use_x_sendfile=self.router.use_x_sendfile,
-            cache_max_age=31536000 if 'v' in request.query else self.router.cache_max_age,
-        ).make_conditional(request)
-
+            cache_max_age=self._get_max_age(request.environ),
+        )
+        if self.sidecar is not None:
+            response.vary.add('Accept-Encoding')
+        if gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+            # The same validators as the hot cache gives this variant.
+            response.set_etag(_variant_etag(self.file, self.sidecar, True))
+            response.last_modified = self.file.mtime
+        if self.immutable:
+            # The URL changes with the content, so never revalidate.
+            response.cache_control['immutable'] = None
+        return response.make_conditional(_conditional_environ(request.environ, gzip))
@@ -38,7 +38,7 @@ class TrackerAppMixin(object):
     def cookie_tracker_middleware(self, app):
         def _app(environ, start):
             def _start(status, headers, *args):
-                request = self.Request(environ)
+                request = self.Request.from_environ(environ)
                 token = request.cookies.get(self.config.cookie_tracker_name)
                 if not token:
                     token = os.urandom(16).encode('hex')
@@ -70,7 +70,7 @@ class ViewAppMixin(object):
             render_string=self.render_string,
             markdown=self.markdown,
             versioned_static=self.versioned_static,
-            url_for= lambda *args, **kwargs: self._local.request.url_for(*args, **kwargs),
+            url_for= lambda *args, **kwargs: self.local_request().url_for(*args, **kwargs),
         )
         
     def export_to(self, map):
@@ -81,6 +81,26 @@ class ViewAppMixin(object):
             markdown=self.markdown,
         )
     
+    template_extensions = ('.html', '.haml', '.mako', '.txt', '.xml')
+    
+    def warmup(self):
+        """Compile every template on the template path into the lookup."""
+        count = 0
+        for directory in self.lookup.directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                for name in filenames:
+                    if not name.endswith(self.template_extensions):
+                        continue
+                    uri = '/' + os.path.relpath(os.path.join(dirpath, name), directory)
+                    try:
+                        self.lookup.get_template(uri)
+                    except Exception:
+                        log.exception('could not compile template %r' % uri)
+                        continue
+                    count += 1
+        log.debug('compiled %d templates' % count)
+        super(ViewAppMixin, self).warmup()
+    
     @property
     def template_path(self):
         return self.lookup.directories
@@ -118,13 +138,15 @@ class ViewAppMixin(object):
         Searches on the current `self.path`.
         
         """
-        if isinstance(template, basestring):
-            template = self.lookup.get_template(template)
-        return self.render_template(template, **data)
+        with self.time_phase('render'):
+            if isinstance(template, basestring):
+                template = self.lookup.get_template(template)
+            return self.render_template(template, **data)
     
     def render_string(self, template, **data):
-        template = mako.Template(template, lookup=self.lookup, **self.lookup.template_args)
-        return self.render_template(template, **data)
+        with self.time_phase('render'):
+            template = mako.Template(template, lookup=self.lookup, **self.lookup.template_args)
+            return self.render_template(template, **data)
     
     def markdown(self, x, **custom_exts):
         exts = self.config.markdown_extensions.copy()
@@ -132,11 +154,8 @@ class ViewAppMixin(object):
         return markdown.markdown(x, **exts)
 
     def versioned_static(self, path):
-        path = '/' + path.lstrip('/')
-        mtime = self.static_router.get_mtime(path)
-        if mtime:
-            return '%s?v=%d' % (path, mtime)
-        return path
+        """The content-hash fingerprinted URL of a static file."""
+        return self.static_router.versioned_url(path)
         
     
 
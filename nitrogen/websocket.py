@@ -170,6 +170,9 @@ class Response(request.Response):
     GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
     SUPPORTED_VERSIONS = ('13', '8', '7')
     
+    # Where servers put the raw socket; see nitrogen.green for our own.
+    socket_environ_keys = ('gunicorn.socket', 'nitrogen.socket')
+    
     def run(self):
         return self.application(self.websocket)
     
@@ -189,8 +192,10 @@ class Response(request.Response):
             raise ValueError('request not for websocket')
         
         # Get the raw socket: this depends on the server.
-        if 'gunicorn.socket' in environ:
-            self.socket = environ['gunicorn.socket']
+        for key in self.socket_environ_keys:
+            if key in environ:
+                self.socket = environ[key]
+                break
         else:
             raise ValueError('no socket')
         
@@ -30,7 +30,8 @@ setup(
         
         wtforms
         
-        jsmin
+        # 3.x is Python 3 only.
+        jsmin<3
 
         # imgsizer
         pil
@@ -1,3 +1,6 @@
+import os
+import time
+
 from nitrogen.core import App
 from nitrogen import test
 from nitrogen.request import Request, Response
@@ -43,4 +46,859 @@ class AppTests(test.TestCase):
         self.assertEqual(client.get('/wsgi').data, 'wsgi')
         self.assertEqual(client.get('/request').data, 'request')
         self.assertEqual(client.get('/none').data, 'none')
-        
\ No newline at end of file
+        
+    def test_compiled_pipeline(self):
+        
+        app = App(compiled_pipeline=True)
+        
+        finished = []
+        app.after_request.listen(finished.append)
+        
+        @app.route('/')
+        def do_render(request):
+            return app.Response('hello')
+        
+        @app.route('/error')
+        def do_error(request):
+            raise ValueError('testing')
+        
+        client = app.test_client()
+        res = client.get('/', buffered=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, 'hello')
+        self.assertEqual(len(finished), 1)
+        
+        res = client.get('/error', buffered=True)
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(len(finished), 2)
+        
+    def test_teardown_without_close(self):
+        
+        for compiled in True, False:
+            
+            app = App(compiled_pipeline=compiled)
+            finished = []
+            app.after_request.listen(finished.append)
+            
+            @app.route('/')
+            def do_render(request):
+                return app.Response('hello')
+            
+            # Exhausting the body is enough, and closing afterwards doesn't
+            # tear down a second time.
+            res = app.test_client().get('/')
+            self.assertEqual(res.data, 'hello')
+            self.assertEqual(len(finished), 1)
+            res.close()
+            self.assertEqual(len(finished), 1)
+        
+    def test_route_cache(self):
+        
+        app = App(route_cache_size=10)
+        
+        @app.route('/{name}')
+        def do_name(request):
+            return app.Response(request.route['name'])
+        
+        client = app.test_client()
+        self.assertEqual(client.get('/one').data, 'one')
+        self.assertEqual(client.get('/one').data, 'one')
+        self.assertEqual(client.get('/two').data, 'two')
+        self.assertEqual(app.route_cache.hits, 1)
+        
+        # Changing the routing table must clear the cache.
+        @app.route('/one', _priority=1)
+        def do_one(request):
+            return app.Response('overridden')
+        
+        self.assertEqual(client.get('/one').data, 'overridden')
+        
+    def test_shared_request(self):
+        
+        app = App(test.app_config)
+        
+        seen = []
+        
+        @app.route('/{name}')
+        def do_name(request):
+            seen.append(request)
+            seen.append(app.local_request())
+            return app.Response(request.path)
+        
+        before = Request.reuse_count
+        client = app.test_client()
+        self.assertEqual(client.get('/one/two').data, '/two')
+        self.assertTrue(seen[0] is seen[1])
+        self.assertTrue(Request.reuse_count > before)
+        
+    def test_request_context_is_not_kept(self):
+        
+        import greenlet
+        from nitrogen.context import RequestContext
+        
+        ctx = RequestContext()
+        local = ctx.local()
+        
+        def run():
+            token = ctx.push()
+            local.x = 1
+            ctx.pop(token)
+            # Outside of a request; as the logging formatters do.
+            self.assertEqual(getattr(local, 'x', None), None)
+            local.y = 2
+            self.assertEqual(getattr(local, 'y', None), None)
+        
+        for i in range(100):
+            greenlet.greenlet(run).switch()
+        self.assertEqual(ctx._contexts, {})
+        
+    def test_build_app_class(self):
+        
+        from nitrogen.app import build_app_class
+        from nitrogen.cookies import CookieAppMixin
+        
+        cls = build_app_class(['auth'])
+        self.assertEqual(cls.subsystems, ('auth', 'cookies'))
+        self.assertTrue(issubclass(cls, CookieAppMixin))
+        self.assertTrue(build_app_class(['auth', 'cookies']) is cls)
+        self.assertRaises(ValueError, build_app_class, ['nope'])
+        
+        app = cls()
+        
+        @app.route('/')
+        def do_render(request):
+            return app.Response('hello')
+        
+        self.assertEqual(app.test_client().get('/').data, 'hello')
+        
+        # The full class is built on demand, and nitrogen.app stays a plain
+        # module (so that it can be patched).
+        import sys
+        import types
+        import nitrogen
+        self.assertTrue(nitrogen.get_app_class() is build_app_class() is App)
+        self.assertTrue(type(sys.modules['nitrogen.app']) is types.ModuleType)
+        
+    def test_warmup(self):
+        
+        app = App()
+        app.warmup()
+        
+        self.assertTrue(app._flattened_wsgi_app is not None)
+        self.assertTrue('Request' in app.__dict__)
+        self.assertTrue('/status/generic.html' in app.lookup._collection)
+        
+    def test_metrics(self):
+        
+        app = App(metrics_on=True, metrics_url='/metrics')
+        
+        @app.route('/page')
+        def do_page(request):
+            return app.Response(app.render_string('hello ${name}', name='world'))
+        
+        client = app.test_client()
+        self.assertEqual(client.get('/page', buffered=True).data, 'hello world')
+        
+        route = 'tests.app:do_page'
+        phases = set(phase for (name, phase), h in app.metrics.items() if name == route)
+        for phase in 'route', 'controller', 'render', 'body', 'total':
+            self.assertTrue(phase in phases, phase)
+            self.assertEqual(app.metrics.get(route, phase).count, 1)
+        self.assertTrue(any(phase.startswith('middleware.') for phase in phases))
+        
+        res = client.get('/metrics', buffered=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Type'], 'text/plain; version=0.0.4')
+        self.assertTrue('nitrogen_phase_seconds_count{route="tests.app:do_page",phase="render"} 1\n' in res.data)
+        self.assertTrue('nitrogen_phase_seconds_bucket{route="tests.app:do_page",phase="total",le="+Inf"} 1\n' in res.data)
+        
+    def test_bench(self):
+        
+        from nitrogen import bench
+        
+        app = App()
+        
+        @app.route('/')
+        def do_render(request):
+            return app.Response('hello')
+        
+        results = bench.run(app, [bench.Target('/', name='index')], concurrency=2, requests=10, warmup=0)
+        self.assertEqual(results.count, 10)
+        self.assertEqual(dict(results.statuses['index']), {200: 10})
+        self.assertTrue(any(phase == 'controller' for route, phase in results.phases))
+        
+    def test_admission_control(self):
+        
+        import threading
+        
+        app = App(admission_max_in_flight=1, admission_max_queue=0)
+        
+        entered = threading.Event()
+        proceed = threading.Event()
+        
+        @app.route('/slow')
+        def do_slow(request):
+            entered.set()
+            proceed.wait(5)
+            return app.Response('slow')
+        
+        @app.route('/health')
+        def do_health(request):
+            return app.Response('ok')
+        
+        results = []
+        thread = threading.Thread(target=lambda: results.append(app.test_client().get('/slow', buffered=True).data))
+        thread.start()
+        entered.wait(5)
+        
+        client = app.test_client()
+        res = client.get('/slow')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(client.get('/health').data, 'ok')
+        
+        proceed.set()
+        thread.join()
+        self.assertEqual(results, ['slow'])
+        self.assertEqual(app.admission_limiter.in_flight, 0)
+        self.assertEqual(client.get('/slow', buffered=True).data, 'slow')
+        
+    def test_spooled_body(self):
+        
+        from nitrogen import body
+        
+        app = App()
+        
+        class UploadRequest(Request):
+            stream_factory = staticmethod(body.make_spooled_factory(16))
+        
+        progress = []
+        
+        @app.route('/seekable')
+        def do_seekable(environ, start):
+            request = Request(environ)
+            request.make_body_seekable(max_size=16, progress=lambda *x: progress.append(x))
+            first = request.body.read()
+            request.body.seek(0)
+            assert request.body.read() == first
+            assert request.body._rolled
+            start('200 OK', [])
+            return [first]
+        
+        @app.route('/upload')
+        def do_upload(environ, start):
+            request = UploadRequest(environ)
+            request.track_progress(lambda *x: progress.append(x))
+            upload = request.files['file']
+            assert upload.stream._rolled
+            start('200 OK', [])
+            return [upload.read()]
+        
+        client = app.test_client()
+        data = 'x' * 100
+        self.assertEqual(client.post('/seekable', data=data).data, data)
+        self.assertEqual(progress[-1], (100, 100))
+        
+        del progress[:]
+        from StringIO import StringIO
+        res = client.post('/upload', data={'file': (StringIO(data), 'x.txt')})
+        self.assertEqual(res.data, data)
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        
+    def test_iter_multipart(self):
+        
+        import hashlib
+        from StringIO import StringIO
+        
+        app = App()
+        
+        @app.route('/upload')
+        def do_upload(request):
+            out = []
+            for part in request.iter_multipart(chunk_size=7):
+                if part.is_file:
+                    hash = hashlib.md5()
+                    for chunk in part:
+                        assert len(chunk) <= 7
+                        hash.update(chunk)
+                    out.append('%s=%s' % (part.filename, hash.hexdigest()))
+                else:
+                    out.append('%s=%s' % (part.name, part.read()))
+            return app.Response(' '.join(out))
+        
+        data = 'x\r\n--y' * 1000
+        res = app.test_client().post('/upload', data={
+            'title': 'hello',
+            'file': (StringIO(data), 'x.txt'),
+        })
+        self.assertEqual(sorted(res.data.split()), ['title=hello', 'x.txt=' + hashlib.md5(data).hexdigest()])
+        
+    def test_version_etag(self):
+        
+        app = App()
+        rendered = []
+        
+        @app.route('/page')
+        def do_page(request):
+            request.check_version('v1')
+            rendered.append(True)
+            return app.Response('page')
+        
+        @app.route('/stream')
+        def do_stream(request):
+            request.check_version('v1')
+            rendered.append(True)
+            return app.Response(iter(['str', 'eam']))
+        
+        client = app.test_client()
+        
+        res = client.get('/page')
+        etag = res.headers['ETag']
+        # Buffered, since the test client chokes on empty streamed bodies.
+        res = client.get('/page', headers=[('If-None-Match', etag)], buffered=True)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(rendered), 1)
+        
+        # Streams can only send their ETag once it has been computed.
+        res = client.get('/stream', buffered=True)
+        self.assertEqual(res.data, 'stream')
+        self.assertTrue('ETag' not in res.headers)
+        res = client.get('/stream', buffered=True)
+        etag = res.headers['ETag']
+        res = client.get('/stream', headers=[('If-None-Match', etag)], buffered=True)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(len(rendered), 3)
+        
+    def test_compression(self):
+        
+        import zlib
+        from nitrogen import eventstream
+        
+        app = App(compress_on=True, compress_min_size=100)
+        
+        @app.route('/big')
+        def do_big(request):
+            return app.Response('hello ' * 100)
+        
+        @app.route('/small')
+        def do_small(request):
+            return app.Response('hello')
+        
+        @app.route('/events')
+        def do_events(request):
+            return eventstream.Response(iter(['one', 'two']))
+        
+        client = app.test_client()
+        gzip = [('Accept-Encoding', 'gzip')]
+        
+        res = client.get('/big', headers=gzip, buffered=True)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        self.assertEqual(zlib.decompress(res.data, 16 + zlib.MAX_WBITS), 'hello ' * 100)
+        
+        # Our suffixed ETag still matches.
+        res = client.get('/big', headers=gzip + [('If-None-Match', res.headers['ETag'])], buffered=True)
+        self.assertEqual(res.status_code, 304)
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        
+        res = client.get('/small', headers=gzip, buffered=True)
+        self.assertTrue('Content-Encoding' not in res.headers)
+        self.assertEqual(res.data, 'hello')
+        
+        res = client.get('/big', buffered=True)
+        self.assertTrue('Content-Encoding' not in res.headers)
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        
+        # Every event is flushed on its own.
+        from werkzeug.test import create_environ, run_wsgi_app
+        environ = create_environ('/events', headers=gzip + [('Accept', 'text/event-stream')])
+        app_iter, status, headers = run_wsgi_app(app, environ)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(next(app_iter)), 'data: one\n\n')
+        self.assertEqual(decompressor.decompress(next(app_iter)), 'data: two\n\n')
+    
+    def test_server_file_wrapper(self):
+        
+        from wsgiref.util import FileWrapper
+        from werkzeug.test import create_environ
+        
+        for compiled, compress in (True, False), (False, False), (False, True):
+            
+            # Compression is on, but the file is too small for it.
+            app = App(compiled_pipeline=compiled, admission_max_in_flight=1, admission_bypass_static=False,
+                static_hot_cache_size=0, compress_on=compress, compress_min_size=1 << 20)
+            finished = []
+            app.after_request.listen(finished.append)
+            
+            environ = create_environ('/static-test.txt', headers=[('Accept-Encoding', 'gzip')])
+            environ['wsgi.file_wrapper'] = FileWrapper
+            started = []
+            app_iter = app(environ, lambda status, headers, exc_info=None: started.append((status, headers)))
+            
+            # The server gets its own wrapper back, through every layer.
+            self.assertTrue(isinstance(app_iter, FileWrapper))
+            self.assertEqual(app.admission_limiter.in_flight, 1)
+            headers = dict(started[0][1])
+            self.assertEqual(int(headers['Content-Length']), len(''.join(app_iter)))
+            self.assertEqual(finished, [])
+            app_iter.close()
+            self.assertEqual(app.admission_limiter.in_flight, 0)
+            self.assertEqual(len(finished), 1)
+    
+    def test_byte_ranges(self):
+        
+        app = App()
+        client = app.test_client()
+        with open(os.path.join(os.path.dirname(__file__), '..', 'static', 'static-test.txt'), 'rb') as fh:
+            data = fh.read()
+        
+        res = client.get('/static-test.txt', buffered=True)
+        self.assertEqual(res.headers['Accept-Ranges'], 'bytes')
+        etag = res.headers['ETag']
+        
+        res = client.get('/static-test.txt', headers=[('Range', 'bytes=2-5')], buffered=True)
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 2-5/%d' % len(data))
+        self.assertEqual(res.data, data[2:6])
+        
+        res = client.get('/static-test.txt', headers=[('Range', 'bytes=0-0,-2')], buffered=True)
+        self.assertEqual(res.status_code, 206)
+        self.assertTrue(res.mimetype == 'multipart/byteranges')
+        self.assertEqual(int(res.headers['Content-Length']), len(res.data))
+        self.assertTrue(('Content-Range: bytes 0-0/%d\r\n\r\n%s\r\n' % (len(data), data[0])) in res.data)
+        self.assertTrue(res.data.endswith('%s\r\n--%s--\r\n' % (data[-2:], res.mimetype_params['boundary'])))
+        
+        res = client.get('/static-test.txt', headers=[('Range', 'bytes=%d-' % len(data))], buffered=True)
+        self.assertEqual(res.status_code, 416)
+        self.assertEqual(res.headers['Content-Range'], 'bytes */%d' % len(data))
+        
+        # A stale If-Range gets the whole file.
+        res = client.get('/static-test.txt', headers=[('Range', 'bytes=2-5'), ('If-Range', '"old"')], buffered=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, data)
+        res = client.get('/static-test.txt', headers=[('Range', 'bytes=2-5'), ('If-Range', etag)], buffered=True)
+        self.assertEqual(res.status_code, 206)
+    
+    def test_page_cache(self):
+        
+        import shutil
+        import stat
+        import tempfile
+        from nitrogen.cache import PageCache
+        
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        app = App(cache_dir=cache_dir, page_cache_disk=True, page_cache_stale=60)
+        
+        # Our own directory, which nobody else may use.
+        directory = app.page_cache.directory
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0700)
+        os.chmod(directory, 0777)
+        self.assertRaises(ValueError, PageCache, directory=directory)
+        os.chmod(directory, 0700)
+        
+        renders = []
+        
+        @app.route('/page')
+        @app.cache_page(ttl=60, tags=['pages'], vary=['Accept-Language'])
+        @Request.application
+        def do_page(request):
+            renders.append(request.headers.get('Accept-Language'))
+            return Response('page %d' % len(renders), headers=[('Vary', 'Accept-Language')])
+        
+        @app.route('/user')
+        @app.cache_page(ttl=60, vary=['Accept-Language'])
+        @Request.application
+        def do_user(request):
+            return Response('user', headers=[('Vary', 'Accept-Language, X-User')])
+        
+        client = app.test_client()
+        res = client.get('/page', buffered=True)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        res = client.get('/page', buffered=True)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(res.data, 'page 1')
+        self.assertEqual(client.get('/page', headers=[('If-None-Match', res.headers['ETag'])], buffered=True).status_code, 304)
+        
+        # Varies upon the header.
+        self.assertEqual(client.get('/page', headers=[('Accept-Language', 'fr')], buffered=True).data, 'page 2')
+        
+        # The disk tier outlives the memory tier.
+        app.page_cache.memory.clear()
+        self.assertEqual(client.get('/page', buffered=True).data, 'page 1')
+        app.page_cache.prune()
+        self.assertEqual(client.get('/page', buffered=True).data, 'page 1')
+        
+        app.page_cache.invalidate('pages')
+        self.assertEqual(client.get('/page', buffered=True).data, 'page 3')
+        self.assertEqual(renders, [None, 'fr', None])
+        
+        # Stale entries are served while someone else revalidates.
+        from werkzeug.test import create_environ
+        # (As routed, with the trailing slash.)
+        key = app.page_cache.make_key(create_environ('/', 'http://localhost/page'), ['Accept-Language'])
+        app.page_cache.memory.get(key).expires = 0
+        app.page_cache._revalidating.add(key)
+        res = client.get('/page', buffered=True)
+        self.assertEqual((res.headers['X-Cache'], res.data), ('STALE', 'page 3'))
+        app.page_cache._revalidating.discard(key)
+        self.assertEqual(client.get('/page', buffered=True).data, 'page 4')
+        
+        # Varies upon something which is not in the key.
+        for i in range(2):
+            self.assertEqual(client.get('/user', buffered=True).headers['X-Cache'], 'MISS')
+    
+    def test_coalesce_requests(self):
+        
+        import threading
+        
+        app = App()
+        gate = threading.Event()
+        renders = []
+        
+        @app.route('/slow')
+        @app.coalesce_requests()
+        @Request.application
+        def do_slow(request):
+            renders.append(True)
+            gate.wait(5)
+            response = Response('slow')
+            response.set_etag('v1')
+            return response.make_conditional(request)
+        
+        results = []
+        def get(headers):
+            res = app.test_client().get('/slow', headers=headers, buffered=True)
+            results.append((res.status_code, res.data))
+        
+        # The first (who renders for everyone) already has the page; the rest
+        # must still get all of it.
+        threads = [threading.Thread(target=get, args=([('If-None-Match', '"v1"')], ))]
+        threads[0].start()
+        while not renders:
+            time.sleep(0.01)
+        threads.extend(threading.Thread(target=get, args=([], )) for i in range(3))
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1) # For the rest to join in.
+        gate.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(sorted(results), [(200, 'slow')] * 3 + [(304, '')])
+        self.assertEqual(len(renders) + app.singleflight.shared, 4)
+    
+    def test_lite_request(self):
+        
+        from nitrogen.request import LiteRequest
+        
+        app = App(private_key='0' * 32)
+        seen = []
+        
+        @app.route('/api/{id}')
+        @app.Request.application(lite=True)
+        def do_api(request):
+            seen.append(request)
+            return Response('%s %s %s %s' % (request.route['id'], request.query['x'], request.post.get('y'), request.user_id))
+        
+        client = app.test_client()
+        cookie = app.dump_cookie('user_id', 'bob').split(';')[0]
+        res = client.post('/api/123?x=1', data={'y': '2'}, headers=[('Cookie', cookie)], buffered=True)
+        self.assertEqual(res.data, '123 1 2 bob')
+        self.assertTrue(isinstance(seen[0], LiteRequest))
+        self.assertFalse(hasattr(seen[0], '__dict__'))
+        
+        # Forged cookies are dropped.
+        res = client.get('/api/123?x=1', headers=[('Cookie', 'user_id=bob')], buffered=True)
+        self.assertEqual(res.data, '123 1 None None')
+        
+        # Without subsystems which want one, nothing builds a full Request (or
+        # a default Response) along the way.
+        from nitrogen.app import build_app_class
+        lean = build_app_class(['cookies'])(private_key='0' * 32)
+        
+        @lean.route('/api/{id}')
+        @lean.Request.application(lite=True)
+        def do_lean_api(request):
+            seen.append(request)
+            return Response('%s %s %s' % (request.route['id'], request.query['x'], request.user_id))
+        
+        built = []
+        original = Request.__init__
+        def counting_init(self, *args, **kwargs):
+            built.append(self)
+            original(self, *args, **kwargs)
+        Request.__init__ = counting_init
+        try:
+            res = lean.test_client().get('/api/123?x=1', buffered=True)
+        finally:
+            Request.__init__ = original
+        self.assertEqual(res.data, '123 1 None')
+        self.assertEqual(built, [])
+        self.assertFalse(hasattr(seen[-1], '_response'))
+        
+        # Every app has its own lite class, and there is none without an app.
+        other = App()
+        self.assertTrue(app.Request.lite_class.app is app)
+        self.assertTrue(other.Request.lite_class.app is other)
+        self.assertRaises(ValueError, Request.application, lambda request: None, lite=True)
+    
+    def test_json_response(self):
+        
+        import json
+        from nitrogen.request import JSONResponse
+        
+        app = App()
+        
+        @app.route('/rows')
+        @Request.application
+        def do_rows(request):
+            return JSONResponse(dict(id=i) for i in xrange(1000))
+        
+        @app.route('/small')
+        @Request.application
+        def do_small(request):
+            return JSONResponse(dict(a=1))
+        
+        res = app.test_client().get('/rows', buffered=True)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertTrue('Content-Length' not in res.headers)
+        self.assertEqual(json.loads(res.data), [dict(id=i) for i in xrange(1000)])
+        
+        res = app.test_client().get('/small', buffered=True)
+        self.assertEqual(json.loads(res.data), dict(a=1))
+        self.assertTrue('ETag' in res.headers)
+        
+        # Scalars which only the encoder understands are not mistaken for
+        # lists to stream.
+        import datetime
+        encoder = lambda obj: json.dumps(obj, default=lambda x: x.isoformat())
+        res = JSONResponse(datetime.date(2012, 1, 2), encoder=encoder)
+        self.assertTrue(res.is_sequence)
+        self.assertEqual(res.data, '"2012-01-02"')
+    
+    def test_static_index(self):
+        
+        import shutil
+        import tempfile
+        from nitrogen.static import StaticIndex
+        
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.makedirs(os.path.join(root, 'css'))
+        with open(os.path.join(root, 'css', 'a.css'), 'w') as fh:
+            fh.write('a')
+        
+        poll = StaticIndex([root], 'poll', interval=0)
+        frozen = StaticIndex([root], 'frozen')
+        self.assertEqual(poll.get('/css/a.css').size, 1)
+        self.assertEqual(frozen.get('css/a.css').hash, '0cc175b9c0f1b6a831c399e269772661')
+        self.assertTrue(poll.get('css/b.css') is None)
+        
+        with open(os.path.join(root, 'css', 'b.css'), 'w') as fh:
+            fh.write('b')
+        # The lookup starts a rescan in the background, and doesn't wait.
+        scanned_at = poll.scanned_at
+        poll.get('css/b.css')
+        for i in range(500):
+            if poll.scanned_at != scanned_at:
+                break
+            time.sleep(0.01)
+        self.assertTrue('css/b.css' in poll.files)
+        self.assertFalse('css/b.css' in frozen)
+        
+        app = App(static_path=[root], static_index='frozen')
+        self.assertEqual(app.test_client().get('/css/b.css', buffered=True).data, 'b')
+        
+        # Symlinked directories are followed, but not round in circles.
+        os.makedirs(os.path.join(root, 'vendor', 'framework'))
+        with open(os.path.join(root, 'vendor', 'framework', 'screen.css'), 'w') as fh:
+            fh.write('screen')
+        os.symlink('../vendor/framework', os.path.join(root, 'css', 'framework'))
+        os.symlink('..', os.path.join(root, 'vendor', 'framework', 'loop'))
+        frozen.scan()
+        self.assertEqual(frozen.get('css/framework/screen.css').size, 6)
+        self.assertTrue('css/framework/loop/screen.css' not in frozen)
+    
+    def test_static_fingerprints(self):
+        
+        import json
+        import shutil
+        import tempfile
+        from nitrogen import manifest
+        
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'site.css'), 'w') as fh:
+            fh.write('a')
+        manifest_path = os.path.join(root, 'manifest.json')
+        manifest.write_manifest(manifest_path, manifest.build_manifest([root]))
+        with open(manifest_path) as fh:
+            self.assertEqual(json.load(fh)['site.css'], 'site.0cc175b9.css')
+        
+        for app in App(static_path=[root]), App(static_path=[root], static_manifest=manifest_path):
+            url = app.static_router.versioned_url('/site.css')
+            self.assertEqual(url, '/site.0cc175b9.css')
+            res = app.test_client().get(url, buffered=True)
+            self.assertEqual(res.data, 'a')
+            self.assertTrue('immutable' in res.headers['Cache-Control'])
+            self.assertTrue('max-age=31536000' in res.headers['Cache-Control'])
+        
+        # Stale hashes still work, but are not cached forever.
+        res = app.test_client().get('/site.00000000.css', buffered=True)
+        self.assertEqual(res.data, 'a')
+        self.assertFalse('immutable' in res.headers['Cache-Control'])
+        
+        # Nor are hashes from a manifest which no longer matches the file.
+        with open(os.path.join(root, 'site.css'), 'w') as fh:
+            fh.write('b')
+        app = App(static_path=[root], static_manifest=manifest_path)
+        res = app.test_client().get('/site.0cc175b9.css', buffered=True)
+        self.assertEqual(res.data, 'b')
+        self.assertFalse('immutable' in res.headers['Cache-Control'])
+    
+    def test_asset_bundles(self):
+        
+        import shutil
+        import tempfile
+        
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.makedirs(os.path.join(root, 'css'))
+        for name, content in ('a.js', 'var a = 1;'), ('b.js', 'var b = 2'), ('css/c.css', 'a {\n  background: url(../img/x.png);\n}\n'):
+            with open(os.path.join(root, name), 'w') as fh:
+                fh.write(content)
+        
+        app = App(cache_dir=root, static_path=[root], assets_bundles={
+            'all.js': ['a.js', 'b.js'],
+            'all.css': ['css/c.css'],
+        })
+        client = app.test_client()
+        self.assertFalse(os.path.exists(app.assets.directory))
+        
+        url = app.asset_url('all.js')
+        
+        # Built where only we can write.
+        import stat
+        self.assertEqual(stat.S_IMODE(os.stat(app.assets.directory).st_mode), 0700)
+        
+        self.assertTrue(url.startswith('/__assets/all.'))
+        res = client.get(url, buffered=True)
+        self.assertEqual(res.data, 'var a=1;;var b=2')
+        self.assertTrue('immutable' in res.headers['Cache-Control'])
+        self.assertEqual(client.get(app.asset_url('all.css'), buffered=True).data, 'a{background:url(/img/x.png);}')
+        
+        # Rebuilt (with a new URL) only when an input changes.
+        self.assertEqual(app.asset_url('all.js'), url)
+        with open(os.path.join(root, 'b.js'), 'w') as fh:
+            fh.write('var b = 3')
+        os.utime(os.path.join(root, 'b.js'), (0, 0))
+        app.static_router.index.scan()
+        self.assertNotEqual(app.asset_url('all.js'), url)
+        self.assertEqual(client.get('/__assets/all.00000000.js', buffered=True).status_code, 404)
+        
+        # A directory we wouldn't build into only matters if we do.
+        os.chmod(app.assets.directory, 0777)
+        app = App(cache_dir=root, static_path=[root])
+        app = App(cache_dir=root, static_path=[root], assets_bundles={'all.js': ['a.js']})
+        self.assertRaises(ValueError, app.asset_url, 'all.js')
+    
+    def test_static_hot_cache(self):
+        
+        import zlib
+        
+        app = App()
+        client = app.test_client()
+        hot_cache = app.static_router.hot_cache
+        
+        res = client.get('/static-test.txt', buffered=True)
+        self.assertEqual(res.data, 'This is a static file.')
+        res = client.get('/static-test.txt', buffered=True)
+        self.assertEqual(hot_cache.stats['hits'], 1)
+        etag = res.headers['ETag']
+        
+        # Same headers as from the file.
+        res = App(static_hot_cache_size=0).test_client().get('/static-test.txt', buffered=True)
+        self.assertEqual(res.headers['ETag'], etag)
+        
+        res = client.get('/static-test.txt', headers=[('If-None-Match', etag)], buffered=True)
+        self.assertEqual(res.status_code, 304)
+        
+        # Compressible files are also kept gzipped.
+        res = client.get('/js/jquery.crud.js', headers=[('Accept-Encoding', 'gzip')], buffered=True)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        with open(os.path.join(os.path.dirname(__file__), '..', 'static', 'js', 'jquery.crud.js'), 'rb') as fh:
+            self.assertEqual(zlib.decompress(res.data, 16 + zlib.MAX_WBITS), fh.read())
+        
+        # Only the ETag of the variant being served is good for a 304, even
+        # if the compress middleware has stripped the suffix from it.
+        gzip_etag = res.headers['ETag']
+        identity_etag = client.get('/js/jquery.crud.js', buffered=True).headers['ETag']
+        self.assertNotEqual(gzip_etag, identity_etag)
+        for client in app.test_client(), App(compress_on=True).test_client():
+            res = client.get('/js/jquery.crud.js', headers=[('Accept-Encoding', 'gzip'), ('If-None-Match', identity_etag)], buffered=True)
+            self.assertEqual((res.status_code, res.headers['Content-Encoding']), (200, 'gzip'))
+            res = client.get('/js/jquery.crud.js', headers=[('Accept-Encoding', 'gzip'), ('If-None-Match', gzip_etag)], buffered=True)
+            self.assertEqual((res.status_code, res.headers['ETag']), (304, gzip_etag))
+            res = client.get('/js/jquery.crud.js', headers=[('If-None-Match', identity_etag)], buffered=True)
+            self.assertEqual(res.status_code, 304)
+    
+    def test_static_gzip_sidecars(self):
+        
+        import shutil
+        import tempfile
+        import zlib
+        from nitrogen.precompress import precompress
+        
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        css = 'a { color: red; }\n' * 100
+        with open(os.path.join(root, 'site.css'), 'w') as fh:
+            fh.write(css)
+        with open(os.path.join(root, 'logo.png'), 'w') as fh:
+            fh.write('not really a png' * 100)
+        
+        self.assertEqual(precompress([root]), 1)
+        self.assertEqual(precompress([root]), 0) # Already up to date.
+        self.assertFalse(os.path.exists(os.path.join(root, 'logo.png.gz')))
+        with open(os.path.join(root, 'site.css.gz'), 'rb') as fh:
+            sidecar = fh.read()
+        self.assertEqual(zlib.decompress(sidecar, 16 + zlib.MAX_WBITS), css)
+        
+        # From the file, and from the hot cache.
+        validators = []
+        for size in 0, 1024 * 1024:
+            client = App(static_path=[root], static_hot_cache_size=size).test_client()
+            res = client.get('/site.css', headers=[('Accept-Encoding', 'gzip')], buffered=True)
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(res.mimetype, 'text/css')
+            self.assertEqual(res.data, sidecar)
+            gzipped = res
+            res = client.get('/site.css', buffered=True)
+            self.assertFalse('Content-Encoding' in res.headers)
+            self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(res.data, css)
+            validators.append([(r.headers['ETag'], r.headers['Last-Modified']) for r in (gzipped, res)])
+        
+        # Both paths give each variant the same validators, so either one
+        # revalidates what the other sent (with or without the compress
+        # middleware in the way).
+        self.assertEqual(validators[0], validators[1])
+        gzip_etag = validators[0][0][0]
+        for size in 0, 1024 * 1024:
+            for compress_on in False, True:
+                client = App(static_path=[root], static_hot_cache_size=size, compress_on=compress_on).test_client()
+                res = client.get('/site.css', headers=[('Accept-Encoding', 'gzip'), ('If-None-Match', gzip_etag)], buffered=True)
+                self.assertEqual(res.status_code, 304)
+        
+        # A stale sidecar is ignored.
+        mtime = os.path.getmtime(os.path.join(root, 'site.css'))
+        os.utime(os.path.join(root, 'site.css.gz'), (mtime - 10, mtime - 10))
+        client = App(static_path=[root], static_hot_cache_size=0).test_client()
+        res = client.get('/site.css', headers=[('Accept-Encoding', 'gzip')], buffered=True)
+        self.assertFalse('Content-Encoding' in res.headers)
+        self.assertEqual(res.data, css)
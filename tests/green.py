@@ -0,0 +1,107 @@
+import threading
+
+import gevent
+from werkzeug.test import create_environ
+
+from nitrogen.core import App
+from nitrogen import green
+from nitrogen import test
+
+
+def _call(frontend, path='/'):
+    captured = []
+    def start(status, headers, exc_info=None):
+        captured[:] = [status, headers]
+    app_iter = frontend(create_environ(path), start)
+    return captured, app_iter
+
+
+class TestFrontend(test.TestCase):
+
+    def test_cooperative_runs_on_hub(self):
+
+        app = App(route_cache_size=10)
+        threads = []
+
+        @app.route('/green')
+        @green.cooperative
+        def do_green(request):
+            threads.append(threading.current_thread())
+            return app.Response('green')
+
+        @app.route('/blocking')
+        def do_blocking(request):
+            threads.append(threading.current_thread())
+            return app.Response('blocking')
+
+        frontend = green.Frontend(app, threads=2)
+        for path in '/green', '/blocking', '/green', '/blocking':
+            captured, app_iter = _call(frontend, path)
+            self.assertEqual(''.join(app_iter), path.strip('/'))
+            self.assertEqual(captured[0], '200 OK')
+
+        main = threading.current_thread()
+        self.assertTrue(threads[0] is main and threads[2] is main)
+        self.assertTrue(threads[1] is not main and threads[3] is not main)
+        # The second round was decided by the route cache.
+        self.assertTrue(app.route_cache.hits >= 2)
+
+    def test_streams_from_pool(self):
+
+        produced = []
+        closed = []
+
+        class Body(object):
+            def __iter__(self):
+                for i in range(5):
+                    produced.append(i)
+                    yield str(i)
+            def close(self):
+                closed.append(True)
+
+        def app(environ, start):
+            start('200 OK', [('Content-Type', 'text/plain')])
+            return Body()
+
+        frontend = green.Frontend(app, threads=1)
+        captured, app_iter = _call(frontend)
+        chunks = iter(app_iter)
+        self.assertEqual(next(chunks), '0')
+        gevent.sleep(0.05)
+        # One chunk waiting for us, and one being made; no more.
+        self.assertTrue(len(produced) <= 3)
+        self.assertEqual(list(chunks), ['1', '2', '3', '4'])
+        self.assertEqual(captured[0], '200 OK')
+        self.assertEqual(closed, [True])
+
+    def test_close_stops_thread(self):
+
+        closed = threading.Event()
+
+        def app(environ, start):
+            start('200 OK', [('Content-Type', 'text/event-stream')])
+            def events():
+                try:
+                    while True:
+                        yield 'data: tick\n\n'
+                finally:
+                    closed.set()
+            return events()
+
+        frontend = green.Frontend(app, threads=1)
+        captured, app_iter = _call(frontend)
+        chunks = iter(app_iter)
+        self.assertEqual(next(chunks), 'data: tick\n\n')
+        app_iter.close()
+
+        # The thread has let go of the stream, and is free for other work.
+        self.assertEqual(frontend.pool.apply(lambda: closed.wait(1)), True)
+
+    def test_errors_are_raised_on_hub(self):
+
+        def app(environ, start):
+            raise ValueError('boom')
+
+        frontend = green.Frontend(app, threads=1)
+        captured, app_iter = _call(frontend)
+        self.assertRaises(ValueError, list, app_iter)